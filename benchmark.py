@@ -0,0 +1,213 @@
+"""
+Offline benchmark of the encode.py pipelines on CPU: synthetic JPEGs and captions, tiny randomly
+initialized Dinov2 / BERT encoders built from configs (nothing is downloaded), real DataLoader,
+ShardWriter and manifests. Compare decode backends, batch sizes and worker counts between commits:
+
+    python benchmark.py --num_images 2000 --resolution 1600 1200 --batch_size 32 128 \
+        --variants baseline jpeg_draft fast_preprocess draft_fast --output bench.json
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import Dinov2Config, Dinov2Model, BitImageProcessor, BertConfig, BertModel, BertTokenizerFast
+
+from encode import process_batch_image, process_caption_columns
+from model import ImageEmbedding, SentenceEmbedding
+from model.language_model import mean_pooling
+from data.shard_writer import ShardWriter
+from data.manifest import ManifestWriter
+from data.batched_processor import BatchedImageProcessor
+from data.pixel_cache import processor_spec
+from train.timing import StageTimer
+
+WORDS = ("a photo of the dog cat man woman child car street tree house red blue green small large "
+         "sitting standing running next to on in with under near two three group people field water").split()
+VARIANTS = ("baseline", "jpeg_draft", "fast_preprocess", "draft_fast")
+
+
+class TinyImageEmbedding(ImageEmbedding):
+    """ImageEmbedding around a randomly initialized Dinov2 of a few layers, on CPU."""
+
+    def __init__(self, agg_mode='concat', hidden_size=64, num_layers=2):
+        torch.nn.Module.__init__(self)
+        self.device = 'cpu'
+        self.seg = False
+        self.agg_mode = agg_mode
+        self.model_name = 'tiny-dinov2'
+        self.SDPA = True
+        config = Dinov2Config(hidden_size=hidden_size, num_hidden_layers=num_layers, num_attention_heads=2,
+                              intermediate_size=2 * hidden_size, image_size=224, patch_size=14)
+        self.model = Dinov2Model(config).eval()
+        # the dinov2 preprocessing: shortest edge 256, center crop 224, bicubic, imagenet statistics
+        self.image_processor = BitImageProcessor(size={'shortest_edge': 256}, crop_size={'height': 224, 'width': 224}, resample=3,
+                                                 image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225])
+
+
+class TinySentenceEmbedding(SentenceEmbedding):
+    """SentenceEmbedding around a randomly initialized BERT with a word-level vocabulary, on CPU."""
+
+    def __init__(self, workdir, hidden_size=64, num_layers=2):
+        torch.nn.Module.__init__(self)
+        self.model_name = 'tiny-bert'
+        self.pooling = mean_pooling
+        self.device = torch.device('cpu')
+        vocab_file = os.path.join(workdir, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS))
+        self.tokenizer = BertTokenizerFast(vocab_file=vocab_file)
+        config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=hidden_size, num_hidden_layers=num_layers, num_attention_heads=2,
+                            intermediate_size=2 * hidden_size, max_position_embeddings=1024)
+        self.model = BertModel(config).eval()
+        self.bucket_stats = {'tokens': 0, 'padded_tokens': 0}
+
+
+def make_images(image_dir, num_images, resolution, quality=90, seed=0):
+    """Smooth gradients plus noise, so JPEG sizes and decode cost resemble photos rather than pure noise."""
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(image_dir, f'{i}.jpg')
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        phase = rng.uniform(0, 2 * np.pi, size=3)
+        freq = rng.uniform(2, 12, size=3) * np.pi / max(width, height)
+        channels = [127 + 100 * np.sin(freq[c] * (x + y * (c + 1) / 3) + phase[c]) for c in range(3)]
+        pixels = np.stack(channels, axis=-1) + rng.normal(0, 12, size=(height, width, 3))
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(path, quality=quality)
+    return paths
+
+
+def make_captions(num_captions, min_words=5, max_words=60, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, size=rng.integers(min_words, max_words + 1))) for _ in range(num_captions)]
+
+
+def dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; children covers the DataLoader workers
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_rss / 1024, children_rss / 1024
+
+
+def run_image(args, image_paths, batch_size, variant, output_dir):
+    model = TinyImageEmbedding()
+    processor = model.image_processor
+    decode_min_side = processor_spec(processor)['resize'] if variant in ('jpeg_draft', 'draft_fast') else None
+    if variant in ('fast_preprocess', 'draft_fast'):
+        processor = BatchedImageProcessor.from_processor(processor, backend=args.preprocess_backend,
+                                                         device=args.preprocess_device if args.preprocess_backend == 'tensor' else 'cpu')
+    writer = ShardWriter(args.storage_dtype, ManifestWriter(output_dir, 0, len(image_paths), source={'benchmark': variant}))
+    timer = StageTimer(os.path.join(args.workdir, f'timing_image_{variant}_{batch_size}.jsonl') if args.timing else None, enabled=args.timing)
+    start = time.perf_counter()
+    with torch.no_grad():
+        process_batch_image(image_paths, [model], 0, batch_size, [output_dir], resume=False, writers=[writer], num_workers=args.num_workers,
+                            prefetch_factor=args.prefetch_factor, image_processors=[processor], decode_min_side=decode_min_side, timer=timer)
+    writer.close()
+    seconds = time.perf_counter() - start
+    timer.log_summary('images')
+    timer.close()
+    return {'images_per_s': len(image_paths) / seconds, 'seconds': seconds}
+
+
+def run_text(args, captions, batch_size, variant, output_dir):
+    model = TinySentenceEmbedding(args.workdir)
+    if variant == 'bucketed':
+        encode_function, shards_per_call = (lambda batch: model.get_sentence_embeddings_bucketed(batch, batch_size)), args.bucket_shards
+    else:
+        encode_function, shards_per_call = model.get_sentence_embeddings, 1
+    writer = ShardWriter(args.storage_dtype, ManifestWriter(output_dir, 0, len(captions), source={'benchmark': variant}))
+    timer = StageTimer(os.path.join(args.workdir, f'timing_text_{variant}_{batch_size}.jsonl') if args.timing else None, enabled=args.timing)
+    start = time.perf_counter()
+    with torch.no_grad():
+        process_caption_columns([captions], 0, batch_size, [output_dir], encode_function, resume=False, writers=[writer],
+                                shards_per_call=shards_per_call, timer=timer)
+    writer.close()
+    seconds = time.perf_counter() - start
+    timer.log_summary('captions')
+    timer.close()
+    return {'captions_per_s': len(captions) / seconds, 'seconds': seconds}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmark of the encode.py image and text pipelines")
+    parser.add_argument('--workdir', type=str, default=None, help='Keeps the synthetic data between runs; a temporary directory by default')
+    parser.add_argument('--domain', type=str, nargs='+', choices=['image', 'text'], default=['image', 'text'])
+    parser.add_argument('--num_images', type=int, default=512)
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1024, 768], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--num_captions', type=int, default=8192)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[64])
+    parser.add_argument('--variants', type=str, nargs='+', default=['baseline'], choices=VARIANTS, help='Image decode/preprocess backends')
+    parser.add_argument('--preprocess_backend', type=str, default='pil', choices=['pil', 'tensor'], help='BatchedImageProcessor backend of the fast variants')
+    parser.add_argument('--preprocess_device', type=str, default='cpu', help='Device of the tensor backend')
+    parser.add_argument('--text_variants', type=str, nargs='+', default=['plain', 'bucketed'], choices=['plain', 'bucketed'])
+    parser.add_argument('--bucket_shards', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--prefetch_factor', type=int, default=4)
+    parser.add_argument('--storage_dtype', type=str, default='float16')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--timing', action='store_true', help='Stage timing tables and JSONL logs in the workdir')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    cleanup = args.workdir is None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='sail_bench_')
+    os.makedirs(args.workdir, exist_ok=True)
+    results = []
+    try:
+        if 'image' in args.domain:
+            image_paths = make_images(os.path.join(args.workdir, f'images_{args.resolution[0]}x{args.resolution[1]}'), args.num_images, args.resolution)
+            for batch_size in args.batch_size:
+                for variant in args.variants:
+                    output_dir = os.path.join(args.workdir, 'out', f'image_{variant}_{batch_size}')
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    result = run_image(args, image_paths, batch_size, variant, output_dir)
+                    results.append({'domain': 'image', 'variant': variant, 'batch_size': batch_size, **result, 'bytes_written': dir_bytes(output_dir)})
+        if 'text' in args.domain:
+            captions = make_captions(args.num_captions)
+            for batch_size in args.batch_size:
+                for variant in args.text_variants:
+                    output_dir = os.path.join(args.workdir, 'out', f'text_{variant}_{batch_size}')
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    result = run_text(args, captions, batch_size, variant, output_dir)
+                    results.append({'domain': 'text', 'variant': variant, 'batch_size': batch_size, **result, 'bytes_written': dir_bytes(output_dir)})
+    finally:
+        if cleanup:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    self_rss, children_rss = peak_rss_mb()
+    lines = [f"{'domain':<8}{'variant':<18}{'batch':>6}{'items/s':>12}{'seconds':>10}{'MB written':>12}"]
+    for r in results:
+        rate = r.get('images_per_s', r.get('captions_per_s'))
+        lines.append(f"{r['domain']:<8}{r['variant']:<18}{r['batch_size']:>6}{rate:>12.1f}{r['seconds']:>10.2f}{r['bytes_written'] / 2**20:>12.2f}")
+    lines.append(f"Peak RSS: {self_rss:.0f} MB main process, {children_rss:.0f} MB largest worker")
+    logging.info("Benchmark results:\n" + "\n".join(lines))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k != 'output'}, 'results': results,
+                       'peak_rss_mb': self_rss, 'peak_worker_rss_mb': children_rss}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Step time, peak memory and estimate quality of the SigLip loss variants on random features:
+dense, blockwise (--siglip-block-size) and sampled negatives (--siglip-negatives, random / hard).
+
+    python benchmark_loss.py --batch_size 4096 16384 --num_negatives 64 256 --device cuda --output loss_bench.json
+
+All variants run in one process; the ring exchange across ranks (which samples each received
+block too) is checked for correctness by `python -m model.loss`, not timed here.
+Downstream quality is not measured here: train one alignment layer per variant with main.py
+(e.g. --siglip --siglip-negatives 256) and compare their eval.py COCO / ImageNet results.
+"""
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from model.loss import SigLipLoss
+from train.logger import setup_logging
+
+
+def make_features(batch_size, dim, device, seed=0):
+    # correlated pairs, so positives score above negatives as in a partially trained model
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.randn(batch_size, dim, generator=generator)
+    text = image + torch.randn(batch_size, dim, generator=generator)
+    return image.to(device), text.to(device)
+
+
+def step(loss_fn, image, text, logit_scale, logit_bias):
+    image = image.clone().requires_grad_()
+    text = text.clone().requires_grad_()
+    loss = loss_fn(image, text, None, logit_scale, logit_bias)
+    loss.backward()
+    return loss.detach(), torch.cat([image.grad, text.grad]).flatten()
+
+
+def run(args, variant, batch_size, image, text, logit_scale, logit_bias, num_negatives=None, dense=None):
+    loss_fn = SigLipLoss(block_size=args.block_size if variant == 'blockwise' else None,
+                         num_negatives=num_negatives, negative_sampling=variant.replace('sampled_', '') if num_negatives else 'random')
+    device = torch.device(args.device)
+    for _ in range(args.warmup):
+        step(loss_fn, image, text, logit_scale, logit_bias)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    times, losses, grads = [], [], []
+    for _ in range(args.steps):
+        start = time.perf_counter()
+        loss, grad = step(loss_fn, image, text, logit_scale, logit_bias)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+        losses.append(loss.item())
+        grads.append(grad)
+    result = {'variant': variant, 'batch_size': batch_size, 'num_negatives': num_negatives,
+              'step_ms': 1000 * float(np.median(times)), 'loss': float(np.mean(losses)), 'loss_std': float(np.std(losses))}
+    if device.type == 'cuda':
+        result['peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+    if dense is not None:
+        # bias of the averaged estimate, and how well a single step's gradient points the dense way
+        result['loss_bias'] = result['loss'] - dense['loss']
+        result['grad_cosine'] = float(np.mean([F.cosine_similarity(g, dense['grad'], dim=0).item() for g in grads]))
+    elif variant == 'dense':
+        result['grad'] = grads[0]
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the dense, blockwise and sampled SigLip losses")
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--num_negatives', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--block_size', type=int, default=1024)
+    parser.add_argument('--logit_scale', type=float, default=10.0)
+    parser.add_argument('--logit_bias', type=float, default=-10.0)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--skip_dense_above', type=int, default=65536, help='Batch sizes whose N x N logits would not fit')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(log_file=None, level=logging.INFO)
+    logit_scale = torch.tensor(args.logit_scale, device=args.device)
+    logit_bias = torch.tensor(args.logit_bias, device=args.device)
+    results = []
+    for batch_size in args.batch_size:
+        image, text = make_features(batch_size, args.dim, args.device)
+        dense = None
+        if batch_size <= args.skip_dense_above:
+            dense = run(args, 'dense', batch_size, image, text, logit_scale, logit_bias)
+            results.append(dense)
+            results.append(run(args, 'blockwise', batch_size, image, text, logit_scale, logit_bias, dense=dense))
+        for num_negatives in args.num_negatives:
+            for variant in ('sampled_random', 'sampled_hard'):
+                results.append(run(args, variant, batch_size, image, text, logit_scale, logit_bias, num_negatives, dense))
+        if dense is not None:
+            del dense['grad']
+
+    lines = [f"{'variant':<16}{'batch':>8}{'k':>6}{'step ms':>10}{'peak MB':>10}{'loss':>10}{'loss std':>10}{'bias':>10}{'grad cos':>10}"]
+    for r in results:
+        lines.append(f"{r['variant']:<16}{r['batch_size']:>8}{r['num_negatives'] or '-':>6}{r['step_ms']:>10.2f}{r.get('peak_memory_mb', float('nan')):>10.1f}"
+                     f"{r['loss']:>10.5f}{r['loss_std']:>10.5f}{r.get('loss_bias', float('nan')):>10.5f}{r.get('grad_cosine', float('nan')):>10.3f}")
+    logging.info("SigLip loss benchmark:\n" + "\n".join(lines))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k != 'output'}, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from .embedding_data import VLEmbeddingDataset, custom_collate_fn
+from .embedding_data import VLEmbeddingDataset, StreamingVLEmbeddingDataset, BatchIndexSampler, DeviceEmbeddingLoader
 from torch.utils.data.distributed import DistributedSampler
 from dataclasses import dataclass
 from multiprocessing import Value
@@ -24,7 +24,7 @@ class DataInfo:
     def set_epoch(self, epoch):
         if self.shared_epoch is not None:
             self.shared_epoch.set_value(epoch)
-        if self.sampler is not None and isinstance(self.sampler, DistributedSampler):
+        if self.sampler is not None and hasattr(self.sampler, 'set_epoch'):
             self.sampler.set_epoch(epoch)
 
 def get_embedding_dataset(
@@ -35,27 +35,55 @@ def get_embedding_dataset(
         batch_size,
         train_num_samples = None,
         is_train = True,
-        distributed=False
+        distributed=False,
+        seed=0,
+        rank=0,
+        world_size=1,
+        device=None,
+        load_workers=8,
+        load_backend="thread",
+        image_agg_mode=None,
     ):
     assert text_embedding_list and image_embedding_list, "Please provide text_embedding_list and image_embedding_list"
     dataset = VLEmbeddingDataset(
         text_embedding_list,
         image_embedding_list,
         extra_text_embedding_list,
-        train_num_samples
+        train_num_samples,
+        load_workers=load_workers,
+        load_backend=load_backend,
+        image_agg_mode=image_agg_mode,
     )
     num_samples = len(dataset)
-    sampler = DistributedSampler(dataset) if distributed and is_train else None
-    shuffle = is_train and sampler is None
+    if device is not None:
+        # the whole set lives on `device`; batches are drawn there without a DataLoader
+        dataloader = DeviceEmbeddingLoader(
+            dataset,
+            batch_size,
+            device,
+            seed=seed,
+            rank=rank if distributed else 0,
+            world_size=world_size if distributed else 1,
+            drop_last=is_train,
+        )
+        return DataInfo(dataloader, dataloader, data_info={'num_samples': num_samples, 'visual_dim': dataset.visual_dim, 'text_dim': dataset.text_dim})
+
+    # batches are gathered in one index_select, so the loader itself does no batching or collation
+    sampler = BatchIndexSampler(
+        num_samples,
+        batch_size,
+        shuffle=is_train,
+        drop_last=is_train,
+        seed=seed,
+        rank=rank if distributed and is_train else 0,
+        world_size=world_size if distributed and is_train else 1,
+    )
     dataloader = DataLoader(
         dataset,
-        batch_size=batch_size,
-        collate_fn=custom_collate_fn,
-        shuffle=shuffle,
+        batch_size=None,
+        sampler=sampler,
         num_workers=workers,
         pin_memory=True,
-        sampler=sampler,
-        drop_last=is_train,
     )
     dataloader.num_samples = num_samples
     dataloader.num_batches = len(dataloader)
@@ -63,9 +91,65 @@ def get_embedding_dataset(
 
     return DataInfo(dataloader, sampler, data_info={'num_samples': num_samples, 'visual_dim': dataset.visual_dim, 'text_dim': dataset.text_dim})
 
+def get_streaming_embedding_dataset(
+        text_embedding_list,
+        image_embedding_list,
+        extra_text_embedding_list,
+        workers,
+        batch_size,
+        shuffle_buffer,
+        seed=0,
+        epoch=0,
+        rank=0,
+        world_size=1,
+        image_agg_mode=None,
+    ):
+    assert text_embedding_list and image_embedding_list, "Please provide text_embedding_list and image_embedding_list"
+    shared_epoch = SharedEpoch(epoch=epoch)
+    dataset = StreamingVLEmbeddingDataset(
+        text_embedding_list,
+        image_embedding_list,
+        extra_text_embedding_list,
+        batch_size=batch_size,
+        shuffle_buffer=shuffle_buffer,
+        seed=seed,
+        shared_epoch=shared_epoch,
+        rank=rank,
+        world_size=world_size,
+        image_agg_mode=image_agg_mode,
+    )
+    # the dataset yields whole batches, so the loader does no batching of its own
+    dataloader = DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=workers,
+        pin_memory=True,
+        persistent_workers=workers > 0,
+    )
+    dataloader.num_samples = dataset.text_num
+    dataloader.num_batches = len(dataset)
+
+    return DataInfo(dataloader, shared_epoch=shared_epoch, data_info={'num_samples': dataset.text_num, 'visual_dim': dataset.visual_dim, 'text_dim': dataset.text_dim})
+
 def get_data(args, epoch=0):
     data = {}
-    if args.text_embedding_list and args.image_embedding_list:
+    if args.dataset_type == "embedding-stream":
+        assert not args.data_on_device, "--data-on-device is not supported with --dataset-type embedding-stream"
+        assert args.train_num_samples is None, "--train-num-samples is not supported with --dataset-type embedding-stream"
+        data['train'] = get_streaming_embedding_dataset(
+            args.text_embedding_list,
+            args.image_embedding_list,
+            args.extra_text_embedding_list,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            shuffle_buffer=args.stream_shuffle_buffer,
+            seed=args.seed,
+            epoch=epoch,
+            rank=args.rank,
+            world_size=args.world_size,
+            image_agg_mode=args.image_agg_mode,
+        )
+    elif args.text_embedding_list and args.image_embedding_list:
         data['train'] = get_embedding_dataset(
             args.text_embedding_list,
             args.image_embedding_list,
@@ -74,7 +158,14 @@ def get_data(args, epoch=0):
             batch_size=args.batch_size,
             train_num_samples=args.train_num_samples,
             is_train=True,
-            distributed=args.distributed
+            distributed=args.distributed,
+            seed=args.seed,
+            rank=args.rank,
+            world_size=args.world_size,
+            device=args.device if args.data_on_device else None,
+            load_workers=args.load_workers,
+            load_backend=args.load_backend,
+            image_agg_mode=args.image_agg_mode,
         )
     else:
         raise ValueError(f"Unknown dataset type: {args.dataset_type}")
@@ -88,7 +179,10 @@ def get_data(args, epoch=0):
             batch_size=args.batch_size,
             train_num_samples = None,
             is_train=False,
-            distributed=args.distributed
+            distributed=args.distributed,
+            load_workers=args.load_workers,
+            load_backend=args.load_backend,
+            image_agg_mode=args.image_agg_mode,
         )
 
     return data
@@ -0,0 +1,142 @@
+from typing import List, Optional, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers.image_processing_base import BatchFeature
+
+from .pixel_cache import crop_offset, processor_spec, resize_center_crop, normalize_pixels
+
+
+class BatchedImageProcessor:
+    """
+    Drop-in replacement for CustomImageProcessor and the HF resize + center-crop processors
+    (dinov2, aimv2, clip, ...) that works on uint8 tensors and normalizes a whole batch at once.
+
+    backend='pil' resizes each image with PIL like the original processors and centers the crop
+    with their offset rounding (floor for HF, round for torchvision), so outputs match them up to
+    float rounding; backend='tensor' resizes with antialiased torch interpolation on `device`,
+    batched over images of equal size, within a few 1/255 steps at high-contrast edges. Dataset
+    workers hand over `worker_pixels` per image and leave the rest to the collate function, or,
+    when resizing on a GPU, to `__call__` in the main process.
+    """
+
+    def __init__(self, resize: int, crop: int, mean, std, interpolation: str = "bicubic", backend: str = "pil",
+                 device: Union[str, torch.device] = "cpu", rounding: str = "round"):
+        assert backend in ("pil", "tensor"), f"Unknown backend {backend}"
+        self.resize, self.crop, self.interpolation, self.rounding = resize, crop, interpolation, rounding
+        self.mean, self.std = tuple(mean), tuple(std)
+        self.backend = backend
+        self.device = torch.device(device)
+
+    @classmethod
+    def from_processor(cls, image_processor, **kwargs) -> Optional["BatchedImageProcessor"]:
+        """None if `image_processor` is not a plain resize + center crop + normalize pipeline."""
+        spec = processor_spec(image_processor)
+        if spec is None:
+            return None
+        return cls(spec["resize"], spec["crop"], spec["mean"], spec["std"], spec["interpolation"], rounding=spec["rounding"], **kwargs)
+
+    def to_uint8(self, image: Union[Image.Image, torch.Tensor]) -> torch.Tensor:
+        """[crop, crop, 3] uint8 crop of one PIL image or [H, W, 3] uint8 tensor."""
+        if self.backend == "pil":
+            if isinstance(image, torch.Tensor):
+                image = Image.fromarray(image.cpu().numpy())
+            return torch.from_numpy(resize_center_crop(image, self.resize, self.crop, self.interpolation, self.rounding))
+        return self._resize_crop_tensor([self._as_tensor(image)])[0]
+
+    @property
+    def resizes_on_device(self) -> bool:
+        return self.backend == "tensor" and self.device.type != "cpu"
+
+    def worker_pixels(self, image: Union[Image.Image, torch.Tensor]) -> torch.Tensor:
+        """
+        What a DataLoader worker hands over for one image: its uint8 crop, or with
+        `resizes_on_device` the whole uint8 [H, W, 3] image, resized per batch on the GPU by `__call__`.
+        """
+        if self.resizes_on_device:
+            return self._as_tensor(image)
+        return self.to_uint8(image)
+
+    def normalize(self, pixels: torch.Tensor) -> torch.Tensor:
+        """[B, crop, crop, 3] uint8 to normalized [B, 3, crop, crop] float."""
+        return normalize_pixels(pixels.to(self.device, non_blocking=True), self.mean, self.std)
+
+    def _as_tensor(self, image: Union[Image.Image, torch.Tensor]) -> torch.Tensor:
+        if isinstance(image, torch.Tensor):
+            return image
+        return torch.from_numpy(np.asarray(image.convert("RGB"), dtype=np.uint8))
+
+    def _output_size(self, height: int, width: int):
+        if width <= height:
+            return int(self.resize * height / width), self.resize
+        return self.resize, int(self.resize * width / height)
+
+    def _resize_crop_tensor(self, images: List[torch.Tensor]) -> torch.Tensor:
+        crops = [None] * len(images)
+        by_size = {}
+        for i, image in enumerate(images):
+            by_size.setdefault(tuple(image.shape[:2]), []).append(i)
+        for (height, width), indices in by_size.items():
+            batch = torch.stack([images[i] for i in indices]).to(self.device, non_blocking=True)
+            batch = batch.permute(0, 3, 1, 2).float()
+            new_height, new_width = self._output_size(height, width)
+            if (new_height, new_width) != (height, width):
+                batch = F.interpolate(batch, size=(new_height, new_width), mode=self.interpolation, align_corners=False, antialias=True)
+            top, left = crop_offset(new_height, self.crop, self.rounding), crop_offset(new_width, self.crop, self.rounding)
+            batch = batch[:, :, top:top + self.crop, left:left + self.crop].round_().clamp_(0, 255).to(torch.uint8)
+            for i, crop in zip(indices, batch.permute(0, 2, 3, 1)):
+                crops[i] = crop
+        return torch.stack(crops)
+
+    def __call__(self, images, return_tensors=None):
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        if self.backend == "pil":
+            pixels = torch.stack([self.to_uint8(image) for image in images])
+        else:
+            pixels = self._resize_crop_tensor([self._as_tensor(image) for image in images])
+        return BatchFeature(data={"pixel_values": self.normalize(pixels)}, tensor_type="pt")
+
+
+if __name__ == "__main__":
+    # Parity check against the processors used for encoding, fails if a backend is off by more than its tolerance:
+    #   python -m data.batched_processor --images path/to/a.jpg path/to/b.jpg
+    import argparse
+    from transformers import AutoImageProcessor
+    from model.vision_model import CustomImageProcessor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=str, nargs="+", required=True)
+    parser.add_argument("--models", type=str, nargs="+",
+                        default=["facebook/dinov2-large", "apple/aimv2-large-patch14-224", "openai/clip-vit-large-patch14", "custom"],
+                        help="HF model names; 'custom' is the CustomImageProcessor of the local ibot/mae/ijepa/dinov1 models")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device of the tensor backend")
+    parser.add_argument("--pil_tolerance", type=float, default=0.5, help="Max abs difference of the pil backend, in uint8 steps")
+    parser.add_argument("--tensor_tolerance", type=float, default=16, help="Max abs difference of the tensor backend, in uint8 steps")
+    parser.add_argument("--tensor_mean_tolerance", type=float, default=1, help="Mean abs difference of the tensor backend, in uint8 steps")
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    failures = []
+    for name in args.models:
+        reference_processor = CustomImageProcessor() if name == "custom" else AutoImageProcessor.from_pretrained(name, trust_remote_code=True)
+        reference = reference_processor(images, return_tensors="pt")
+        reference = reference if isinstance(reference, torch.Tensor) else reference["pixel_values"]
+        for backend in ("pil", "tensor"):
+            processor = BatchedImageProcessor.from_processor(reference_processor, backend=backend, device=args.device if backend == "tensor" else "cpu")
+            if processor is None:
+                print(f"{name}: not a resize + center crop processor, skipped")
+                break
+            diff = (processor(images)["pixel_values"].cpu() - reference).abs()
+            # one uint8 step after normalization is 1 / (255 * std)
+            step = 1 / (255 * min(processor.std))
+            max_steps, mean_steps = (diff.max() / step).item(), (diff.mean() / step).item()
+            print(f"{name} [{backend}]: max abs diff {diff.max():.5f} ({max_steps:.2f} uint8 steps), mean {diff.mean():.6f} ({mean_steps:.3f} steps)")
+            if backend == "pil" and max_steps > args.pil_tolerance:
+                failures.append(f"{name} [pil]: {max_steps:.2f} > {args.pil_tolerance} steps")
+            if backend == "tensor" and (max_steps > args.tensor_tolerance or mean_steps > args.tensor_mean_tolerance):
+                failures.append(f"{name} [tensor]: max {max_steps:.2f} / mean {mean_steps:.3f} steps, tolerance {args.tensor_tolerance} / {args.tensor_mean_tolerance}")
+    assert not failures, "Preprocessing differs from the reference processors:\n  " + "\n  ".join(failures)
+    print("All backends within tolerance")
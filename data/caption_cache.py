@@ -0,0 +1,170 @@
+import os
+import glob
+import json
+import time
+import socket
+import hashlib
+import logging
+from typing import Callable, List, Sequence
+
+import numpy as np
+import torch
+
+# A cache directory holds the fp16 embeddings of one text model:
+#   <cache_dir>/cache.json            model name and embedding dim
+#   <cache_dir>/<segment>.bin         [rows, dim] fp16 embeddings, appended by one flush
+#   <cache_dir>/<segment>.keys.npy    [rows, 2] uint64 caption hashes, written last
+# Keys hash the normalized model input, which already carries the instruction prefix.
+CACHE_CONFIG_FILE = "cache.json"
+
+
+def normalize_caption(text: str) -> str:
+    return " ".join(str(text).split())
+
+
+def caption_keys(sentences: Sequence[str]) -> np.ndarray:
+    keys = np.empty((len(sentences), 2), dtype=np.uint64)
+    for i, sentence in enumerate(sentences):
+        digest = hashlib.blake2b(normalize_caption(sentence).encode("utf-8"), digest_size=16).digest()
+        keys[i] = np.frombuffer(digest, dtype=np.uint64)
+    return keys
+
+
+class CaptionEmbeddingCache:
+    """
+    Persistent content-addressed cache of caption embeddings.
+
+    Each flush writes a new immutable segment, so several encode.py workers can share one
+    cache directory; segments written by other processes become visible on the next open.
+    Lookups binary-search the first 64 bits of the 128-bit key and verify the rest.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, flush_rows: int = 65536):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.flush_rows = flush_rows
+        os.makedirs(cache_dir, exist_ok=True)
+        config_path = os.path.join(cache_dir, CACHE_CONFIG_FILE)
+        self.dim = None
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                config = json.load(f)
+            assert config["model"] == model_name, f"Cache {cache_dir} belongs to {config['model']}, not {model_name}"
+            self.dim = config["dim"]
+
+        self.segments = []
+        hi, lo, where = [], [], []
+        for keys_path in sorted(glob.glob(os.path.join(cache_dir, "*.keys.npy"))):
+            keys = np.load(keys_path)
+            self.segments.append(self._open_values(keys_path[: -len(".keys.npy")] + ".bin", len(keys)))
+            hi.append(keys[:, 0])
+            lo.append(keys[:, 1])
+            where.append(np.stack([np.full(len(keys), len(self.segments) - 1), np.arange(len(keys))], axis=1))
+        if hi:
+            hi, lo, where = np.concatenate(hi), np.concatenate(lo), np.concatenate(where)
+            order = np.argsort(hi, kind="stable")
+            self._hi, self._lo, self._where = hi[order], lo[order], where[order]
+        else:
+            self._hi = self._lo = np.empty(0, dtype=np.uint64)
+            self._where = np.empty((0, 2), dtype=np.int64)
+        # entries flushed by this process, not yet in the sorted index
+        self._recent = {}
+        self._pending_keys, self._pending_values = [], []
+        self._segment_counter = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.encode_time = 0.0
+        logging.info(f"Opened caption cache {cache_dir} with {len(self._hi)} entries in {len(self.segments)} segments")
+
+    def __len__(self):
+        return len(self._hi) + len(self._recent)
+
+    def _open_values(self, path: str, rows: int) -> np.ndarray:
+        return np.memmap(path, dtype=np.float16, mode="r", shape=(rows, self.dim))
+
+    def lookup(self, keys: np.ndarray):
+        """Return (hit mask, fp16 rows of the hits) for [n, 2] uint64 keys."""
+        hit = np.zeros(len(keys), dtype=bool)
+        where = np.zeros((len(keys), 2), dtype=np.int64)
+        if len(self._hi):
+            pos = np.minimum(np.searchsorted(self._hi, keys[:, 0]), len(self._hi) - 1)
+            hit = (self._hi[pos] == keys[:, 0]) & (self._lo[pos] == keys[:, 1])
+            where[hit] = self._where[pos[hit]]
+        for i in np.flatnonzero(~hit):
+            location = self._recent.get((int(keys[i, 0]), int(keys[i, 1])))
+            if location is not None:
+                hit[i], where[i] = True, location
+        where = where[hit]
+        rows = np.empty((len(where), self.dim or 0), dtype=np.float16)
+        for segment in np.unique(where[:, 0]):
+            in_segment = where[:, 0] == segment
+            rows[in_segment] = self.segments[segment][where[in_segment, 1]]
+        return hit, torch.from_numpy(rows)
+
+    def add(self, keys: np.ndarray, embeddings: torch.Tensor):
+        if self.dim is None:
+            self.dim = embeddings.shape[-1]
+            with open(os.path.join(self.cache_dir, CACHE_CONFIG_FILE), "w") as f:
+                json.dump({"model": self.model_name, "dim": self.dim}, f)
+        self._pending_keys.append(keys)
+        self._pending_values.append(embeddings.detach().to("cpu", torch.float16).numpy())
+        if sum(len(k) for k in self._pending_keys) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_keys:
+            return
+        keys, values = np.concatenate(self._pending_keys), np.concatenate(self._pending_values)
+        self._pending_keys, self._pending_values = [], []
+        name = os.path.join(self.cache_dir, f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}-{self._segment_counter}")
+        self._segment_counter += 1
+        values.tofile(name + ".bin")
+        # np.save appends .npy, so the tmp file is renamed into place only once complete
+        np.save(name + ".keys.tmp.npy", keys)
+        os.replace(name + ".keys.tmp.npy", name + ".keys.npy")
+        self.segments.append(self._open_values(name + ".bin", len(keys)))
+        segment = len(self.segments) - 1
+        for row, (hi, lo) in enumerate(keys.tolist()):
+            self._recent[(hi, lo)] = (segment, row)
+
+    def cached(self, encode_function: Callable[[List[str]], torch.Tensor], device="cuda") -> Callable[[List[str]], torch.Tensor]:
+        """
+        Wrap an encode function: cache hits are served from disk, duplicate captions within a
+        call are encoded once, and only the remaining misses reach the model.
+        """
+        def encode(sentences: List[str]) -> torch.Tensor:
+            keys = caption_keys(sentences)
+            unique_keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            hit, hit_rows = self.lookup(unique_keys)
+            miss = np.flatnonzero(~hit)
+            self.hits += len(sentences) - len(miss)
+            self.misses += len(miss)
+
+            unique_embeddings = None
+            if len(miss):
+                start_time = time.time()
+                miss_embeddings = encode_function([sentences[first[i]] for i in miss])
+                if miss_embeddings.is_cuda:
+                    torch.cuda.synchronize()
+                self.encode_time += time.time() - start_time
+                unique_embeddings = miss_embeddings.new_empty((len(unique_keys), miss_embeddings.shape[-1]))
+                unique_embeddings[torch.from_numpy(miss).to(miss_embeddings.device)] = miss_embeddings
+                self.add(unique_keys[miss], miss_embeddings)
+            if hit.any():
+                hit_rows = hit_rows.to(device if unique_embeddings is None else unique_embeddings.device, non_blocking=True)
+                if unique_embeddings is None:
+                    unique_embeddings = hit_rows.new_empty((len(unique_keys), hit_rows.shape[-1]))
+                unique_embeddings[torch.from_numpy(np.flatnonzero(hit)).to(hit_rows.device)] = hit_rows.to(unique_embeddings.dtype)
+            return unique_embeddings[torch.from_numpy(inverse).to(unique_embeddings.device)]
+
+        return encode
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return
+        per_caption = self.encode_time / max(self.misses, 1)
+        logging.info(f"Caption cache: {self.hits}/{total} hits ({100 * self.hits / total:.1f}%), "
+                     f"~{self.hits * per_caption:.1f} seconds of encoding saved, {len(self)} entries")
@@ -1,11 +1,13 @@
 import torch
-from torch.utils.data import Dataset, DataLoader
-import os
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
+import math
+import random
+import itertools
+import logging
 from tqdm import tqdm
-import glob
-from natsort import natsorted
-from torch.nn.utils.rnn import pad_sequence
 import numpy as np
+from .embedding_store import EmbeddingMatrix, ShardedEmbeddingReader, agg_columns, cat_rows, has_store, list_shards, load_shards_parallel, open_store, select_columns
+from .manifest import check_alignment, check_concat_layout
 
 def custom_collate_fn(batch):
     if len(batch[0]) == 3:
@@ -14,27 +16,99 @@ def custom_collate_fn(batch):
         text_vectors, image_vectors = zip(*batch)
         extra_text_vectors = None
 
-    text_vectors = pad_sequence(text_vectors, batch_first=True, padding_value=0)
-    image_vectors = pad_sequence(image_vectors, batch_first=True, padding_value=0)
+    # embeddings are fixed-size 1-d vectors, so there is nothing to pad
+    text_vectors = torch.stack(text_vectors)
+    image_vectors = torch.stack(image_vectors)
     
     if extra_text_vectors:
-        extra_text_vectors = pad_sequence(extra_text_vectors, batch_first=True, padding_value=0)
+        extra_text_vectors = torch.stack(extra_text_vectors)
         return text_vectors, image_vectors, extra_text_vectors
     else:
         return text_vectors, image_vectors
 
-def load_vectors(embedding_list: list[str]) -> list[torch.Tensor]:
-    files = []
+
+class BatchIndexSampler(Sampler):
+    """
+    Yields whole batches of indices as LongTensors, so the dataset can gather a batch with a
+    single index_select instead of one __getitem__ call per sample.
+
+    Shuffling and rank partitioning follow DistributedSampler: the permutation is seeded by
+    seed + epoch and every rank takes a strided slice of the same permutation.
+    """
+
+    def __init__(self, num_samples, batch_size, shuffle=True, drop_last=True, seed=0, rank=0, world_size=1, device='cpu'):
+        self.num_samples = num_samples
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        if drop_last:
+            self.samples_per_rank = num_samples // world_size
+        else:
+            self.samples_per_rank = math.ceil(num_samples / world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def rank_indices(self):
+        if self.shuffle:
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_samples, generator=generator, device=self.device)
+        else:
+            indices = torch.arange(self.num_samples, device=self.device)
+        total_size = self.samples_per_rank * self.world_size
+        if total_size > self.num_samples:
+            # pad by wrapping around so every rank gets the same number of samples
+            indices = torch.cat([indices, indices[:total_size - self.num_samples]])
+        return indices[:total_size][self.rank::self.world_size]
+
+    def __iter__(self):
+        for batch in self.rank_indices().split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.samples_per_rank // self.batch_size
+        return math.ceil(self.samples_per_rank / self.batch_size)
+
+def load_vectors(embedding_list: list[str], load_workers: int = 8, load_backend: str = "thread", agg_mode: str = None) -> EmbeddingMatrix:
+    """Load embedding directories; `agg_mode` selects the cls/patch columns of concat-encoded images."""
+    if agg_mode is not None and agg_mode != 'concat':
+        check_concat_layout(embedding_list)
+    else:
+        agg_mode = None
+    parts = []
     for dir_path in embedding_list:
-        files.extend(natsorted(glob.glob(os.path.join(dir_path, "*.pt"))))
-    vectors = []
-    for file in tqdm(files, desc="Loading embedding data", unit="file"):
-        vectors.extend(torch.load(file, weights_only=True).to(torch.float16))
-    return vectors
+        if has_store(dir_path):
+            # packed store: O(1) startup, rows are paged in on first touch
+            logging.info(f"Memory-mapping packed embedding store in {dir_path}")
+            store = open_store(dir_path)
+            parts.append(select_columns(store, agg_columns(agg_mode, store.shape[1])) if agg_mode else store)
+            continue
+        shards = list_shards(dir_path)
+        assert shards, f"No embedding shards found in {dir_path}"
+        # int8 shards stay quantized until they reach the training device
+        vectors = load_shards_parallel(shards, num_workers=load_workers, backend=load_backend)
+        if agg_mode:
+            # copy the selected half so the full matrix can be freed
+            vectors = select_columns(vectors, agg_columns(agg_mode, vectors.shape[1])).clone()
+        parts.append(vectors)
+    return EmbeddingMatrix(parts)
 
 class VLEmbeddingDataset(Dataset):
-    def __init__(self, text_embedding_list, image_embedding_list, extra_text_embedding_list=None, train_num_samples=None):
+    def __init__(self, text_embedding_list, image_embedding_list, extra_text_embedding_list=None, train_num_samples=None, load_workers=8, load_backend="thread", image_agg_mode=None):
 
+        # manifests let mis-paired directories fail before minutes of shard loading
+        check_alignment(text_embedding_list, image_embedding_list, extra_text_embedding_list)
+        self.load_kwargs = {'load_workers': load_workers, 'load_backend': load_backend}
+        self.image_agg_mode = image_agg_mode
         self.text_vectors, self.image_vectors = self._load_image_text_vectors(image_embedding_list, text_embedding_list)
         n_img, n_txt = len(self.image_vectors), len(self.text_vectors)
         assert n_img > 0 and n_txt > 0 and n_txt % n_img == 0, f"text vectors length ({n_txt}) is not a multiple of image vectors length ({n_img})"
@@ -44,29 +118,28 @@ class VLEmbeddingDataset(Dataset):
             self.extra_text_vectors, _ = self._load_image_text_vectors(text_embedding_list = extra_text_embedding_list)
             assert len(self.extra_text_vectors) == len(self.text_vectors), f"extra text vectors length {len(self.extra_text_vectors)} is not equal to text vectors length {len(self.text_vectors)}"
     
+        # subset of text rows used for training; images are always paired by modulo indexing
+        self.sample_indices = None
         if train_num_samples is not None:
             num_samples = len(self.text_vectors)
             random_indices = np.random.choice(num_samples, train_num_samples, replace=False)
-            self.text_vectors = [self.text_vectors[i] for i in random_indices]
-            self.image_vectors = [self.image_vectors[i] for i in random_indices]
-            if extra_text_embedding_list:
-                self.extra_text_vectors = [self.extra_text_vectors[i] for i in random_indices]
+            self.sample_indices = torch.from_numpy(random_indices).long()
             print(f"Random Selecting {train_num_samples} samples as training data")
 
         self.image_num = len(self.image_vectors)
-        self.text_num = len(self.text_vectors)
+        self.text_num = len(self.text_vectors) if self.sample_indices is None else len(self.sample_indices)
 
-        self.visual_dim = self.image_vectors[0].shape[-1]
-        self.text_dim = self.text_vectors[0].shape[-1]
+        self.visual_dim = self.image_vectors.dim
+        self.text_dim = self.text_vectors.dim
         
     def _load_image_text_vectors(self, image_embedding_list = None, text_embedding_list = None):
         assert image_embedding_list is not None or text_embedding_list is not None, "Either image_embedding_list or text_embedding_list must be provided"
         if image_embedding_list is not None:
-            image_vectors = load_vectors(image_embedding_list)
+            image_vectors = load_vectors(image_embedding_list, agg_mode=self.image_agg_mode, **self.load_kwargs)
         else:
             image_vectors = []
         if text_embedding_list is not None:
-            text_vectors = load_vectors(text_embedding_list)
+            text_vectors = load_vectors(text_embedding_list, **self.load_kwargs)
         else:
             text_vectors = []
         return text_vectors, image_vectors
@@ -74,18 +147,237 @@ class VLEmbeddingDataset(Dataset):
     def __len__(self):
         return self.text_num
     
+    def get_batch(self, indices: torch.Tensor):
+        """Gather a whole batch of rows with one index_select per matrix."""
+        if self.sample_indices is not None:
+            indices = self.sample_indices[indices]
+        img_indices = indices % self.image_num
+
+        if hasattr(self, 'extra_text_vectors'):
+            return self.text_vectors.take(indices), self.image_vectors.take(img_indices), self.extra_text_vectors.take(indices)
+        else:
+            return self.text_vectors.take(indices), self.image_vectors.take(img_indices)
+
     def __getitem__(self, idx):
+        if isinstance(idx, torch.Tensor) and idx.dim() > 0:
+            return self.get_batch(idx)
+        if self.sample_indices is not None:
+            idx = int(self.sample_indices[idx])
         # multiple text for one image
-        if idx >= self.image_num:
-            img_idx = idx % self.image_num
-        else:
-            img_idx = idx
+        img_idx = idx % self.image_num
         
         if hasattr(self, 'extra_text_vectors'):
             return self.text_vectors[idx], self.image_vectors[img_idx], self.extra_text_vectors[idx]
         else:
             return self.text_vectors[idx], self.image_vectors[img_idx]
 
+class DeviceEmbeddingLoader:
+    """
+    DataLoader replacement that keeps the whole training set resident on `device`.
+
+    The embedding matrices are copied to the device once; every epoch draws an on-device
+    permutation (partitioned across ranks like DistributedSampler) and batches are plain
+    index_selects into the resident tensors, with no workers and no host-to-device copies.
+    """
+
+    def __init__(self, dataset: VLEmbeddingDataset, batch_size, device, seed=0, rank=0, world_size=1, drop_last=True):
+        self.device = torch.device(device)
+        logging.info(f"Moving {len(dataset)} training samples to {self.device}")
+        self.text_vectors = dataset.text_vectors.to_device(self.device)
+        self.image_vectors = dataset.image_vectors.to_device(self.device)
+        self.extra_text_vectors = None
+        if hasattr(dataset, 'extra_text_vectors'):
+            self.extra_text_vectors = dataset.extra_text_vectors.to_device(self.device)
+        self.sample_indices = None
+        if dataset.sample_indices is not None:
+            self.sample_indices = dataset.sample_indices.to(self.device)
+        self.image_num = dataset.image_num
+
+        self.sampler = BatchIndexSampler(
+            len(dataset),
+            batch_size,
+            shuffle=True,
+            drop_last=drop_last,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+            device=self.device,
+        )
+        self.num_samples = len(dataset)
+        self.num_batches = len(self.sampler)
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for indices in self.sampler:
+            if self.sample_indices is not None:
+                indices = self.sample_indices[indices]
+            img_indices = indices % self.image_num
+            texts = self.text_vectors.index_select(0, indices)
+            images = self.image_vectors.index_select(0, img_indices)
+            if self.extra_text_vectors is not None:
+                yield texts, images, self.extra_text_vectors.index_select(0, indices)
+            else:
+                yield texts, images
+
+
+class StreamingVLEmbeddingDataset(IterableDataset):
+    """
+    Streams (text, image[, extra_text]) batches shard by shard, so host memory stays flat
+    however many embedding directories are listed.
+
+    Text shards are the unit of work: their order is reshuffled every epoch, split across
+    ranks and dataloader workers by row count, and the rows pass through a bounded shuffle
+    buffer. Text row i is paired with image row i % n_img, as in VLEmbeddingDataset.
+
+    With drop_last or more than one rank, every rank yields exactly
+    text_num // (batch_size * world_size) full batches, so DDP and the SigLip ring stay in step.
+    """
+
+    def __init__(
+        self,
+        text_embedding_list,
+        image_embedding_list,
+        extra_text_embedding_list=None,
+        batch_size=64,
+        shuffle_buffer=131072,
+        seed=0,
+        shared_epoch=None,
+        rank=0,
+        world_size=1,
+        drop_last=True,
+        image_agg_mode=None,
+    ):
+        check_alignment(text_embedding_list, image_embedding_list, extra_text_embedding_list)
+        if image_agg_mode == 'concat':
+            image_agg_mode = None
+        elif image_agg_mode is not None:
+            check_concat_layout(image_embedding_list)
+        self.text_reader = ShardedEmbeddingReader(text_embedding_list)
+        self.image_reader = ShardedEmbeddingReader(image_embedding_list, agg_mode=image_agg_mode)
+        n_img, n_txt = len(self.image_reader), len(self.text_reader)
+        assert n_img > 0 and n_txt > 0 and n_txt % n_img == 0, f"text vectors length ({n_txt}) is not a multiple of image vectors length ({n_img})"
+
+        self.extra_text_reader = None
+        if extra_text_embedding_list:
+            self.extra_text_reader = ShardedEmbeddingReader(extra_text_embedding_list)
+            assert len(self.extra_text_reader) == n_txt, f"extra text vectors length {len(self.extra_text_reader)} is not equal to text vectors length {n_txt}"
+
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.shared_epoch = shared_epoch
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+
+        self.image_num = n_img
+        self.text_num = n_txt
+        self.visual_dim = self.image_reader.dim
+        self.text_dim = self.text_reader.dim
+        assert len(self.text_reader.shard_ranges) >= world_size, f"Need at least {world_size} text shards to split across ranks, got {len(self.text_reader.shard_ranges)}"
+
+    def _capped(self):
+        # every rank must yield the same number of equally sized batches, or collectives hang
+        return self.drop_last or self.world_size > 1
+
+    def __len__(self):
+        # number of batches this rank yields per epoch
+        if self._capped():
+            return self.text_num // (self.batch_size * self.world_size)
+        return math.ceil(self.text_num / self.batch_size)
+
+    def _worker_num_batches(self, worker_id, num_workers):
+        num_batches, remainder = divmod(len(self), num_workers)
+        return num_batches + (1 if worker_id < remainder else 0)
+
+    def _assigned_shards(self, epoch):
+        shard_ids = list(range(len(self.text_reader.shard_ranges)))
+        random.Random(self.seed + epoch).shuffle(shard_ids)  # same order on every rank and worker
+        rank_shards = _balanced_split(shard_ids, self._shard_rows(), self.world_size)[self.rank]
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return rank_shards
+        worker_shards = _balanced_split(rank_shards, self._shard_rows(), worker_info.num_workers)[worker_info.id]
+        # more workers than shards: spare workers start elsewhere in the rank's shards
+        return worker_shards or rank_shards[worker_info.id % len(rank_shards):] + rank_shards[:worker_info.id % len(rank_shards)]
+
+    def _shard_rows(self):
+        return [end - start for start, end in self.text_reader.shard_ranges]
+
+    def _read_shard(self, shard_id):
+        start, end = self.text_reader.shard_ranges[shard_id]
+        rows = [self.text_reader.read(start, end), self.image_reader.read_modulo(start, end, self.image_num)]
+        if self.extra_text_reader is not None:
+            rows.append(self.extra_text_reader.read(start, end))
+        return rows
+
+    def __iter__(self):
+        epoch = self.shared_epoch.get_value() if self.shared_epoch is not None else 0
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch * 1000003 + self.rank * 1009 + worker_id)
+
+        capped = self._capped()
+        num_batches = self._worker_num_batches(worker_id, num_workers) if capped else None
+        shard_ids = self._assigned_shards(epoch)
+        if capped:
+            # balanced shards still differ by up to a shard's rows; wrap around to fill this worker's quota
+            shard_ids = itertools.cycle(shard_ids)
+        emitted = 0
+
+        buffer = None
+        for shard_id in shard_ids:
+            if capped and emitted >= num_batches:
+                return
+            rows = self._read_shard(shard_id)
+            buffer = rows if buffer is None else [cat_rows([b, r]) for b, r in zip(buffer, rows)]
+            if len(buffer[0]) < self.shuffle_buffer + self.batch_size:
+                continue
+            # shuffle once, emit every batch beyond the buffer budget, keep the (shuffled) rest
+            perm = torch.randperm(len(buffer[0]), generator=generator)
+            buffer = [b[perm] for b in buffer]
+            ready = (len(buffer[0]) - self.shuffle_buffer) // self.batch_size
+            if capped:
+                ready = min(ready, num_batches - emitted)
+            for i in range(ready):
+                # clone so each batch owns its storage instead of pinning the whole buffer
+                yield tuple(b[i * self.batch_size:(i + 1) * self.batch_size].clone() for b in buffer)
+            emitted += ready
+            buffer = [b[ready * self.batch_size:].clone() for b in buffer]
+            if capped and emitted >= num_batches:
+                return
+
+        if buffer is None:
+            return
+        perm = torch.randperm(len(buffer[0]), generator=generator)
+        buffer = [b[perm] for b in buffer]
+        for start in range(0, len(buffer[0]), self.batch_size):
+            batch = tuple(b[start:start + self.batch_size].clone() for b in buffer)
+            if self.drop_last and len(batch[0]) < self.batch_size:
+                break
+            yield batch
+
+
+def _balanced_split(shard_ids, shard_rows, parts):
+    """Deal shard_ids into `parts` lists of near-equal total rows (largest first to the lightest part), keeping their order within each part."""
+    loads = [0] * parts
+    assignment = {}
+    for shard_id in sorted(shard_ids, key=lambda i: -shard_rows[i]):
+        part = min(range(parts), key=lambda p: (loads[p], p))
+        assignment[shard_id] = part
+        loads[part] += shard_rows[shard_id]
+    split = [[] for _ in range(parts)]
+    for shard_id in shard_ids:
+        split[assignment[shard_id]].append(shard_id)
+    return split
+
 if __name__ == "__main__":
 
     text_embedding_dir = ['/home/mila/l/le.zhang/scratch/light_align/data/tensor_data/text_embedding/gte-large-en-v1.5/validation']
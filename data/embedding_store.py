@@ -0,0 +1,536 @@
+import os
+import glob
+import json
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from natsort import natsorted
+from tqdm import tqdm
+
+# A packed store lives next to the `{idx}.pt` shards written by encode.py:
+#   <embedding_dir>/embeddings.bin         contiguous row-major [num_rows, dim] matrix
+#   <embedding_dir>/embeddings.scales.bin  per-row fp32 scales, int8 stores only
+#   <embedding_dir>/embeddings.json        header (row count, dim, dtype and source shards)
+# Stores written in place by encode.py --direct_store have no source shards; their header
+# lists fixed ranges of STORE_RANGE_ROWS rows instead, the unit of work for streaming.
+STORE_DATA_FILE = "embeddings.bin"
+STORE_SCALES_FILE = "embeddings.scales.bin"
+STORE_HEADER_FILE = "embeddings.json"
+STORE_FORMAT = "sail-embedding-store"
+STORE_VERSION = 1
+STORE_RANGE_ROWS = 16384
+
+NUMPY_DTYPES = {
+    "float16": np.float16,
+    "float32": np.float32,
+    "int8": np.int8,
+}
+STORAGE_DTYPES = ["float16", "int8"]
+
+
+def quantize_rows(vectors: torch.Tensor):
+    """Symmetric int8 quantization with one fp32 scale per row."""
+    vectors = vectors.float()
+    scales = vectors.abs().amax(dim=-1).clamp(min=1e-12) / 127.0
+    values = torch.round(vectors / scales.unsqueeze(-1)).clamp(-127, 127).to(torch.int8)
+    return values, scales
+
+
+def dequantize_rows(values: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype = torch.float16) -> torch.Tensor:
+    return (values.float() * scales.unsqueeze(-1)).to(dtype)
+
+
+class QuantizedRows:
+    """
+    int8 embedding rows with one fp32 scale per row.
+
+    Indexing, gathering and pinning keep the rows quantized; `.to(device)` moves the int8
+    values and scales and dequantizes on the target device, so training loops can treat a
+    batch of QuantizedRows exactly like a tensor batch.
+    """
+
+    def __init__(self, values: torch.Tensor, scales: torch.Tensor):
+        self.values = values
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def device(self):
+        return self.values.device
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return QuantizedRows(self.values[idx], self.scales[idx])
+
+    def index_select(self, dim, index):
+        assert dim == 0, "QuantizedRows can only be gathered along rows"
+        index = index.to(self.values.device)
+        return QuantizedRows(self.values.index_select(0, index), self.scales.index_select(0, index))
+
+    def clone(self):
+        return QuantizedRows(self.values.clone(), self.scales.clone())
+
+    def select_columns(self, columns: slice):
+        # scales are per row, so a column slice keeps them unchanged
+        return QuantizedRows(self.values[:, columns], self.scales)
+
+    def share_memory_(self):
+        self.values.share_memory_()
+        self.scales.share_memory_()
+        return self
+
+    def pin_memory(self):
+        return QuantizedRows(self.values.pin_memory(), self.scales.pin_memory())
+
+    def quantized_to(self, device, non_blocking=False):
+        """Move the rows without dequantizing them."""
+        return QuantizedRows(
+            self.values.to(device, non_blocking=non_blocking),
+            self.scales.to(device, non_blocking=non_blocking),
+        )
+
+    def to(self, device=None, dtype=None, non_blocking=False):
+        if isinstance(device, torch.dtype):
+            device, dtype = None, device
+        rows = self.quantized_to(device, non_blocking=non_blocking) if device is not None else self
+        return dequantize_rows(rows.values, rows.scales, dtype or torch.float16)
+
+
+# Image embeddings encoded with agg_mode "concat" are [cls | patch-mean]; the other modes
+# are column views of it, so one encode serves all three.
+AGG_MODES = ["concat", "cls", "patch"]
+
+
+def agg_columns(agg_mode: str, dim: int) -> slice:
+    """Columns of a concat-encoded [N, dim] matrix that make up `agg_mode`."""
+    assert agg_mode in AGG_MODES, f"Invalid agg_mode: {agg_mode}"
+    assert dim % 2 == 0, f"A concat encoding has an even dim, got {dim}"
+    return {"concat": slice(0, dim), "cls": slice(0, dim // 2), "patch": slice(dim // 2, dim)}[agg_mode]
+
+
+def select_columns(rows: Union[torch.Tensor, "QuantizedRows"], columns: Optional[slice]):
+    """Column view of a matrix; memory-mapped parts stay mapped and only the view is read."""
+    if columns is None:
+        return rows
+    if isinstance(rows, QuantizedRows):
+        return rows.select_columns(columns)
+    return rows[:, columns]
+
+
+def cat_rows(chunks: Sequence[Union[torch.Tensor, QuantizedRows]]):
+    if isinstance(chunks[0], QuantizedRows):
+        return QuantizedRows(torch.cat([c.values for c in chunks]), torch.cat([c.scales for c in chunks]))
+    return torch.cat(chunks)
+
+
+def save_shard(embeddings: torch.Tensor, output_path: str, storage_dtype: str = "float16"):
+    """Write one `{idx}.pt` shard, as fp16 or as int8 values plus per-row scales."""
+    if storage_dtype == "int8":
+        values, scales = quantize_rows(embeddings)
+        torch.save({"values": values, "scales": scales}, output_path)
+    else:
+        torch.save(embeddings.half(), output_path)
+
+
+def load_shard(shard_path: str, mmap: bool = False) -> Union[torch.Tensor, QuantizedRows]:
+    shard = torch.load(shard_path, mmap=mmap, weights_only=True)
+    if isinstance(shard, dict):
+        return QuantizedRows(shard["values"], shard["scales"])
+    return shard
+
+
+def list_shards(embedding_dir: str) -> List[str]:
+    return natsorted(glob.glob(os.path.join(embedding_dir, "*.pt")))
+
+
+def has_store(embedding_dir: str) -> bool:
+    return os.path.exists(os.path.join(embedding_dir, STORE_HEADER_FILE))
+
+
+def read_header(embedding_dir: str) -> dict:
+    with open(os.path.join(embedding_dir, STORE_HEADER_FILE), "r") as f:
+        header = json.load(f)
+    assert header.get("format") == STORE_FORMAT, f"{embedding_dir} does not contain a packed embedding store"
+    return header
+
+
+def write_header(embedding_dir: str, header: dict):
+    # write-then-rename so readers never see a partially written header
+    tmp_path = os.path.join(embedding_dir, STORE_HEADER_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_path, os.path.join(embedding_dir, STORE_HEADER_FILE))
+
+
+def store_shard_rows(header: dict) -> List[int]:
+    """Rows of each shard listed in a store header, or of fixed STORE_RANGE_ROWS ranges if it lists none."""
+    if "shards" in header:
+        return [shard["rows"] for shard in header["shards"]]
+    num_rows = header["num_rows"]
+    return [min(STORE_RANGE_ROWS, num_rows - start) for start in range(0, num_rows, STORE_RANGE_ROWS)]
+
+
+def _memmap(path: str, dtype: str, shape: tuple) -> torch.Tensor:
+    # copy-on-write keeps the file read-only while giving torch a writable array
+    return torch.from_numpy(np.memmap(path, dtype=NUMPY_DTYPES[dtype], mode="c", shape=shape))
+
+
+def open_store(embedding_dir: str) -> Union[torch.Tensor, QuantizedRows]:
+    """
+    Memory-map a packed store as a [num_rows, dim] tensor (or QuantizedRows for int8 stores).
+
+    Nothing is read from disk here; pages are faulted in when rows are touched.
+    """
+    header = read_header(embedding_dir)
+    shape = (header["num_rows"], header["dim"])
+    values = _memmap(os.path.join(embedding_dir, STORE_DATA_FILE), header["dtype"], shape)
+    if header["dtype"] == "int8":
+        scales = _memmap(os.path.join(embedding_dir, STORE_SCALES_FILE), "float32", (header["num_rows"],))
+        return QuantizedRows(values, scales)
+    return values
+
+
+def pack_embedding_dir(
+        embedding_dir: str,
+        output_dir: Optional[str] = None,
+        overwrite: bool = False,
+        storage_dtype: str = "float16",
+    ) -> dict:
+    """
+    Pack the `{idx}.pt` shards of one embedding directory into a single fp16 or int8 store.
+
+    Shards are streamed one at a time, so packing never holds more than one shard in memory.
+    """
+    assert storage_dtype in STORAGE_DTYPES, f"Unsupported storage dtype: {storage_dtype}"
+    output_dir = output_dir or embedding_dir
+    if has_store(output_dir) and not overwrite:
+        logging.info(f"{output_dir} already contains a packed store, skipping...")
+        return read_header(output_dir)
+
+    shards = list_shards(embedding_dir)
+    assert shards, f"No .pt shards found in {embedding_dir}"
+    os.makedirs(output_dir, exist_ok=True)
+
+    num_rows, dim = 0, None
+    shard_info = []
+    cosine_sum, cosine_min = 0.0, 1.0
+    tmp_path = os.path.join(output_dir, STORE_DATA_FILE + ".tmp")
+    tmp_scales_path = os.path.join(output_dir, STORE_SCALES_FILE + ".tmp")
+    with open(tmp_path, "wb") as f, open(tmp_scales_path, "wb") as f_scales:
+        for shard in tqdm(shards, desc=f"Packing {embedding_dir}", unit="file"):
+            vectors = load_shard(shard).to(torch.float16)
+            assert vectors.dim() == 2, f"Expected a 2-d tensor in {shard}, got shape {tuple(vectors.shape)}"
+            if dim is None:
+                dim = vectors.shape[1]
+            assert vectors.shape[1] == dim, f"Dimension mismatch in {shard}: {vectors.shape[1]} != {dim}"
+            if storage_dtype == "int8":
+                values, scales = quantize_rows(vectors)
+                f.write(values.contiguous().numpy().tobytes())
+                f_scales.write(scales.contiguous().numpy().tobytes())
+                cosine = torch.nn.functional.cosine_similarity(vectors.float(), dequantize_rows(values, scales, torch.float32), dim=-1)
+                cosine_sum += cosine.sum().item()
+                cosine_min = min(cosine_min, cosine.min().item())
+            else:
+                f.write(vectors.contiguous().numpy().tobytes())
+            shard_info.append({"file": os.path.basename(shard), "rows": vectors.shape[0]})
+            num_rows += vectors.shape[0]
+    os.replace(tmp_path, os.path.join(output_dir, STORE_DATA_FILE))
+    if storage_dtype == "int8":
+        os.replace(tmp_scales_path, os.path.join(output_dir, STORE_SCALES_FILE))
+    else:
+        os.remove(tmp_scales_path)
+
+    header = {
+        "format": STORE_FORMAT,
+        "version": STORE_VERSION,
+        "num_rows": num_rows,
+        "dim": dim,
+        "dtype": storage_dtype,
+        "shards": shard_info,
+    }
+    if storage_dtype == "int8":
+        # reconstruction quality against the fp16 source, kept for later inspection
+        header["quantization"] = {"mean_cosine": cosine_sum / num_rows, "min_cosine": cosine_min}
+        logging.info(f"int8 reconstruction cosine similarity: mean {cosine_sum / num_rows:.6f}, min {cosine_min:.6f}")
+    # the header is written last: its presence marks the store as complete
+    write_header(output_dir, header)
+    logging.info(f"Packed {num_rows} x {dim} {storage_dtype} embeddings from {len(shards)} shards into {output_dir}")
+    return header
+
+
+class EmbeddingMatrix:
+    """
+    Row-indexable view over one or more [N, D] matrices, one per embedding directory.
+
+    Parts are either memory-mapped stores or tensors loaded from `.pt` shards; rows are
+    addressed by their global index across all parts in list order. int8 parts are kept
+    as QuantizedRows and gathered without dequantizing.
+    """
+
+    def __init__(self, parts: Sequence[Union[torch.Tensor, QuantizedRows]]):
+        assert len(parts) > 0, "EmbeddingMatrix needs at least one part"
+        dims = {part.shape[1] for part in parts}
+        assert len(dims) == 1, f"All embedding parts must share one dimension, got {sorted(dims)}"
+        self.quantized = isinstance(parts[0], QuantizedRows)
+        assert all(isinstance(part, QuantizedRows) == self.quantized for part in parts), "Cannot mix int8 and fp16 embedding directories"
+        self.parts = list(parts)
+        self.offsets = torch.tensor([0] + [len(part) for part in self.parts], dtype=torch.long).cumsum(0)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def dim(self) -> int:
+        return self.parts[0].shape[1]
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.parts[0].dtype
+
+    def _locate(self, idx: int):
+        part_id = int(torch.searchsorted(self.offsets[1:], idx, right=True))
+        return part_id, idx - int(self.offsets[part_id])
+
+    def __getitem__(self, idx: Union[int, torch.Tensor]) -> torch.Tensor:
+        if isinstance(idx, torch.Tensor) and idx.dim() > 0:
+            return self.take(idx)
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        part_id, row = self._locate(idx)
+        return self.parts[part_id][row]
+
+    def _empty(self, num_rows: int, device=None):
+        if self.quantized:
+            return QuantizedRows(
+                torch.empty((num_rows, self.dim), dtype=torch.int8, device=device),
+                torch.empty((num_rows,), dtype=torch.float32, device=device),
+            )
+        return torch.empty((num_rows, self.dim), dtype=self.dtype, device=device)
+
+    @staticmethod
+    def _assign(out, rows, where):
+        if isinstance(out, QuantizedRows):
+            out.values[where] = rows.values.to(out.values.device)
+            out.scales[where] = rows.scales.to(out.scales.device)
+        else:
+            out[where] = rows.to(out.device)
+
+    def to_device(self, device: Union[str, torch.device]):
+        """Materialize all parts as one contiguous tensor on `device`, copying part by part."""
+        out = self._empty(len(self), device=device)
+        for part_id, part in enumerate(self.parts):
+            self._assign(out, part, slice(int(self.offsets[part_id]), int(self.offsets[part_id + 1])))
+        return out
+
+    def take(self, indices: torch.Tensor):
+        """Gather rows for a 1-d index tensor into one contiguous [len(indices), D] tensor."""
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        if len(self.parts) == 1:
+            return self.parts[0].index_select(0, indices)
+        part_ids = torch.searchsorted(self.offsets[1:], indices, right=True)
+        out = self._empty(len(indices))
+        for part_id, part in enumerate(self.parts):
+            mask = part_ids == part_id
+            if mask.any():
+                self._assign(out, part.index_select(0, indices[mask] - self.offsets[part_id]), mask)
+        return out
+
+
+def peek_shard(shard_path: str) -> tuple:
+    """Shape of a `.pt` shard, read through mmap so the tensor data is never loaded."""
+    return tuple(load_shard(shard_path, mmap=True).shape)
+
+
+LOAD_BACKENDS = ["thread", "process"]
+
+# destination of process-backend loads; forked workers inherit it and write into shared memory
+_SHARED_OUTPUT = None
+
+
+def _copy_shard(out, shard_path: str, start: int, end: int) -> int:
+    shard = load_shard(shard_path)
+    assert len(shard) == end - start, f"{shard_path} changed size while loading"
+    EmbeddingMatrix._assign(out, shard, slice(start, end))
+    return os.path.getsize(shard_path)
+
+
+def _copy_shard_shared(shard_path: str, start: int, end: int) -> int:
+    return _copy_shard(_SHARED_OUTPUT, shard_path, start, end)
+
+
+def load_shards_parallel(shards: Sequence[str], num_workers: int = 8, backend: str = "thread"):
+    """
+    Load `.pt` shards into one preallocated contiguous matrix.
+
+    A quick mmap metadata pass sizes the output, then shard reads fan out over a thread or
+    (fork-based) process pool and each worker copies its rows straight into place.
+    """
+    global _SHARED_OUTPUT
+    assert backend in LOAD_BACKENDS, f"Unknown load backend: {backend}"
+    assert shards, "No shards to load"
+    num_workers = max(1, num_workers)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        metas = list(executor.map(lambda shard: load_shard(shard, mmap=True), shards))
+    quantized = isinstance(metas[0], QuantizedRows)
+    assert all(isinstance(meta, QuantizedRows) == quantized for meta in metas), "Cannot mix int8 and fp16 shards"
+    dims = {meta.shape[1] for meta in metas}
+    assert len(dims) == 1, f"All shards must share one dimension, got {sorted(dims)}"
+    starts = np.cumsum([0] + [len(meta) for meta in metas]).tolist()
+    del metas
+
+    num_rows, dim = starts[-1], dims.pop()
+    if quantized:
+        out = QuantizedRows(torch.empty((num_rows, dim), dtype=torch.int8), torch.empty((num_rows,), dtype=torch.float32))
+    else:
+        out = torch.empty((num_rows, dim), dtype=torch.float16)
+
+    if backend == "process" and num_workers > 1:
+        out.share_memory_()
+        _SHARED_OUTPUT = out
+        executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"))
+        submit = lambda i: executor.submit(_copy_shard_shared, shards[i], starts[i], starts[i + 1])
+    else:
+        executor = ThreadPoolExecutor(num_workers)
+        submit = lambda i: executor.submit(_copy_shard, out, shards[i], starts[i], starts[i + 1])
+
+    total_bytes = sum(os.path.getsize(shard) for shard in shards)
+    start_time = time.time()
+    try:
+        with executor, tqdm(total=total_bytes, desc="Loading embedding data", unit="B", unit_scale=True) as pbar:
+            futures = [submit(i) for i in range(len(shards))]
+            for future in as_completed(futures):
+                pbar.update(future.result())
+    finally:
+        _SHARED_OUTPUT = None
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info(
+        f"Loaded {num_rows} x {dim} embeddings from {len(shards)} shards ({total_bytes / 1e6:.1f} MB) "
+        f"in {elapsed:.1f}s with {num_workers} {backend} workers: {total_bytes / 1e6 / elapsed:.1f} MB/s"
+    )
+    return out
+
+
+class ShardedEmbeddingReader:
+    """
+    Random access to row ranges of one or more embedding directories without loading them.
+
+    Packed stores are sliced through their memory map; `.pt` shards are opened with
+    `torch.load(mmap=True)` on demand. `shard_ranges` lists the [start, end) global row
+    range of every source shard, which streaming datasets use as their unit of work.
+    """
+
+    def __init__(self, embedding_list: Sequence[str], agg_mode: Optional[str] = None):
+        self.sources = []  # (global_start, global_end, store tensor or shard path)
+        self.shard_ranges = []
+        self.dim = None
+        num_rows = 0
+        for dir_path in embedding_list:
+            if has_store(dir_path):
+                header = read_header(dir_path)
+                self._check_dim(header["dim"], dir_path)
+                self.sources.append((num_rows, num_rows + header["num_rows"], open_store(dir_path)))
+                for rows in store_shard_rows(header):
+                    self.shard_ranges.append((num_rows, num_rows + rows))
+                    num_rows += rows
+            else:
+                shards = list_shards(dir_path)
+                assert shards, f"No embedding shards found in {dir_path}"
+                for shard in shards:
+                    rows, dim = peek_shard(shard)
+                    self._check_dim(dim, shard)
+                    self.sources.append((num_rows, num_rows + rows, shard))
+                    self.shard_ranges.append((num_rows, num_rows + rows))
+                    num_rows += rows
+        self.num_rows = num_rows
+        self._source_starts = [start for start, _, _ in self.sources]
+        # column view of concat-encoded image embeddings, applied to every read
+        self.columns = None
+        if agg_mode is not None and self.dim is not None:
+            self.columns = agg_columns(agg_mode, self.dim)
+            self.dim = self.columns.stop - self.columns.start
+
+    def _check_dim(self, dim: int, where: str):
+        if self.dim is None:
+            self.dim = dim
+        assert dim == self.dim, f"Dimension mismatch in {where}: {dim} != {self.dim}"
+
+    def __len__(self):
+        return self.num_rows
+
+    def read(self, start: int, end: int) -> torch.Tensor:
+        """Rows [start, end) as one fp16 tensor, or QuantizedRows for int8 sources."""
+        assert 0 <= start <= end <= self.num_rows, f"Row range [{start}, {end}) out of bounds for {self.num_rows} rows"
+        chunks = []
+        source_id = int(np.searchsorted(self._source_starts, start, side="right")) - 1
+        while start < end:
+            source_start, source_end, source = self.sources[source_id]
+            stop = min(end, source_end)
+            if isinstance(source, str):
+                source = load_shard(source, mmap=True)
+            chunk = select_columns(source[start - source_start:stop - source_start], self.columns)
+            chunks.append(chunk.to(torch.float16) if isinstance(chunk, torch.Tensor) else chunk)
+            start = stop
+            source_id += 1
+        if len(chunks) == 1:
+            return chunks[0]
+        return cat_rows(chunks) if chunks else torch.empty((0, self.dim), dtype=torch.float16)
+
+    def read_modulo(self, start: int, end: int, modulo: int) -> torch.Tensor:
+        """Rows `i % modulo` for i in [start, end), read as at most a few contiguous slices."""
+        chunks = []
+        while start < end:
+            row = start % modulo
+            stop = min(end, start + modulo - row)
+            chunks.append(self.read(row, row + stop - start))
+            start = stop
+        return chunks[0] if len(chunks) == 1 else cat_rows(chunks)
+
+
+if __name__ == "__main__":
+    import argparse
+    from train.logger import setup_logging
+
+    setup_logging(log_file=None, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Pack `{idx}.pt` embedding shards into memory-mappable stores.")
+    parser.add_argument("embedding_dirs", nargs="*", help="Embedding directories to pack in place.")
+    parser.add_argument(
+        "--root",
+        type=str,
+        default=None,
+        help="Pack every data/tensor_data/{text,image}_embedding/<model>/<data> directory under this root, e.g. ./data/tensor_data",
+    )
+    parser.add_argument("--overwrite", action="store_true", help="Re-pack directories that already have a store.")
+    parser.add_argument("--dtype", type=str, default="float16", choices=STORAGE_DTYPES, help="Storage dtype of the packed matrix.")
+    parser.add_argument(
+        "--output-suffix",
+        type=str,
+        default="",
+        help="Write each store to <embedding_dir><suffix> instead of in place, e.g. _int8 to keep an fp16 store alongside.",
+    )
+    args = parser.parse_args()
+
+    embedding_dirs = list(args.embedding_dirs)
+    if args.root is not None:
+        for domain in ("text_embedding", "image_embedding"):
+            embedding_dirs.extend(natsorted(glob.glob(os.path.join(args.root, domain, "*", "*"))))
+    embedding_dirs = [d for d in embedding_dirs if os.path.isdir(d) and list_shards(d)]
+    assert embedding_dirs, "No embedding directories with .pt shards found"
+    for embedding_dir in embedding_dirs:
+        output_dir = embedding_dir.rstrip("/") + args.output_suffix if args.output_suffix else None
+        pack_embedding_dir(embedding_dir, output_dir=output_dir, overwrite=args.overwrite, storage_dtype=args.dtype)
@@ -3,18 +3,29 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from typing import List, Optional
 import os
+import time
+from functools import partial
 from PIL import ImageFile
 from .utils import load_data
+from .pixel_cache import resize_center_crop, normalize_pixels, processor_spec
+from .batched_processor import BatchedImageProcessor
+from .decode import open_image
 from transformers.image_processing_base import BatchFeature
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 Image.MAX_IMAGE_PIXELS = None
 
+# collate "normalization" of a BatchedImageProcessor that resizes on the GPU: keep the images as a list
+RESIZE_ON_DEVICE = "resize_on_device"
+
 class ImageDataset(Dataset):
-    def __init__(self, image_paths: List[str], image_processor, transform=None):
+    def __init__(self, image_paths: List[str], image_processor, transform=None, pixel_cache=None, decode_min_side=None):
         self.image_paths = image_paths
+        self.decode_min_side = decode_min_side
         self.transform = transform
         self.image_processor = image_processor
+        # with a PixelCache, items are uint8 center crops and normalization happens per batch in collate
+        self.pixel_cache = pixel_cache
         
     def __len__(self):
         return len(self.image_paths)
@@ -22,42 +33,153 @@ class ImageDataset(Dataset):
     def __getitem__(self, idx):
         image_path = self.image_paths[idx]
         try:
-            with Image.open(image_path) as img:
-                img = img.convert('RGB')
-                if self.transform:
-                    img = self.transform(img)
-                    return img  # Return directly if custom transform is used
-                else:
-                    # Return the dictionary from image_processor
-                    return self.image_processor(img, return_tensors="pt")
+            if self.pixel_cache is not None:
+                return self.pixel_cache.load(image_path)
+            img = open_image(image_path, self.decode_min_side)
+            if self.transform:
+                img = self.transform(img)
+                return img  # Return directly if custom transform is used
+            elif isinstance(self.image_processor, BatchedImageProcessor):
+                # uint8 crop normalized per batch in collate, or the whole image when resizing on the GPU
+                return self.image_processor.worker_pixels(img)
+            else:
+                # Return the dictionary from image_processor
+                return self.image_processor(img, return_tensors="pt")
         except Exception as e:
             print(f"Error processing image {image_path}: {str(e)}")
+            if self.pixel_cache is not None or isinstance(self.image_processor, BatchedImageProcessor):
+                crop = self.pixel_cache.crop if self.pixel_cache is not None else self.image_processor.crop
+                return torch.zeros((crop, crop, 3), dtype=torch.uint8)
             # Return a placeholder with the same format as image_processor output
             return {'pixel_values': torch.zeros((1, 3, 224, 224))}
 
-def collate_fn(batch):
+class MultiProcessorImageDataset(Dataset):
+    """Decode each image once and apply every processor to it, e.g. to encode several backbones in one pass."""
+
+    def __init__(self, image_paths: List[str], image_processors: List, pixel_caches: Optional[List] = None, decode_min_side=None,
+                 record_timings=False):
+        self.image_paths = image_paths
+        self.decode_min_side = decode_min_side
+        # append {'decode': s, 'preprocess': s} of this item, summed per batch by multi_collate_fn
+        self.record_timings = record_timings
+        self.image_processors = image_processors
+        # processors with a PixelCache get uint8 center crops, the image is only decoded if some processor misses
+        self.pixel_caches = pixel_caches or [None] * len(image_processors)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def _decode(self, image_path):
+        try:
+            return open_image(image_path, self.decode_min_side)
+        except Exception as e:
+            print(f"Error processing image {image_path}: {str(e)}")
+            # a black image gives every processor a placeholder of its own output size
+            return Image.new('RGB', (224, 224))
+
+    def __getitem__(self, idx):
+        image_path = self.image_paths[idx]
+        start = time.perf_counter()
+        outputs = [cache.get(image_path) if cache is not None else None for cache in self.pixel_caches]
+        img = None
+        timings = {'decode': time.perf_counter() - start, 'preprocess': 0.0}
+        for i, (processor, cache) in enumerate(zip(self.image_processors, self.pixel_caches)):
+            if outputs[i] is not None:
+                continue
+            if img is None:
+                start = time.perf_counter()
+                img = self._decode(image_path)
+                timings['decode'] += time.perf_counter() - start
+            start = time.perf_counter()
+            if cache is not None:
+                outputs[i] = torch.from_numpy(resize_center_crop(img, cache.resize, cache.crop, cache.interpolation, cache.rounding))
+            elif isinstance(processor, BatchedImageProcessor):
+                outputs[i] = processor.worker_pixels(img)
+            else:
+                outputs[i] = processor(img, return_tensors="pt")
+            timings['preprocess'] += time.perf_counter() - start
+        if self.record_timings:
+            outputs.append(timings)
+        return tuple(outputs)
+
+def collate_fn(batch, normalization=None):
     # Stack all tensors in the batch along dim=0 to create a batch of shape [n,3,224,224]
-    tensors = [item['pixel_values'] for item in batch]
+    # (CustomImageProcessor returns tensors, huggingface processors return a dict)
+    if normalization == RESIZE_ON_DEVICE:
+        # whole uint8 images of different sizes, left to BatchedImageProcessor.__call__ in the main process
+        return list(batch)
+    if normalization is not None:
+        # uint8 [n,224,224,3] crops from a pixel cache, normalized as one tensor op
+        return BatchFeature(data={'pixel_values': normalize_pixels(torch.stack(batch, dim=0), *normalization)}, tensor_type="pt")
+    tensors = [item if isinstance(item, torch.Tensor) else item['pixel_values'] for item in batch]
     tensors = [t.squeeze(0) if t.dim() == 4 else t for t in tensors] # Remove batch dim if present
 
     return BatchFeature(data={'pixel_values': torch.stack(tensors, dim=0)}, tensor_type="pt")
 
+def multi_collate_fn(batch, normalizations=None, with_timings=False):
+    # one collated batch per processor
+    if with_timings:
+        # worker seconds spent on this batch per stage, next to the batches
+        start = time.perf_counter()
+        timings = {stage: sum(item[-1][stage] for item in batch) for stage in batch[0][-1]}
+        batches = multi_collate_fn([item[:-1] for item in batch], normalizations)
+        timings['collate'] = time.perf_counter() - start
+        return batches, timings
+    normalizations = normalizations or [None] * len(batch[0])
+    return tuple(collate_fn(list(items), normalization) for items, normalization in zip(zip(*batch), normalizations))
+
+def pixel_normalization(image_processor, pixel_cache):
+    """(mean, std) to normalize the uint8 crops of a pixel cache or a BatchedImageProcessor, RESIZE_ON_DEVICE for one resizing on the GPU, else None."""
+    if pixel_cache is None:
+        if isinstance(image_processor, BatchedImageProcessor):
+            if image_processor.resizes_on_device:
+                return RESIZE_ON_DEVICE
+            return image_processor.mean, image_processor.std
+        return None
+    spec = processor_spec(image_processor)
+    assert spec is not None and (spec['resize'], spec['crop'], spec['interpolation'], spec['rounding']) == \
+        (pixel_cache.resize, pixel_cache.crop, pixel_cache.interpolation, pixel_cache.rounding), \
+        f"Pixel cache {pixel_cache.cache_dir} does not match the crop policy of {type(image_processor).__name__}"
+    return spec['mean'], spec['std']
+
 def create_image_dataloader(
     image_paths: List[str],
     image_processor,
     batch_size: int = 32,
     num_workers: int = 4,
     shuffle: bool = False,
-    transform = None
+    transform = None,
+    batch_sampler = None,
+    prefetch_factor: int = 2,
+    pixel_cache = None,
+    decode_min_side: Optional[int] = None,
+    record_timings: bool = False,
 ) -> DataLoader:
-    dataset = ImageDataset(image_paths, image_processor, transform)
+    """
+    If `batch_sampler` is given it yields lists of indices and overrides batch_size/shuffle,
+    e.g. to decode only the batches whose shards are still missing. A list of processors
+    decodes every image once and yields a tuple with one batch per processor. `pixel_cache`
+    (a list with one entry per processor, None where unused) reads pre-cropped pixels
+    instead of decoding. `decode_min_side` decodes JPEGs at reduced resolution (see data.decode.open_image)
+    and must not be below the resize of any processor. With `record_timings` (processor lists only)
+    each batch comes with the worker seconds spent decoding, preprocessing and collating it.
+    """
+    if isinstance(image_processor, (list, tuple)):
+        pixel_caches = pixel_cache or [None] * len(image_processor)
+        dataset = MultiProcessorImageDataset(image_paths, list(image_processor), pixel_caches, decode_min_side, record_timings)
+        collate = partial(multi_collate_fn, normalizations=[pixel_normalization(p, c) for p, c in zip(image_processor, pixel_caches)],
+                          with_timings=record_timings)
+    else:
+        dataset = ImageDataset(image_paths, image_processor, transform, pixel_cache, decode_min_side)
+        collate = partial(collate_fn, normalization=pixel_normalization(image_processor, pixel_cache))
+    batching = {'batch_sampler': batch_sampler} if batch_sampler is not None else {'batch_size': batch_size, 'shuffle': shuffle}
     return DataLoader(
         dataset,
-        batch_size=batch_size,
-        shuffle=shuffle,
         num_workers=num_workers,
         pin_memory=True,
-        collate_fn=collate_fn
+        collate_fn=collate,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        **batching,
     ) 
 
 if __name__ == "__main__":
@@ -0,0 +1,314 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import logging
+import threading
+from typing import List, Optional, Sequence
+
+from natsort import natsorted
+from tqdm import tqdm
+
+from .embedding_store import has_store, list_shards, load_shard, read_header
+
+# Every embedding directory carries manifest.json and/or one fragment per encode.py process
+# (manifest.<start>-<end>.json), so concurrent multi-GPU runs never write the same file.
+MANIFEST_FILE = "manifest.json"
+MANIFEST_FORMAT = "sail-embedding-manifest"
+MANIFEST_VERSION = 1
+FRAGMENT_PATTERN = re.compile(r"manifest\.(\d+)-(\d+)\.json$")
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def shard_index(shard_file: str) -> int:
+    return int(os.path.splitext(os.path.basename(shard_file))[0])
+
+
+def _write_json(path: str, obj: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def new_manifest(source: Optional[dict] = None) -> dict:
+    return {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "dim": None,
+        "dtype": None,
+        "source": source or {},
+        "shards": [],
+    }
+
+
+def fragment_path(embedding_dir: str, start_index: int, end_index: int) -> str:
+    return os.path.join(embedding_dir, f"manifest.{start_index}-{end_index}.json")
+
+
+def manifest_files(embedding_dir: str) -> List[str]:
+    files = [os.path.join(embedding_dir, MANIFEST_FILE)] if os.path.exists(os.path.join(embedding_dir, MANIFEST_FILE)) else []
+    files += natsorted(f for f in glob.glob(os.path.join(embedding_dir, "manifest.*.json")) if FRAGMENT_PATTERN.search(f))
+    return files
+
+
+def has_manifest(embedding_dir: str) -> bool:
+    return len(manifest_files(embedding_dir)) > 0
+
+
+def load_manifest(embedding_dir: str) -> Optional[dict]:
+    """Merge manifest.json and all per-process fragments of one directory, or None if there are none."""
+    files = manifest_files(embedding_dir)
+    if not files:
+        return None
+    merged = None
+    shards = {}
+    for path in files:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        assert manifest.get("format") == MANIFEST_FORMAT, f"{path} is not an embedding manifest"
+        if merged is None:
+            merged = {k: v for k, v in manifest.items() if k != "shards"}
+        for key in ("dim", "dtype"):
+            if merged[key] is None:
+                merged[key] = manifest[key]
+            assert manifest[key] in (None, merged[key]), f"{key} mismatch in {path}: {manifest[key]} != {merged[key]}"
+        for shard in manifest["shards"]:
+            shards[shard["file"]] = shard
+    merged["shards"] = sorted(shards.values(), key=lambda shard: (shard["start"], shard["file"]))
+    return merged
+
+
+def validate_manifest(manifest: dict, expected_rows: Optional[int] = None) -> List[str]:
+    """Return human-readable problems: gaps and overlaps between shard row ranges, wrong totals."""
+    problems = []
+    cursor = 0
+    for shard in manifest["shards"]:
+        if shard["start"] > cursor:
+            problems.append(f"missing rows [{cursor}, {shard['start']}) before {shard['file']}")
+        elif shard["start"] < cursor:
+            problems.append(f"{shard['file']} rows [{shard['start']}, {shard['end']}) overlap rows before {cursor}")
+        cursor = max(cursor, shard["end"])
+    if expected_rows is not None and cursor != expected_rows:
+        problems.append(f"shards cover {cursor} rows, expected {expected_rows}")
+    return problems
+
+
+def manifest_num_rows(manifest: dict) -> int:
+    return max((shard["end"] for shard in manifest["shards"]), default=0)
+
+
+class ManifestWriter:
+    """
+    Records the shards one encode.py process writes into its own manifest fragment.
+
+    Entries already present in the fragment (from an earlier `--resume`d run) are kept. Shards
+    are added from the writer thread and, for --resume, from the encoding loop, hence the lock.
+    """
+
+    def __init__(self, embedding_dir: str, start_index: int, end_index: int, source: Optional[dict] = None, flush_every: int = 64):
+        self.path = fragment_path(embedding_dir, start_index, end_index)
+        self.flush_every = flush_every
+        self.manifest = new_manifest(dict(source or {}, start_index=start_index, end_index=end_index))
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                previous = json.load(f)
+            self.manifest["dim"], self.manifest["dtype"] = previous["dim"], previous["dtype"]
+            self.manifest["shards"] = previous["shards"]
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def has_shard(self, shard_path: str) -> bool:
+        file = os.path.basename(shard_path)
+        with self._lock:
+            return any(shard["file"] == file for shard in self.manifest["shards"])
+
+    def add_shard(self, shard_path: str, start: int, rows: int, dim: int, dtype: str):
+        entry = {
+            "file": os.path.basename(shard_path),
+            "start": start,
+            "end": start + rows,
+            "rows": rows,
+            "sha256": file_checksum(shard_path),
+        }
+        with self._lock:
+            self.manifest["dim"] = self.manifest["dim"] or dim
+            self.manifest["dtype"] = self.manifest["dtype"] or dtype
+            self.manifest["shards"] = [shard for shard in self.manifest["shards"] if shard["file"] != entry["file"]]
+            self.manifest["shards"].append(entry)
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.manifest["shards"]:
+            return
+        self.manifest["shards"].sort(key=lambda shard: shard["start"])
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        _write_json(self.path, self.manifest)
+        self._pending = 0
+
+
+def consolidate_manifest(embedding_dir: str, expected_rows: Optional[int] = None, extra: Optional[dict] = None) -> List[str]:
+    """Merge all fragments into manifest.json, remove them and return any validation problems."""
+    fragments = [f for f in manifest_files(embedding_dir) if FRAGMENT_PATTERN.search(f)]
+    manifest = load_manifest(embedding_dir)
+    assert manifest is not None, f"No manifest fragments in {embedding_dir}"
+    for key in ("start_index", "end_index"):
+        manifest["source"].pop(key, None)
+    problems = validate_manifest(manifest, expected_rows)
+    manifest["complete"] = not problems
+    manifest.update(extra or {})
+    _write_json(os.path.join(embedding_dir, MANIFEST_FILE), manifest)
+    for fragment in fragments:
+        os.remove(fragment)
+    return problems
+
+
+def build_manifest(embedding_dir: str, batch_size: Optional[int] = None, checksum: bool = True, source: Optional[dict] = None) -> dict:
+    """
+    Build manifest.json for an existing directory of `{idx}.pt` shards.
+
+    encode.py names shards `start_index // batch_size + n`, so shard `idx` starts at row
+    `idx * batch_size`; batch_size defaults to the largest shard.
+    """
+    shards = list_shards(embedding_dir)
+    assert shards, f"No .pt shards found in {embedding_dir}"
+    manifest = new_manifest(source)
+    infos = []
+    for shard in tqdm(shards, desc=f"Indexing {embedding_dir}", unit="file"):
+        vectors = load_shard(shard, mmap=True)
+        rows, dim = vectors.shape
+        infos.append((shard, rows, dim, str(vectors.dtype).replace("torch.", "")))
+    batch_size = batch_size or max(rows for _, rows, _, _ in infos)
+    for shard, rows, dim, dtype in infos:
+        assert dim == infos[0][2], f"Dimension mismatch in {shard}: {dim} != {infos[0][2]}"
+        start = shard_index(shard) * batch_size
+        entry = {"file": os.path.basename(shard), "start": start, "end": start + rows, "rows": rows}
+        if checksum:
+            entry["sha256"] = file_checksum(shard)
+        manifest["shards"].append(entry)
+    manifest["dim"], manifest["dtype"] = infos[0][2], infos[0][3]
+    manifest["source"]["batch_size"] = batch_size
+    _write_json(os.path.join(embedding_dir, MANIFEST_FILE), manifest)
+    return manifest
+
+
+def verify_checksums(embedding_dir: str, manifest: dict) -> List[str]:
+    problems = []
+    for shard in tqdm(manifest["shards"], desc=f"Verifying {embedding_dir}", unit="file"):
+        path = os.path.join(embedding_dir, shard["file"])
+        if not os.path.exists(path):
+            problems.append(f"{shard['file']} is missing")
+        elif "sha256" in shard and file_checksum(path) != shard["sha256"]:
+            problems.append(f"{shard['file']} checksum mismatch")
+    return problems
+
+
+def describe_embedding_dir(embedding_dir: str) -> Optional[dict]:
+    """
+    Row count and dim of a directory from its store header or manifest, without touching shards.
+
+    Raises if the manifest shows missing or overlapping shards; returns None if there is no metadata.
+    """
+    if has_store(embedding_dir):
+        header = read_header(embedding_dir)
+        return {"num_rows": header["num_rows"], "dim": header["dim"]}
+    manifest = load_manifest(embedding_dir)
+    if manifest is None:
+        return None
+    problems = validate_manifest(manifest)
+    if problems:
+        raise ValueError(f"Invalid embedding directory {embedding_dir}:\n  " + "\n  ".join(problems))
+    return {"num_rows": manifest_num_rows(manifest), "dim": manifest["dim"]}
+
+
+def describe_embedding_list(embedding_list: Sequence[str]) -> Optional[dict]:
+    """Summed row count and shared dim of a list of directories, or None if any lacks metadata."""
+    infos = [describe_embedding_dir(d) for d in embedding_list]
+    if any(info is None for info in infos):
+        return None
+    dims = {info["dim"] for info in infos}
+    assert len(dims) == 1, f"Embedding directories {list(embedding_list)} have different dims {sorted(dims)}"
+    return {"num_rows": sum(info["num_rows"] for info in infos), "dim": dims.pop()}
+
+
+def check_concat_layout(embedding_list: Sequence[str]):
+    """Assert every directory holds [cls | patch-mean] rows, per its manifest or else its `_concat` name."""
+    for embedding_dir in embedding_list:
+        manifest = load_manifest(embedding_dir)
+        if manifest is not None:
+            source = manifest["source"]
+        else:
+            # stores written in place by encode.py --direct_store carry the source in their header
+            source = read_header(embedding_dir).get("source", {}) if has_store(embedding_dir) else {}
+        layout = source.get("agg_layout", source.get("agg_mode"))
+        if layout is None and os.path.basename(os.path.normpath(embedding_dir)).endswith("_concat"):
+            layout = "concat"
+        assert layout == "concat", f"Selecting cls/patch columns needs concat-encoded image embeddings, {embedding_dir} has layout {layout}"
+
+
+def check_alignment(text_embedding_list: Sequence[str], image_embedding_list: Sequence[str], extra_text_embedding_list: Optional[Sequence[str]] = None):
+    """
+    Fail fast on mis-paired text/image directories using manifests only, before any shard is loaded.
+
+    Directories without a manifest or store header are skipped and checked after loading instead.
+    """
+    text_info = describe_embedding_list(text_embedding_list)
+    image_info = describe_embedding_list(image_embedding_list)
+    if text_info is None or image_info is None:
+        return
+    n_txt, n_img = text_info["num_rows"], image_info["num_rows"]
+    assert n_img > 0 and n_txt > 0 and n_txt % n_img == 0, f"text rows ({n_txt}) in {list(text_embedding_list)} are not a multiple of image rows ({n_img}) in {list(image_embedding_list)}"
+    if extra_text_embedding_list:
+        extra_info = describe_embedding_list(extra_text_embedding_list)
+        if extra_info is not None:
+            assert extra_info["num_rows"] == n_txt, f"extra text rows ({extra_info['num_rows']}) are not equal to text rows ({n_txt})"
+            assert extra_info["dim"] == text_info["dim"], f"extra text dim ({extra_info['dim']}) is not equal to text dim ({text_info['dim']})"
+    logging.info(f"Manifests OK: {n_txt} text rows (dim {text_info['dim']}), {n_img} image rows (dim {image_info['dim']})")
+
+
+if __name__ == "__main__":
+    import argparse
+    from train.logger import setup_logging
+
+    setup_logging(log_file=None, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or validate manifests of embedding directories.")
+    parser.add_argument("command", choices=["build", "validate"])
+    parser.add_argument("embedding_dirs", nargs="+")
+    parser.add_argument("--batch_size", type=int, default=None, help="encode.py batch size used to name the shards (build)")
+    parser.add_argument("--no_checksum", action="store_true", help="Skip per-shard checksums (build)")
+    parser.add_argument("--expected_rows", type=int, default=None, help="Expected total rows per directory (validate)")
+    parser.add_argument("--verify_checksums", action="store_true", help="Re-hash every shard (validate)")
+    args = parser.parse_args()
+
+    failed = False
+    for embedding_dir in args.embedding_dirs:
+        if args.command == "build":
+            manifest = build_manifest(embedding_dir, batch_size=args.batch_size, checksum=not args.no_checksum)
+        else:
+            manifest = load_manifest(embedding_dir)
+            assert manifest is not None, f"No manifest in {embedding_dir}, run `python -m data.manifest build` first"
+        problems = validate_manifest(manifest, args.expected_rows)
+        if args.command == "validate" and args.verify_checksums:
+            problems += verify_checksums(embedding_dir, manifest)
+        rows = manifest_num_rows(manifest)
+        if problems:
+            failed = True
+            logging.error(f"{embedding_dir}: {rows} rows, dim {manifest['dim']}, {len(problems)} problem(s):\n  " + "\n  ".join(problems))
+        else:
+            logging.info(f"{embedding_dir}: {rows} rows in {len(manifest['shards'])} shards, dim {manifest['dim']}, OK")
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,270 @@
+import os
+import json
+import hashlib
+import logging
+from typing import List, Optional, Sequence
+
+import numpy as np
+import torch
+from PIL import Image, ImageFile
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+Image.MAX_IMAGE_PIXELS = None
+
+# A pixel cache holds resized and center-cropped uint8 images of one image set under one
+# crop policy, at <root>/<name>/<spec>, e.g. ./data/pixel_cache/dreamclipcc3m/r256_c224_bicubic_floor:
+#   pixels.bin   [N, crop, crop, 3] uint8, row i is paths[i]
+#   filled.bin   [N] uint8, 1 once row i is written (builds are resumable)
+#   paths.txt    one image path per row
+#   cache.json   crop policy and row count
+# Normalization is left to the consumer, so every backbone sharing the policy shares the cache.
+PIXELS_FILE = "pixels.bin"
+FILLED_FILE = "filled.bin"
+PATHS_FILE = "paths.txt"
+CACHE_CONFIG_FILE = "cache.json"
+
+INTERPOLATIONS = {"bicubic": Image.BICUBIC, "bilinear": Image.BILINEAR}
+PIL_RESAMPLE_NAMES = {int(Image.BICUBIC): "bicubic", int(Image.BILINEAR): "bilinear"}
+# how an odd leftover is split by the center crop: torchvision's CenterCrop rounds the offset,
+# the HF image processors floor it, so their crops of the same image differ by one pixel
+CROP_ROUNDINGS = ("round", "floor")
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def spec_name(resize: int, crop: int, interpolation: str = "bicubic", rounding: str = "round") -> str:
+    return f"r{resize}_c{crop}_{interpolation}_{rounding}"
+
+
+def crop_offset(size: int, crop: int, rounding: str = "round") -> int:
+    assert rounding in CROP_ROUNDINGS, f"Unknown crop rounding {rounding}"
+    return int(round((size - crop) / 2.0)) if rounding == "round" else (size - crop) // 2
+
+
+def processor_spec(image_processor) -> Optional[dict]:
+    """
+    Crop policy and normalization of an image processor, or None if it is not a plain
+    resize-shortest-edge + center-crop pipeline that a pixel cache can stand in for.
+    """
+    # BatchedImageProcessor
+    if hasattr(image_processor, "to_uint8"):
+        return {"resize": image_processor.resize, "crop": image_processor.crop, "interpolation": image_processor.interpolation,
+                "rounding": getattr(image_processor, "rounding", "round"), "mean": image_processor.mean, "std": image_processor.std}
+    # CustomImageProcessor (local ibot/mae/ijepa/dinov1/aim models)
+    if hasattr(image_processor, "image_processor") and hasattr(image_processor.image_processor, "transforms"):
+        # torchvision Resize + CenterCrop
+        return {"resize": 256, "crop": 224, "interpolation": "bicubic", "rounding": "round", "mean": IMAGENET_MEAN, "std": IMAGENET_STD}
+    size, crop_size = getattr(image_processor, "size", None), getattr(image_processor, "crop_size", None)
+    if not (getattr(image_processor, "do_resize", False) and getattr(image_processor, "do_center_crop", False)):
+        return None
+    if not isinstance(size, dict) or "shortest_edge" not in size or not isinstance(crop_size, dict):
+        return None
+    if crop_size.get("height") != crop_size.get("width"):
+        return None
+    interpolation = PIL_RESAMPLE_NAMES.get(int(getattr(image_processor, "resample", Image.BICUBIC)))
+    if interpolation is None:
+        return None
+    return {
+        "resize": size["shortest_edge"],
+        "crop": crop_size["height"],
+        "interpolation": interpolation,
+        # transformers' center_crop floors the offset
+        "rounding": "floor",
+        "mean": tuple(image_processor.image_mean) if getattr(image_processor, "do_normalize", True) else (0.0, 0.0, 0.0),
+        "std": tuple(image_processor.image_std) if getattr(image_processor, "do_normalize", True) else (1.0, 1.0, 1.0),
+    }
+
+
+def resize_center_crop(img: Image.Image, resize: int, crop: int, interpolation: str = "bicubic", rounding: str = "round") -> np.ndarray:
+    """Shortest edge to `resize`, then a `crop` x `crop` center crop (offset rounded per `rounding`), as [crop, crop, 3] uint8."""
+    img = img.convert("RGB")
+    width, height = img.size
+    if width <= height:
+        new_size = (resize, int(resize * height / width))
+    else:
+        new_size = (int(resize * width / height), resize)
+    if new_size != (width, height):
+        img = img.resize(new_size, INTERPOLATIONS[interpolation])
+    width, height = img.size
+    left, top = crop_offset(width, crop, rounding), crop_offset(height, crop, rounding)
+    return np.asarray(img.crop((left, top, left + crop, top + crop)), dtype=np.uint8)
+
+
+def normalize_pixels(pixels: torch.Tensor, mean: Sequence[float], std: Sequence[float]) -> torch.Tensor:
+    """[B, H, W, 3] (or [H, W, 3]) uint8 to normalized [B, 3, H, W] float, as one tensor op."""
+    pixels = pixels.movedim(-1, -3).float().div_(255)
+    shape = (3, 1, 1)
+    mean = torch.tensor(mean, dtype=pixels.dtype, device=pixels.device).view(shape)
+    std = torch.tensor(std, dtype=pixels.dtype, device=pixels.device).view(shape)
+    return pixels.sub_(mean).div_(std)
+
+
+def path_keys(paths: Sequence[str]) -> np.ndarray:
+    return np.array([int.from_bytes(hashlib.blake2b(os.path.normpath(p).encode("utf-8"), digest_size=8).digest(), "little") for p in paths], dtype=np.uint64)
+
+
+class PixelCache:
+    """
+    Read access to a built pixel cache; rows are found by image path.
+
+    The memory map is opened lazily so the object can be sent to DataLoader workers.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, CACHE_CONFIG_FILE), "r") as f:
+            self.config = json.load(f)
+        self.resize, self.crop, self.interpolation = self.config["resize"], self.config["crop"], self.config["interpolation"]
+        self.rounding = self.config["crop_rounding"]
+        self.num_rows = self.config["num_rows"]
+        with open(os.path.join(cache_dir, PATHS_FILE), "r") as f:
+            keys = path_keys(f.read().splitlines())
+        self._order = np.argsort(keys)
+        self._keys = keys[self._order]
+        self._pixels = None
+        self._filled = None
+
+    @classmethod
+    def open(cls, root: str, name: str, spec: dict) -> Optional["PixelCache"]:
+        """The cache of image set `name` under the crop policy of `spec`, if one was built."""
+        cache_dir = os.path.join(root, name, spec_name(spec["resize"], spec["crop"], spec["interpolation"], spec["rounding"]))
+        if not os.path.exists(os.path.join(cache_dir, CACHE_CONFIG_FILE)):
+            logging.info(f"No pixel cache at {cache_dir}, decoding images")
+            return None
+        logging.info(f"Reading pixels from {cache_dir}")
+        return cls(cache_dir)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pixels"] = state["_filled"] = None
+        return state
+
+    def _open(self):
+        if self._pixels is None:
+            self._pixels = np.memmap(os.path.join(self.cache_dir, PIXELS_FILE), dtype=np.uint8, mode="r",
+                                     shape=(self.num_rows, self.crop, self.crop, 3))
+            self._filled = np.memmap(os.path.join(self.cache_dir, FILLED_FILE), dtype=np.uint8, mode="r", shape=(self.num_rows,))
+
+    def row(self, path: str) -> Optional[int]:
+        key = path_keys([path])[0]
+        pos = int(np.searchsorted(self._keys, key))
+        if pos >= len(self._keys) or self._keys[pos] != key:
+            return None
+        return int(self._order[pos])
+
+    def get(self, path: str) -> Optional[torch.Tensor]:
+        """[crop, crop, 3] uint8 pixels of `path`, or None if it is not cached."""
+        row = self.row(path)
+        if row is None:
+            return None
+        self._open()
+        if not self._filled[row]:
+            return None
+        return torch.from_numpy(np.array(self._pixels[row]))
+
+    def load(self, path: str) -> torch.Tensor:
+        """Cached pixels, falling back to decoding the image under the same crop policy."""
+        pixels = self.get(path)
+        if pixels is None:
+            with Image.open(path) as img:
+                pixels = torch.from_numpy(resize_center_crop(img, self.resize, self.crop, self.interpolation, self.rounding))
+        return pixels
+
+
+class _DecodeDataset(Dataset):
+    def __init__(self, paths: List[str], rows: List[int], resize: int, crop: int, interpolation: str, rounding: str):
+        self.paths, self.rows = paths, rows
+        self.resize, self.crop, self.interpolation, self.rounding = resize, crop, interpolation, rounding
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        try:
+            with Image.open(self.paths[row]) as img:
+                return row, resize_center_crop(img, self.resize, self.crop, self.interpolation, self.rounding), True
+        except Exception as e:
+            print(f"Error processing image {self.paths[row]}: {str(e)}")
+            return row, np.zeros((self.crop, self.crop, 3), dtype=np.uint8), False
+
+
+def build_pixel_cache(image_paths: List[str], cache_dir: str, resize: int = 256, crop: int = 224, interpolation: str = "bicubic",
+                      rounding: str = "floor", num_workers: int = 16, batch_size: int = 256) -> str:
+    """Decode, resize and crop every image into `cache_dir`; rows already filled by an earlier run are skipped."""
+    os.makedirs(cache_dir, exist_ok=True)
+    config = {"resize": resize, "crop": crop, "interpolation": interpolation, "crop_rounding": rounding, "num_rows": len(image_paths)}
+    config_path = os.path.join(cache_dir, CACHE_CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            existing = json.load(f)
+        assert existing == config, f"{cache_dir} was built with {existing}, not {config}"
+        pixel_mode = "r+"
+    else:
+        with open(os.path.join(cache_dir, PATHS_FILE), "w") as f:
+            f.write("\n".join(image_paths))
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        pixel_mode = "w+"
+    pixels = np.memmap(os.path.join(cache_dir, PIXELS_FILE), dtype=np.uint8, mode=pixel_mode, shape=(len(image_paths), crop, crop, 3))
+    filled = np.memmap(os.path.join(cache_dir, FILLED_FILE), dtype=np.uint8, mode=pixel_mode, shape=(len(image_paths),))
+
+    todo = np.flatnonzero(filled == 0).tolist()
+    logging.info(f"Building pixel cache {cache_dir}: {len(todo)} of {len(image_paths)} images to decode")
+    loader = DataLoader(_DecodeDataset(image_paths, todo, resize, crop, interpolation, rounding), batch_size=batch_size, num_workers=num_workers,
+                        collate_fn=lambda batch: batch)
+    failed = 0
+    for n, batch in enumerate(tqdm(loader, desc="Decoding", unit="batch")):
+        for row, image, ok in batch:
+            pixels[row] = image
+            filled[row] = ok
+            failed += not ok
+        if n % 100 == 0:
+            pixels.flush()
+            filled.flush()
+    pixels.flush()
+    filled.flush()
+    if failed:
+        logging.warning(f"{failed} images could not be decoded and are left unfilled")
+    return cache_dir
+
+
+def list_images(image_root: str) -> List[str]:
+    extensions = (".jpg", ".jpeg", ".png", ".JPEG", ".JPG", ".PNG")
+    paths = []
+    for dirpath, _, filenames in os.walk(image_root):
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.endswith(extensions))
+    return sorted(paths)
+
+
+if __name__ == "__main__":
+    import argparse
+    from train.logger import setup_logging
+
+    setup_logging(log_file=None, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build a decoded-pixel cache of uint8 center crops.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", type=str, help="Key of DATADIR in data/data_config.py; caches its 'Image Path' column")
+    source.add_argument("--image_root", type=str, help="Directory of images to cache, e.g. ImageNet val or COCO val2017")
+    parser.add_argument("--name", type=str, default=None, help="Image set name, defaults to --data or the basename of --image_root")
+    parser.add_argument("--root", type=str, default="./data/pixel_cache")
+    parser.add_argument("--resize", type=int, default=256, help="Shortest edge after resizing")
+    parser.add_argument("--crop", type=int, default=224, help="Center crop size")
+    parser.add_argument("--interpolation", type=str, default="bicubic", choices=list(INTERPOLATIONS))
+    parser.add_argument("--crop_rounding", type=str, default="floor", choices=CROP_ROUNDINGS,
+                        help="Center crop offset rule: floor for the HF processors (dinov2, aimv2, clip), round for the local CustomImageProcessor models")
+    parser.add_argument("--num_workers", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.data:
+        from data.data_config import DATADIR
+        from data.utils import load_data
+        _, image_paths = load_data(DATADIR[args.data], None, "image")
+        name = args.name or args.data
+    else:
+        image_paths = list_images(args.image_root)
+        name = args.name or os.path.basename(os.path.normpath(args.image_root))
+    cache_dir = os.path.join(args.root, name, spec_name(args.resize, args.crop, args.interpolation, args.crop_rounding))
+    build_pixel_cache(image_paths, cache_dir, args.resize, args.crop, args.interpolation, args.crop_rounding, num_workers=args.num_workers)
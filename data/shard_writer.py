@@ -0,0 +1,134 @@
+import os
+import queue
+import logging
+import threading
+import time
+
+import torch
+
+from .embedding_store import QuantizedRows, load_shard, save_shard
+
+
+class ShardWriter:
+    """
+    Background thread that saves embedding shards while the GPU encodes the next batch.
+
+    `submit` starts a non-blocking device-to-host copy into pinned memory and returns
+    immediately; the writer thread waits for that copy, converts to the storage dtype,
+    saves the shard and records it in the manifest. The queue is bounded, so a slow disk
+    applies back-pressure instead of accumulating batches in host memory.
+    """
+
+    def __init__(self, storage_dtype: str = "float16", manifest=None, max_pending: int = 4):
+        self.storage_dtype = storage_dtype
+        self.manifest = manifest
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.num_written = 0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self._run, name="shard-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, embeddings: torch.Tensor, output_path: str, start_row: int):
+        if self.error is not None:
+            raise RuntimeError("Shard writer failed") from self.error
+        event = None
+        if embeddings.is_cuda:
+            host = torch.empty(embeddings.shape, dtype=embeddings.dtype, pin_memory=True)
+            host.copy_(embeddings, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            embeddings = host
+        self.queue.put((embeddings, event, output_path, start_row))
+
+    def is_done(self, output_path: str, start_row: int, num_rows: int) -> bool:
+        """Whether a previous run already wrote these rows, for --resume."""
+        if not os.path.exists(output_path):
+            return False
+        if self.manifest is not None and not self.manifest.has_shard(output_path):
+            # written before manifests existed, or by a run killed between manifest flushes
+            shard = load_shard(output_path, mmap=True)
+            dtype = "int8" if isinstance(shard, QuantizedRows) else str(shard.dtype).replace("torch.", "")
+            self.manifest.add_shard(output_path, start_row, *shard.shape, dtype)
+        return True
+
+    def _write(self, embeddings: torch.Tensor, output_path: str, start_row: int):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # write-then-rename, so a killed worker never leaves a truncated shard for --resume to skip
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        save_shard(embeddings, tmp_path, self.storage_dtype)
+        os.replace(tmp_path, output_path)
+        if self.manifest is not None:
+            self.manifest.add_shard(output_path, start_row, *embeddings.shape, self.storage_dtype)
+
+    def _finish(self):
+        if self.manifest is not None:
+            self.manifest.flush()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            embeddings, event, output_path, start_row = item
+            if self.error is not None:
+                continue
+            try:
+                start_time = time.time()
+                if event is not None:
+                    event.synchronize()
+                self._write(embeddings, output_path, start_row)
+                self.num_written += 1
+                self.write_time += time.time() - start_time
+            except Exception as e:
+                logging.error(f"Failed to write {output_path}: {e}")
+                self.error = e
+        try:
+            self._finish()
+        except Exception as e:
+            logging.error(f"Failed to finish writing: {e}")
+            self.error = self.error or e
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def close(self):
+        """Wait for every submitted shard, flush the manifest and re-raise any write error."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Shard writer failed") from self.error
+        logging.info(f"Wrote {self.num_written} shards in {self.write_time:.2f} seconds of writer time")
+
+
+if __name__ == "__main__":
+    # A run killed between manifest flushes, on top of shards from before manifests, then resumed:
+    #   python -m data.shard_writer
+    import tempfile
+    from .manifest import ManifestWriter, consolidate_manifest, describe_embedding_dir, load_manifest
+
+    num_shards, rows, dim = 10, 100, 8
+    vectors = torch.randn(num_shards * rows, dim)
+    with tempfile.TemporaryDirectory() as embedding_dir:
+        paths = [os.path.join(embedding_dir, f"{idx}.pt") for idx in range(num_shards)]
+        # shards 0-2 predate manifests
+        for idx in range(3):
+            save_shard(vectors[idx * rows:(idx + 1) * rows], paths[idx])
+        # shards 3-8 by a run killed after its first manifest flush: 7 and 8 are on disk but unlisted
+        killed = ManifestWriter(embedding_dir, 0, num_shards * rows, flush_every=4)
+        for idx in range(3, 9):
+            save_shard(vectors[idx * rows:(idx + 1) * rows], paths[idx])
+            killed.add_shard(paths[idx], idx * rows, rows, dim, "float16")
+        assert len(load_manifest(embedding_dir)["shards"]) == 4
+
+        writer = ShardWriter(manifest=ManifestWriter(embedding_dir, 0, num_shards * rows))
+        for idx in range(num_shards):
+            if not writer.is_done(paths[idx], idx * rows, rows):
+                writer.submit(vectors[idx * rows:(idx + 1) * rows], paths[idx], idx * rows)
+        writer.close()
+        assert writer.num_written == 1, f"Resume rewrote {writer.num_written} shards, only shard {num_shards - 1} was missing"
+        problems = consolidate_manifest(embedding_dir, num_shards * rows)
+        assert not problems, problems
+        assert describe_embedding_dir(embedding_dir) == {"num_rows": num_shards * rows, "dim": dim}
+    print("Resumed shards are recorded in the manifest: OK")
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import logging
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .embedding_store import (NUMPY_DTYPES, STORE_DATA_FILE, STORE_FORMAT, STORE_SCALES_FILE, STORE_VERSION, has_store,
+                              quantize_rows, store_shard_rows, write_header)
+from .shard_writer import ShardWriter
+
+# While encode.py writes a store in place, the directory holds, next to the preallocated
+# embeddings.bin (and embeddings.scales.bin):
+#   embeddings.partial.json   row count, dim, dtype and source, fixed by the first writer
+#   embeddings.done.bin       [num_rows] uint8, 1 once a row is durably written
+#   embeddings.lock           taken by the writer that allocates the files
+# finalize_store() replaces these with the regular embeddings.json header once every row is done.
+# Writers share these files, possibly across hosts on NFS, so each one only ever writes the
+# exact bytes of its own rows (pwrite) instead of write-back of whole memory-mapped pages.
+STORE_PARTIAL_HEADER_FILE = "embeddings.partial.json"
+STORE_DONE_FILE = "embeddings.done.bin"
+STORE_LOCK_FILE = "embeddings.lock"
+
+
+def _read_partial_header(embedding_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(embedding_dir, STORE_PARTIAL_HEADER_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view, offset = view[written:], offset + written
+
+
+def _allocate(path: str, num_bytes: int):
+    # sparse file: blocks are only allocated as rows are written
+    with open(path, "wb") as f:
+        f.truncate(num_bytes)
+
+
+class StoreWriter(ShardWriter):
+    """
+    ShardWriter that writes each batch in place into one preallocated packed store of
+    `num_rows` rows (the full CSV), instead of one `{idx}.pt` file per batch.
+
+    Any number of processes may write disjoint row ranges of the same store. Rows are marked
+    in the completion file only after their values are flushed, so `is_done` (and --resume)
+    never trusts a row a killed worker left half written.
+    """
+
+    def __init__(self, embedding_dir: str, num_rows: int, storage_dtype: str = "float16", source: Optional[dict] = None,
+                 max_pending: int = 4, flush_every: int = 16, lock_timeout: float = 600):
+        self.embedding_dir = embedding_dir
+        self.num_rows = num_rows
+        self.source = source or {}
+        self.flush_every = flush_every
+        self.lock_timeout = lock_timeout
+        self._values_fd = self._scales_fd = self._done_fd = None
+        self._row_bytes = None
+        self._unflushed = []
+        os.makedirs(embedding_dir, exist_ok=True)
+        super().__init__(storage_dtype, manifest=None, max_pending=max_pending)
+        if _read_partial_header(embedding_dir) is not None:
+            self._open()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.embedding_dir, name)
+
+    def _create(self, dim: int):
+        """Allocate the store, or wait for the writer that won the lock to do so."""
+        try:
+            fd = os.open(self._path(STORE_LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            deadline = time.time() + self.lock_timeout
+            while _read_partial_header(self.embedding_dir) is None:
+                assert time.time() < deadline, f"Timed out waiting for another writer to allocate {self.embedding_dir}; remove {STORE_LOCK_FILE} if it died"
+                time.sleep(0.5)
+            return
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{os.getpid()}")
+        itemsize = np.dtype(NUMPY_DTYPES[self.storage_dtype]).itemsize
+        _allocate(self._path(STORE_DATA_FILE), self.num_rows * dim * itemsize)
+        if self.storage_dtype == "int8":
+            _allocate(self._path(STORE_SCALES_FILE), self.num_rows * 4)
+        _allocate(self._path(STORE_DONE_FILE), self.num_rows)
+        header = {"format": STORE_FORMAT, "version": STORE_VERSION, "num_rows": self.num_rows, "dim": dim,
+                  "dtype": self.storage_dtype, "source": self.source}
+        tmp_path = self._path(STORE_PARTIAL_HEADER_FILE + f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(header, f, indent=2)
+        os.replace(tmp_path, self._path(STORE_PARTIAL_HEADER_FILE))
+        logging.info(f"Allocated {self.num_rows} x {dim} {self.storage_dtype} store in {self.embedding_dir}")
+
+    def _open(self, dim: Optional[int] = None):
+        header = _read_partial_header(self.embedding_dir)
+        if header is None:
+            assert dim is not None
+            self._create(dim)
+            header = _read_partial_header(self.embedding_dir)
+        assert header["num_rows"] == self.num_rows and header["dtype"] == self.storage_dtype, \
+            f"{self.embedding_dir} was allocated as {header['num_rows']} {header['dtype']} rows, this writer uses {self.num_rows} {self.storage_dtype} rows"
+        assert dim is None or header["dim"] == dim, f"{self.embedding_dir} was allocated with dim {header['dim']}, got {dim}"
+        self._row_bytes = header["dim"] * np.dtype(NUMPY_DTYPES[self.storage_dtype]).itemsize
+        self._values_fd = os.open(self._path(STORE_DATA_FILE), os.O_RDWR)
+        if self.storage_dtype == "int8":
+            self._scales_fd = os.open(self._path(STORE_SCALES_FILE), os.O_RDWR)
+        self._done_fd = os.open(self._path(STORE_DONE_FILE), os.O_RDWR)
+
+    def is_done(self, output_path: str, start_row: int, num_rows: int) -> bool:
+        if self._done_fd is None:
+            if _read_partial_header(self.embedding_dir) is None:
+                return False
+            self._open()
+        done = os.pread(self._done_fd, num_rows, start_row)
+        return len(done) == num_rows and bool(np.frombuffer(done, dtype=np.uint8).all())
+
+    def _write(self, embeddings: torch.Tensor, output_path: str, start_row: int):
+        if self._values_fd is None:
+            self._open(embeddings.shape[1])
+        end_row = start_row + embeddings.shape[0]
+        assert end_row <= self.num_rows, f"Rows [{start_row}, {end_row}) are outside the {self.num_rows}-row store {self.embedding_dir}"
+        if self.storage_dtype == "int8":
+            values, scales = quantize_rows(embeddings)
+            _pwrite(self._scales_fd, scales.contiguous().numpy().tobytes(), start_row * 4)
+        else:
+            values = embeddings.half()
+        _pwrite(self._values_fd, values.contiguous().numpy().tobytes(), start_row * self._row_bytes)
+        self._unflushed.append((start_row, end_row))
+        if len(self._unflushed) >= self.flush_every:
+            self._flush()
+
+    def _flush(self):
+        if not self._unflushed:
+            return
+        # values first, so a row is never marked done before it is on disk
+        os.fsync(self._values_fd)
+        if self._scales_fd is not None:
+            os.fsync(self._scales_fd)
+        for start_row, end_row in self._unflushed:
+            _pwrite(self._done_fd, b"\x01" * (end_row - start_row), start_row)
+        os.fsync(self._done_fd)
+        self._unflushed = []
+
+    def _finish(self):
+        self._flush()
+        for fd in (self._values_fd, self._scales_fd, self._done_fd):
+            if fd is not None:
+                os.close(fd)
+        self._values_fd = self._scales_fd = self._done_fd = None
+
+
+def finalize_store(embedding_dir: str) -> bool:
+    """
+    Stamp an in-place store complete by writing its embeddings.json header, once every row is
+    done. Safe to call from every writer; returns whether the store is complete.
+    """
+    if has_store(embedding_dir):
+        return True
+    header = _read_partial_header(embedding_dir)
+    if header is None:
+        logging.warning(f"No store is being written in {embedding_dir}")
+        return False
+    try:
+        done = np.memmap(os.path.join(embedding_dir, STORE_DONE_FILE), dtype=np.uint8, mode="r", shape=(header["num_rows"],))
+    except FileNotFoundError:
+        # another writer stamped it between our checks
+        return has_store(embedding_dir)
+    missing = int(header["num_rows"] - np.count_nonzero(done))
+    if missing:
+        logging.info(f"{embedding_dir}: {missing} of {header['num_rows']} rows not written yet, store left incomplete")
+        return False
+    del done
+    # fixed row ranges stand in for source shards as the streaming unit of work
+    header["shards"] = [{"rows": rows} for rows in store_shard_rows(header)]
+    write_header(embedding_dir, header)
+    for name in (STORE_DONE_FILE, STORE_PARTIAL_HEADER_FILE, STORE_LOCK_FILE):
+        try:
+            os.remove(os.path.join(embedding_dir, name))
+        except FileNotFoundError:
+            pass
+    logging.info(f"Stamped {embedding_dir} complete: {header['num_rows']} x {header['dim']} {header['dtype']}")
+    return True
+
+
+if __name__ == "__main__":
+    # Two writers fill interleaved batches of the same stores, which are then streamed back:
+    #   python -m data.store_writer
+    import tempfile
+    from .embedding_data import StreamingVLEmbeddingDataset
+    from .embedding_store import STORE_RANGE_ROWS, open_store, read_header
+
+    num_rows, dim, batch_size = 2 * STORE_RANGE_ROWS + 1000, 8, 1000
+    text = torch.randn(num_rows, dim, generator=torch.Generator().manual_seed(0))
+    with tempfile.TemporaryDirectory() as workdir:
+        text_dir, image_dir = os.path.join(workdir, "text"), os.path.join(workdir, "image")
+        for embedding_dir, storage_dtype, vectors in ((text_dir, "int8", text), (image_dir, "float16", 2 * text)):
+            writers = [StoreWriter(embedding_dir, num_rows, storage_dtype) for _ in range(2)]
+            for n, start_row in enumerate(range(0, num_rows, batch_size)):
+                writers[n % 2].submit(vectors[start_row:start_row + batch_size], "", start_row)
+            for writer in writers:
+                writer.close()
+            reopened = StoreWriter(embedding_dir, num_rows, storage_dtype)
+            assert reopened.is_done("", 0, num_rows)
+            reopened.close()
+            assert finalize_store(embedding_dir), f"{embedding_dir} was not stamped complete"
+            assert len(read_header(embedding_dir)["shards"]) == 3
+            stored = open_store(embedding_dir).to(torch.float32)
+            assert torch.allclose(stored, vectors, atol=0.05), f"{embedding_dir}: max error {(stored - vectors).abs().max().item()}"
+
+        dataset = StreamingVLEmbeddingDataset([text_dir], [image_dir], batch_size=batch_size, shuffle_buffer=4 * batch_size, drop_last=False)
+        assert len(dataset.text_reader.shard_ranges) == 3
+        seen, total = 0, torch.zeros(dim)
+        for text_batch, image_batch in dataset:
+            text_batch = text_batch.to(torch.float32)
+            # text row i is paired with image row i, written as 2 * text
+            assert torch.allclose(image_batch.float(), 2 * text_batch, atol=0.1)
+            seen += len(text_batch)
+            total += text_batch.sum(dim=0)
+        assert seen == num_rows, f"Streamed {seen} of {num_rows} rows"
+        assert torch.allclose(total, text.sum(dim=0), atol=num_rows * 0.01)
+    print("StoreWriter stores stream back through StreamingVLEmbeddingDataset: OK")
@@ -58,6 +58,23 @@ def read_csv_column(file_path, column_name, chunksize=None):
     print(f"Time taken to read '{column_name}' column: {elapsed_time:.2f} seconds")
     return column_data
 
+def read_csv_columns(file_path, column_names):
+    """Read several columns in one pass over the CSV; returns {column_name: list}."""
+    start_time = time.time()
+    frame = pd.read_csv(file_path, usecols=list(column_names))
+    columns = {column_name: frame[column_name].tolist() for column_name in column_names}
+    print(f"Time taken to read columns {list(column_names)}: {time.time() - start_time:.2f} seconds")
+    return columns
+
+def load_caption_columns(data_config, source_captions):
+    """Captions of every requested column, with the instruction prefix, as {column: sentences}."""
+    data_file = data_config['annotation']
+    if not data_file.endswith('.csv'):
+        assert len(source_captions) == 1, f'{data_file} has a single caption field, cannot encode columns {source_captions}'
+        return {source_captions[0]: load_data(data_config, source_captions[0], 'text')[0]}
+    columns = read_csv_columns(data_file, source_captions)
+    return {column: [instruction + sentence for sentence in sentences] for column, sentences in columns.items()}
+
 def load_csv_data(data_file, image_dir, source_caption, domain):
     # Read image paths and captions using read_csv_column function
     images = []
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+# Coordinator-free task queue on a shared filesystem. Task t covers rows
+# [t * task_rows, (t + 1) * task_rows); a worker owns it while it holds `leases/t.lease`
+# (created with O_EXCL) and finishes it by writing `done/t.json`.
+QUEUE_CONFIG_FILE = "config.json"
+QUEUE_COMPLETE_FILE = "COMPLETE"
+
+
+@dataclass
+class Task:
+    index: int
+    start: int
+    end: int
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json_atomic(path: str, obj: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+class WorkQueue:
+    """
+    Lease-file work queue for encode.py.
+
+    Any number of workers, on one node or many sharing the filesystem, call `claim()` until
+    it returns None, which happens once every task is done. A live worker refreshes its lease's mtime from a heartbeat thread; a lease
+    older than `lease_timeout` seconds belongs to a dead worker and is reclaimed by renaming it
+    away, which only one of the competing workers can do.
+    """
+
+    def __init__(self, queue_dir: str, num_rows: int, task_rows: int, lease_timeout: float = 900, worker_id: Optional[str] = None, extra_config: Optional[dict] = None):
+        self.queue_dir = queue_dir
+        self.lease_dir = os.path.join(queue_dir, "leases")
+        self.done_dir = os.path.join(queue_dir, "done")
+        self.num_rows = num_rows
+        self.task_rows = task_rows
+        self.num_tasks = (num_rows + task_rows - 1) // task_rows
+        self.lease_timeout = lease_timeout
+        self.worker_id = worker_id or default_worker_id()
+        self.extra_config = extra_config or {}
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self._check_config()
+
+        self._current = None
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _check_config(self):
+        # the first worker fixes the task layout; later workers must agree with it
+        config = {"num_rows": self.num_rows, "task_rows": self.task_rows, **self.extra_config}
+        path = os.path.join(self.queue_dir, QUEUE_CONFIG_FILE)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, "w") as f:
+                json.dump(config, f)
+        except FileExistsError:
+            with open(path, "r") as f:
+                existing = json.load(f)
+            assert existing == config, f"Work queue {self.queue_dir} was created with {existing}, this worker uses {config}"
+
+    def _lease_path(self, index: int) -> str:
+        return os.path.join(self.lease_dir, f"{index}.lease")
+
+    def _done_path(self, index: int) -> str:
+        return os.path.join(self.done_dir, f"{index}.json")
+
+    def _task(self, index: int) -> Task:
+        return Task(index, index * self.task_rows, min(self.num_rows, (index + 1) * self.task_rows))
+
+    def is_done(self, index: int) -> bool:
+        return os.path.exists(self._done_path(index))
+
+    def num_done(self) -> int:
+        return sum(self.is_done(t) for t in range(self.num_tasks))
+
+    def _try_lease(self, index: int) -> bool:
+        try:
+            fd = os.open(self._lease_path(index), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        return True
+
+    def _is_stale(self, path: str) -> bool:
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def _reclaim(self, index: int) -> bool:
+        """Break a stale lease; only the worker whose rename succeeds may re-create it."""
+        path = self._lease_path(index)
+        if not self._is_stale(path):
+            return False
+        tomb = f"{path}.stale.{self.worker_id}"
+        try:
+            os.rename(path, tomb)
+        except FileNotFoundError:
+            return False
+        if not self._is_stale(tomb):
+            # another worker re-leased the task between our stat and rename: give it back
+            try:
+                os.link(tomb, path)
+            except FileExistsError:
+                pass
+            os.remove(tomb)
+            return False
+        os.remove(tomb)
+        logging.warning(f"Reclaimed stale lease of task {index}")
+        return self._try_lease(index)
+
+    def claim(self) -> Optional[Task]:
+        """
+        Lease the next unfinished task. While the only unfinished tasks are leased by others,
+        wait and retry, so a lease left by a crashed worker is reclaimed once it goes stale;
+        return None only when every task is done.
+        """
+        assert self._current is None, "complete() the current task before claiming another"
+        while True:
+            leased = 0
+            for index in range(self.num_tasks):
+                if self.is_done(index):
+                    continue
+                if self._try_lease(index) or self._reclaim(index):
+                    if self.is_done(index):
+                        # finished between our check and the lease
+                        os.remove(self._lease_path(index))
+                        continue
+                    self._current = self._task(index)
+                    logging.info(f"Worker {self.worker_id} claimed task {index} rows [{self._current.start}, {self._current.end})")
+                    return self._current
+                leased += 1
+            if leased == 0:
+                return None
+            logging.info(f"{leased} unfinished tasks are leased by other workers, waiting in case a lease goes stale")
+            time.sleep(self.lease_timeout / 4)
+
+    def owns(self, task: Task) -> bool:
+        try:
+            with open(self._lease_path(task.index), "r") as f:
+                return f.read() == self.worker_id
+        except FileNotFoundError:
+            return False
+
+    def complete(self, task: Task):
+        if not self.owns(task):
+            logging.warning(f"Worker {self.worker_id} lost the lease of task {task.index} before finishing it")
+        _write_json_atomic(self._done_path(task.index), {"start": task.start, "end": task.end, "worker": self.worker_id, "time": time.time()})
+        if self.owns(task):
+            os.remove(self._lease_path(task.index))
+        self._current = None
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_timeout / 4):
+            task = self._current
+            if task is not None and self.owns(task):
+                try:
+                    os.utime(self._lease_path(task.index))
+                except FileNotFoundError:
+                    pass
+
+    def finalize(self) -> bool:
+        """Stop heartbeats; returns True for the one worker that observes the queue complete."""
+        self._stop.set()
+        if self.num_done() < self.num_tasks:
+            logging.info(f"{self.num_done()}/{self.num_tasks} tasks done, other workers are still running")
+            return False
+        try:
+            fd = os.open(os.path.join(self.queue_dir, QUEUE_COMPLETE_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        return True
@@ -7,9 +7,19 @@ import time
 from tqdm import tqdm
 from model import SentenceEmbedding, ImageEmbedding
 from train.logger import setup_logging
+from train.timing import StageTimer, synchronize
 from data.data_config import DATADIR
-from data.utils import load_data
+from data.utils import load_data, load_caption_columns
 from data.image_dataset import create_image_dataloader
+from data.embedding_store import STORAGE_DTYPES
+from data.manifest import ManifestWriter, consolidate_manifest
+from data.work_queue import WorkQueue
+from data.caption_cache import CaptionEmbeddingCache
+from data.shard_writer import ShardWriter
+from data.store_writer import StoreWriter, finalize_store
+from data.embedding_store import has_store
+from data.pixel_cache import PixelCache, processor_spec
+from data.batched_processor import BatchedImageProcessor
 import warnings
 setup_logging(log_file=None, level=logging.INFO)
 warnings.filterwarnings("ignore", message="Corrupt EXIF data")
@@ -19,39 +29,95 @@ def parse_args():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', type=str, required=True, help='Data type')
-    parser.add_argument('--vision_model_name', type=str, required=True, help='Model name')
+    parser.add_argument('--vision_model_name', type=str, nargs='+', required=True, help='Model name(s); several vision models share one decode of every image')
     parser.add_argument('--text_model_name', type=str, required=True, help='Model name')
     parser.add_argument('--resume', action='store_true', help='Resume from existing embeddings')
     parser.add_argument('--start_index', type=int, default=0, help='Start index for data processing')
     parser.add_argument('--end_index', type=int, default=None, help='End index for data processing')
     parser.add_argument('--domain', type=str, choices=['text', 'image'], required=True, help='Domain to encode')
-    parser.add_argument('--source_caption', type=str, choices=['raw_caption', 'shortIB_captions', 'longIB_captions', 'shortSV_captions', 'longSV_captions', 'shortLLA_captions', 'longLLA_captions','caption'], required=True, help='Source caption')
+    parser.add_argument('--source_caption', type=str, nargs='+', choices=['raw_caption', 'shortIB_captions', 'longIB_captions', 'shortSV_captions', 'longSV_captions', 'shortLLA_captions', 'longLLA_captions','caption'], required=True, help='Source caption column(s); several columns are encoded in one run, each into its own directory')
     parser.add_argument('--save_name', type=str, default=None, help='Save name')
     parser.add_argument('--batch_size', type=int, default=32, help='Save batch size')
-    parser.add_argument('--agg_mode', type=str, default='concat', help='Aggregation mode')
+    parser.add_argument('--agg_mode', type=str, default='concat', help='Aggregation mode; concat stores cls and patch-mean side by side, so training can select either with --image-agg-mode')
     parser.add_argument('--throughput', action='store_true', help='Calculate throughput')
+    parser.add_argument('--timing_log', type=str, default=None, help='Append per-batch stage timings (JSONL) to this file; implied stage timing with --throughput')
+    parser.add_argument('--storage_dtype', type=str, default='float16', choices=STORAGE_DTYPES, help='Shard storage dtype; int8 stores per-row scaled values')
+    parser.add_argument('--num_workers', type=int, default=8, help='Image decoding and preprocessing workers')
+    parser.add_argument('--prefetch_factor', type=int, default=4, help='Batches prefetched per image worker')
+    parser.add_argument('--direct_store', action='store_true', help='Write rows in place into one preallocated store per output dir instead of {idx}.pt shards')
+    parser.add_argument('--write_queue', type=int, default=4, help='Max encoded batches waiting for the shard writer')
+    parser.add_argument('--length_bucketing', action='store_true', help='Encode captions in batches of similar token length (text only)')
+    parser.add_argument('--bucket_shards', type=int, default=16, help='Number of save batches sorted by length together')
+    parser.add_argument('--encode_batch_size', type=int, default=None, help='Max captions per bucketed batch, defaults to --batch_size')
+    parser.add_argument('--max_tokens', type=int, default=None, help='Max padded tokens per bucketed batch')
+    parser.add_argument('--caption_cache', type=str, default=None, help='Directory of the content-addressed caption embedding cache, e.g. ./data/tensor_data/caption_cache')
+    parser.add_argument('--work_queue', action='store_true', help='Share the index range with every worker on this output directory via lease files')
+    parser.add_argument('--task_rows', type=int, default=65536, help='Rows per work-queue task, a multiple of --batch_size')
+    parser.add_argument('--lease_timeout', type=float, default=900, help='Seconds without heartbeat before a lease is reclaimed')
+    parser.add_argument('--worker_id', type=str, default=None, help='Work-queue worker name, defaults to hostname-pid')
+    parser.add_argument('--pixel_cache', type=str, default=None, help='Root of decoded-pixel caches built by data/pixel_cache.py, e.g. ./data/pixel_cache')
+    parser.add_argument('--jpeg_draft', action='store_true', help='Decode JPEGs at the smallest DCT scale covering every model\'s resize (resize + center-crop processors only)')
+    parser.add_argument('--fast_preprocess', action='store_true', help='Crop to uint8 in the workers and normalize whole batches (resize + center-crop processors only)')
+    parser.add_argument('--preprocess_backend', type=str, default='pil', choices=['pil', 'tensor'],
+                        help='With --fast_preprocess: resize with PIL in the workers, or with batched torch interpolation on --preprocess_device')
+    parser.add_argument('--preprocess_device', type=str, default='cuda',
+                        help='Device of the tensor backend; on a GPU the workers only decode and whole batches are resized there')
     return parser.parse_args()
 
-def process_batch(data, start_index, batch_size, output_dir, encode_function, resume, throughput=False):
-    idx = start_index // batch_size
+def is_done(writer, output_path, start_row, num_rows):
+    # shard files without a writer (--throughput), else the writer's own record (shard file or store rows)
+    if writer is None:
+        return os.path.exists(output_path)
+    return writer.is_done(output_path, start_row, num_rows)
+
+def process_caption_columns(columns, start_index, batch_size, output_dirs, encode_function, resume, throughput=False, writers=None, shards_per_call=1, timer=None):
+    """
+    Encode parallel caption columns (the same rows from different sources) into shards of
+    batch_size rows, one output dir per column. The pending shards of `shards_per_call` save
+    batches of every column go to encode_function together, so GPU batches stay full across
+    columns and a length-bucketed encoder sorts them jointly; its output, which must be in
+    input order, is split back into shards.
+    """
+    num_rows = len(columns[0])
+    first_idx = start_index // batch_size
+    writers = writers or [None] * len(columns)
+    timer = timer or StageTimer(enabled=False)
+    sync_device = 'cuda' if throughput else None
     total_time = 0
     total_samples = 0
     
-    for batch_idx in tqdm(range(0, len(data), batch_size)):  # Use batch_size for both encoding and saving
+    window_size = batch_size * shards_per_call
+    for window_start in tqdm(range(0, num_rows, window_size)):  # Use batch_size for saving
         # Save embeddings in chunks of batch_size with torch.fp16
-        
-        output_path = os.path.join(output_dir, f'{idx}.pt')
-        if resume and os.path.exists(output_path):
-            idx += 1
+        shards = []
+        for batch_idx in range(window_start, min(window_start + window_size, num_rows), batch_size):
+            for column, output_dir, writer in zip(columns, output_dirs, writers):
+                output_path = os.path.join(output_dir, f'{first_idx + batch_idx // batch_size}.pt')
+                rows = column[batch_idx:batch_idx + batch_size]
+                if resume and is_done(writer, output_path, start_index + batch_idx, len(rows)):
+                    continue
+                shards.append((rows, batch_idx, output_path, writer))
+        if not shards:
             continue
 
-        batch_data = data[batch_idx:batch_idx + batch_size]  # Use batch_size for encoding
+        batch_data = [row for rows, _, _, _ in shards for row in rows]
         
         # Measure encoding time
         start_time = time.time()
-        with torch.cuda.amp.autocast():  # Enable automatic mixed precision
+        with timer.stage('encode', sync_device), torch.cuda.amp.autocast():  # Enable automatic mixed precision
             with torch.no_grad():
-                batch_embeddings = encode_function(batch_data).cpu()  # Encode the entire batch
+                batch_embeddings = encode_function(batch_data)  # Encode the entire batch
+        if throughput:
+            with timer.stage('d2h', sync_device):
+                batch_embeddings.cpu()
+        else:
+            # copied to host and saved by the writer thread while the next batch encodes
+            with timer.stage('save'):
+                offset = 0
+                for rows, batch_idx, output_path, writer in shards:
+                    writer.submit(batch_embeddings[offset:offset + len(rows)], output_path, start_index + batch_idx)
+                    offset += len(rows)
+        timer.step(len(batch_data))
         end_time = time.time()
         
         # Update timing stats
@@ -65,13 +131,8 @@ def process_batch(data, start_index, batch_size, output_dir, encode_function, re
         
 
         if throughput:
-            logging.info(f"Batch {idx} throughput: {current_throughput:.2f} samples/sec, "
+            logging.info(f"Batch {first_idx + shards[0][1] // batch_size} throughput: {current_throughput:.2f} samples/sec, "
                         f"Average throughput: {avg_throughput:.2f} samples/sec")
-        else:
-            batch_embeddings = batch_embeddings.half()  # Convert to half precision
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torch.save(batch_embeddings, output_path)
-        idx += 1
     
     # Log final stats
     if total_samples > 0:
@@ -81,98 +142,252 @@ def process_batch(data, start_index, batch_size, output_dir, encode_function, re
         logging.info(f"Total samples processed: {total_samples}")
 
 
-def process_batch_image(data_loader, model, start_index, batch_size, output_dir, resume, throughput=False):
-    idx = start_index // batch_size
+def process_batch_image(image_paths, models, start_index, batch_size, output_dirs, resume, throughput=False, writers=None, num_workers=8, prefetch_factor=4, pixel_caches=None,
+                        image_processors=None, decode_min_side=None, timer=None):
+    """
+    Three-stage pipeline: DataLoader workers decode and preprocess upcoming batches, the main
+    thread runs the models, and `writers` save finished shards in the background. Each image
+    is decoded once and preprocessed separately for every model (one output dir per model).
+    """
+    first_idx = start_index // batch_size
+    writers = writers or [None] * len(models)
+    timer = timer or StageTimer(enabled=False)
+    sync_device = 'cuda' if throughput else None
+    # only decode the batches where some model's shard is still missing
+    batches = []
+    for n, batch_start in enumerate(range(0, len(image_paths), batch_size)):
+        batch_rows = min(batch_size, len(image_paths) - batch_start)
+        pending = [m for m, output_dir in enumerate(output_dirs)
+                   if not (resume and is_done(writers[m], os.path.join(output_dir, f'{first_idx + n}.pt'), start_index + batch_start, batch_rows))]
+        if not pending:
+            continue
+        batches.append((first_idx + n, batch_start, pending, list(range(batch_start, min(batch_start + batch_size, len(image_paths))))))
+    logging.info(f"{len(batches)} batches to encode, {len(image_paths) // batch_size + (len(image_paths) % batch_size > 0) - len(batches)} already done")
+    image_processors = image_processors or [model.image_processor for model in models]
+    data_loader = create_image_dataloader(image_paths, image_processors, num_workers=num_workers,
+                                          batch_sampler=[indices for _, _, _, indices in batches], prefetch_factor=prefetch_factor,
+                                          pixel_cache=pixel_caches, decode_min_side=decode_min_side, record_timings=timer.enabled)
+
     total_time = 0
+    wait_time = 0
     total_samples = 0
-    
-    for batch_data in tqdm(data_loader):  # Use batch_size for both encoding and saving
-        # Save embeddings in chunks of batch_size with torch.fp16
-        output_path = os.path.join(output_dir, f'{idx}.pt')
-        if resume and os.path.exists(output_path):
-            print(f'{output_path} already exists, skipping...')
-            idx += 1
-            continue
-        
-        # Measure encoding time
+    start_time = time.time()
+    for (idx, batch_start, pending, indices), model_inputs in zip(batches, tqdm(data_loader)):
+        batch_ready = time.time()
+        wait_time += batch_ready - start_time
+        if timer.enabled:
+            # decode/preprocess/collate are worker seconds, spread over num_workers processes
+            model_inputs, worker_timings = model_inputs
+            timer.add('data_wait', batch_ready - start_time)
+            for stage, seconds in worker_timings.items():
+                timer.add(stage, seconds)
+        for m in pending:
+            model = models[m]
+            batch_data = model_inputs[m]
+            if isinstance(batch_data, list):
+                # whole decoded images: the BatchedImageProcessor resizes, crops and normalizes them on its device
+                with timer.stage('preprocess_device', sync_device):
+                    batch_data = image_processors[m](batch_data)['pixel_values']
+            with timer.stage('h2d', sync_device):
+                batch_data = batch_data.to(model.device, dtype=model.model.dtype, non_blocking=True)
+            with timer.stage('forward', sync_device), torch.cuda.amp.autocast():  # Enable automatic mixed precision
+                with torch.no_grad():
+                    batch_embeddings = model(batch_data)  # Encode the entire batch
+            if throughput:
+                with timer.stage('d2h', sync_device):
+                    batch_embeddings.cpu()
+            else:
+                with timer.stage('save'):
+                    writers[m].submit(batch_embeddings, os.path.join(output_dirs[m], f'{idx}.pt'), start_index + batch_start)
+        if throughput:
+            synchronize(sync_device)
+        timer.step(len(indices), batch=idx)
         start_time = time.time()
-        batch_data = batch_data.to('cuda')
-        with torch.cuda.amp.autocast():  # Enable automatic mixed precision
-            with torch.no_grad():
-                batch_embeddings = model(batch_data).cpu()  # Encode the entire batch
-        end_time = time.time()
-        
-        # Update timing stats
-        batch_time = end_time - start_time
-        total_time += batch_time
-        total_samples += batch_size
-        
-        # Calculate and log throughput
-        current_throughput = batch_size / batch_time
-        avg_throughput = total_samples / total_time
-        
-        logging.info(f"Batch {idx} throughput: {current_throughput:.2f} samples/sec, "
-                    f"Average throughput: {avg_throughput:.2f} samples/sec")
-        
-        if not throughput:
-            logging.info(f"Batch {idx} processing time: {batch_time:.2f} seconds")
-            batch_embeddings = batch_embeddings.half()  # Convert to half precision
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torch.save(batch_embeddings, output_path)
-        idx += 1
+        total_time += start_time - batch_ready
+        total_samples += len(indices)
+
+        if throughput:
+            logging.info(f"Batch {idx} throughput: {len(indices) / (start_time - batch_ready):.2f} images/sec through {len(pending)} models, "
+                         f"Average throughput: {total_samples / total_time:.2f} images/sec")
     
     # Log final stats
     if total_samples > 0:
-        final_throughput = total_samples / total_time
-        logging.info(f"Final average throughput: {final_throughput:.2f} samples/sec")
-        logging.info(f"Total processing time: {total_time:.2f} seconds")
+        logging.info(f"Final average throughput: {total_samples / (total_time + wait_time):.2f} images/sec "
+                     f"({total_samples / total_time:.2f} images/sec of encode time) through {len(models)} models")
+        logging.info(f"Total processing time: {total_time:.2f} seconds, waiting for data: {wait_time:.2f} seconds")
         logging.info(f"Total samples processed: {total_samples}")
 
+def manifest_source(args, model_name, column):
+    # where the rows came from, so a manifest alone identifies the CSV slice it covers
+    return {'data': args.data, 'annotation': DATADIR[args.data]['annotation'], 'column': column, 'model': model_name, 'batch_size': args.batch_size}
+
+def run_encoding(args, columns, start_index, output_dirs, sources, encode_range, total_rows):
+    """
+    Encode parallel `columns` (rows start_index..) into their output_dirs, either as one range
+    or, with --work_queue, as leased tasks shared with every other worker of the same job. The
+    queue lives in the first output dir. With --direct_store every process writes its rows into
+    one store of `total_rows` rows per output dir, stamped complete by whichever finishes it.
+    """
+    num_rows = len(columns[0])
+
+    def make_writers(row_start, row_end):
+        if args.direct_store:
+            return [StoreWriter(output_dir, total_rows, args.storage_dtype, source=source, max_pending=args.write_queue)
+                    for output_dir, source in zip(output_dirs, sources)]
+        return [ShardWriter(args.storage_dtype, ManifestWriter(output_dir, row_start, row_end, source=source), max_pending=args.write_queue)
+                for output_dir, source in zip(output_dirs, sources)]
+
+    if not args.work_queue:
+        writers = make_writers(start_index, start_index + num_rows)
+        encode_range(columns, start_index, args.resume, writers)
+        for writer in writers:
+            writer.close()
+        if args.direct_store and not args.throughput:
+            for output_dir in output_dirs:
+                finalize_store(output_dir)
+        return
+
+    assert not args.throughput, "--throughput does not write shards, there is nothing to queue"
+    assert start_index % args.batch_size == 0 and args.task_rows % args.batch_size == 0, \
+        "--start_index and --task_rows must be multiples of --batch_size so tasks map to whole shards"
+    queue = WorkQueue(os.path.join(output_dirs[0], '_queue'), num_rows, args.task_rows, lease_timeout=args.lease_timeout, worker_id=args.worker_id,
+                      extra_config={'output_dirs': [os.path.basename(d) for d in output_dirs]})
+    while (task := queue.claim()) is not None:
+        task_start = start_index + task.start
+        writers = make_writers(task_start, start_index + task.end)
+        # a reclaimed task keeps the shards its previous owner finished
+        encode_range([column[task.start:task.end] for column in columns], task_start, True, writers)
+        for writer in writers:
+            writer.close()
+        queue.complete(task)
+    if queue.finalize():
+        for output_dir in output_dirs:
+            if args.direct_store:
+                finalize_store(output_dir)
+                continue
+            problems = consolidate_manifest(output_dir, start_index + num_rows)
+            if problems:
+                logging.error(f"Encoding of {output_dir} finished with problems:\n  " + "\n  ".join(problems))
+            else:
+                logging.info(f"All {queue.num_tasks} tasks done, wrote {os.path.join(output_dir, 'manifest.json')}")
+
 @torch.no_grad()
-def encode_text(args, sentences, start_index):
+def encode_text(args, captions, start_index, total_rows):
+    """Encode {source_caption: sentences} with one model load, one output dir per column."""
     model_name = args.text_model_name.split('/')[-1]
-    if args.save_name:
-        output_dir = os.path.join('./data/tensor_data/text_embedding', model_name, args.data +'_'+ args.source_caption + '_' + args.save_name)
-    else:
-        output_dir = os.path.join('./data/tensor_data/text_embedding', model_name, args.data +'_'+ args.source_caption)
-    print(f"Output directory: {output_dir}")
-    if not args.resume and os.path.exists(output_dir):
+    output_dirs = {}
+    for source_caption in captions:
+        if args.save_name:
+            output_dir = os.path.join('./data/tensor_data/text_embedding', model_name, args.data +'_'+ source_caption + '_' + args.save_name)
+        else:
+            output_dir = os.path.join('./data/tensor_data/text_embedding', model_name, args.data +'_'+ source_caption)
+        print(f"Output directory: {output_dir}")
+        if has_store(output_dir) or (not args.resume and not args.work_queue and not args.direct_store and os.path.exists(output_dir)):
+            logging.info(f'{output_dir} already exists, skipping {source_caption}...')
+            continue
+        output_dirs[source_caption] = output_dir
+    if not output_dirs:
         exit()
     model = SentenceEmbedding(args.text_model_name)
     model = model.half().to('cuda')  # Move model to GPU and convert to FP16
     model.eval()
-    process_batch(sentences, start_index, args.batch_size, output_dir, model.get_sentence_embeddings, args.resume, args.throughput)
-
-# @torch.no_grad()
-# def encode_image(args, image_paths, start_index):
-#     model_name = args.vision_model_name.split('/')[-1]
-#     output_dir = os.path.join('./data/tensor_data/image_embedding', model_name, args.data + '_' + args.agg_mode)
-#     if not args.resume and os.path.exists(output_dir):
-#         logging.info(f'{output_dir} already exists, skipping...')
-#         exit()
-#     model = ImageEmbedding(args.vision_model_name, agg_mode=args.agg_mode)
-#     model = model.half().to('cuda')  # Move model to GPU and convert to FP16
-#     model.eval()
-#     image_data_loader = create_image_dataloader(image_paths, model.image_processor, batch_size=args.batch_size, num_workers=4, shuffle=False)
-#     process_batch_image(image_data_loader, model, start_index, args.batch_size, output_dir, args.resume, args.throughput)
+
+    if args.length_bucketing:
+        # sort the captions of bucket_shards shards of every column by length so batches carry little padding
+        def encode_function(batch):
+            return model.get_sentence_embeddings_bucketed(batch, args.encode_batch_size or args.batch_size, args.max_tokens)
+        shards_per_call = args.bucket_shards
+    else:
+        # shards of several columns arrive together, keep each forward at the encode batch size
+        encode_batch_size = args.encode_batch_size or args.batch_size
+        def encode_function(batch):
+            return torch.cat([model.get_sentence_embeddings(batch[i:i + encode_batch_size]) for i in range(0, len(batch), encode_batch_size)])
+        shards_per_call = 1
+    cache = None
+    if args.caption_cache:
+        # only captions missing from the cache reach the model (and the length buckets)
+        cache = CaptionEmbeddingCache(os.path.join(args.caption_cache, model_name), args.text_model_name)
+        encode_function = cache.cached(encode_function)
+
+    timer = StageTimer(args.timing_log, enabled=args.throughput or args.timing_log is not None)
+
+    def encode_range(columns, row_start, resume, writers):
+        process_caption_columns(columns, row_start, args.batch_size, list(output_dirs.values()), encode_function, resume, args.throughput, writers, shards_per_call,
+                                timer=timer)
+
+    sources = [manifest_source(args, args.text_model_name, source_caption) for source_caption in output_dirs]
+    run_encoding(args, [captions[source_caption] for source_caption in output_dirs], start_index, list(output_dirs.values()), sources, encode_range, total_rows)
+    timer.log_summary('captions')
+    timer.close()
+    if cache is not None:
+        cache.flush()
+        cache.log_stats()
+    if args.length_bucketing and model.bucket_stats['padded_tokens'] > 0:
+        stats = model.bucket_stats
+        logging.info(f"Length bucketing: {stats['tokens']} real of {stats['padded_tokens']} padded tokens "
+                     f"({100 * stats['tokens'] / stats['padded_tokens']:.1f}% useful)")
 
 @torch.no_grad()
-def encode_image(args, images, start_index):
-    model_name = args.vision_model_name.split('/')[-1]
-    output_dir = os.path.join('./data/tensor_data/image_embedding', model_name, args.data + '_' + args.agg_mode)
-    if not args.resume and os.path.exists(output_dir):
-        logging.info(f'{output_dir} already exists, skipping...')
+def encode_image(args, images, start_index, total_rows):
+    """Encode the images with every --vision_model_name from a single decode, one output dir per model."""
+    output_dirs = {}
+    for vision_model_name in args.vision_model_name:
+        model_name = vision_model_name.split('/')[-1]
+        output_dir = os.path.join('./data/tensor_data/image_embedding', model_name, args.data + '_' + args.agg_mode)
+        if has_store(output_dir) or (not args.resume and not args.work_queue and not args.direct_store and os.path.exists(output_dir)):
+            logging.info(f'{output_dir} already exists, skipping...')
+            continue
+        output_dirs[vision_model_name] = output_dir
+    if not output_dirs:
         exit()
-    model = ImageEmbedding(args.vision_model_name, agg_mode=args.agg_mode)
-    model = model.to('cuda')  # Move model to GPU
-    model.eval()
-    process_batch(images, start_index, args.batch_size, output_dir, model.get_visual_embeddings_from_directory, args.resume)
+    models = []
+    for vision_model_name in output_dirs:
+        model = ImageEmbedding(vision_model_name, agg_mode=args.agg_mode)
+        model = model.to('cuda')  # Move model to GPU
+        model.eval()
+        models.append(model)
+    pixel_caches = None
+    if args.pixel_cache:
+        # models whose processor is a plain resize + center crop read pre-cropped pixels of their policy
+        specs = [processor_spec(model.image_processor) for model in models]
+        pixel_caches = [PixelCache.open(args.pixel_cache, args.data, spec) if spec else None for spec in specs]
+    image_processors = [model.image_processor for model in models]
+    decode_min_side = None
+    if args.jpeg_draft:
+        specs = [processor_spec(p) for p in image_processors]
+        if all(specs):
+            decode_min_side = max(spec['resize'] for spec in specs)
+            logging.info(f"Decoding JPEGs with a shorter side of at least {decode_min_side}")
+        else:
+            logging.warning("--jpeg_draft needs resize + center-crop processors for every model, decoding at full resolution")
+    if args.fast_preprocess:
+        device = args.preprocess_device if args.preprocess_backend == 'tensor' else 'cpu'
+        image_processors = [BatchedImageProcessor.from_processor(p, backend=args.preprocess_backend, device=device) or p for p in image_processors]
+
+    timer = StageTimer(args.timing_log, enabled=args.throughput or args.timing_log is not None)
 
+    def encode_range(columns, row_start, resume, writers):
+        process_batch_image(columns[0], models, row_start, args.batch_size, list(output_dirs.values()), resume, args.throughput, writers,
+                            num_workers=args.num_workers, prefetch_factor=args.prefetch_factor, pixel_caches=pixel_caches,
+                            image_processors=image_processors, decode_min_side=decode_min_side, timer=timer)
+
+    # agg_layout 'concat' marks [cls | patch-mean] rows that training can view as cls or patch
+    sources = [dict(manifest_source(args, vision_model_name, 'Image Path'), agg_mode=args.agg_mode, agg_layout=model.agg_layout)
+               for vision_model_name, model in zip(output_dirs, models)]
+    run_encoding(args, [images], start_index, list(output_dirs.values()), sources, encode_range, total_rows)
+    timer.log_summary('images')
+    timer.close()
 
 def main():
     args = parse_args()
-    sentences, image_paths = load_data(DATADIR[args.data], args.source_caption, args.domain)
+    if args.domain == 'text':
+        captions = load_caption_columns(DATADIR[args.data], args.source_caption)
+        sentences, image_paths = captions[args.source_caption[0]], []
+    else:
+        sentences, image_paths = load_data(DATADIR[args.data], args.source_caption[0], args.domain)
     start_index = args.start_index
+    # a --direct_store store covers the whole CSV, so ranks writing index ranges share it
+    total_rows = max(len(sentences), len(image_paths))
     end_index = args.end_index if args.end_index else max(len(sentences), len(image_paths))
     logging.info(f"Start index: {start_index}, End index: {end_index}")
     logging.info(f"Number of sentences: {len(sentences)}")
@@ -181,15 +396,15 @@ def main():
         logging.warning("Only measure throughput, not saving embeddings")
     # assert begin and end 
     if args.domain == 'text':
-        logging.info(f'Encoding text data {args.data} with model {args.text_model_name} of batch size {args.batch_size}...')
-        sentences = sentences[start_index:end_index]
-        logging.info(f"First 5 items of sentences: {sentences[:5]}")
-        encode_text(args, sentences, start_index)
+        logging.info(f'Encoding text data {args.data} columns {args.source_caption} with model {args.text_model_name} of batch size {args.batch_size}...')
+        captions = {source_caption: sentences[start_index:end_index] for source_caption, sentences in captions.items()}
+        logging.info(f"First 5 items of sentences: {captions[args.source_caption[0]][:5]}")
+        encode_text(args, captions, start_index, total_rows)
     elif args.domain == 'image':
-        logging.info(f'Encoding image data {args.data} with model {args.vision_model_name} of batch size {args.batch_size}...')
+        logging.info(f'Encoding image data {args.data} with models {args.vision_model_name} of batch size {args.batch_size}...')
         image_paths = image_paths[start_index:end_index]
         logging.info(f"First 5 items of image_paths paths: {image_paths[:5]}")
-        encode_image(args, image_paths, start_index)
+        encode_image(args, image_paths, start_index, total_rows)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
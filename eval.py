@@ -73,6 +73,12 @@ def parse_args():
         default="evaluation/backbone_features",
         help="Path to images",
     )
+    parser.add_argument(
+        "--pixel_cache",
+        type=str,
+        default=None,
+        help="Root of decoded-pixel caches (data/pixel_cache.py) named imagenet_val, imagenetv2 and coco_val2017.",
+    )
     parser.add_argument(
         "--target-dimension",
         type=int,
@@ -199,6 +205,7 @@ def main(args):
             vision_model_name=vision_model_name,
             images_dir=imagenet_dir,
             save_dir=args.save_dir,
+            pixel_cache_root=args.pixel_cache,
             version="v1",
         )
     elif args.task.lower() == "imagenetv2":
@@ -209,6 +216,7 @@ def main(args):
             vision_model_name=vision_model_name,
             images_dir=args.dataset_root_dir,
             save_dir=args.save_dir,
+            pixel_cache_root=args.pixel_cache,
             version="v2",
         )
     elif args.task.lower() == "coco":
@@ -234,6 +242,7 @@ def main(args):
             vision_model_name=vision_model_name,
             k_vals=[1, 5, 10],
             save_dir=args.save_dir,
+            pixel_cache_root=args.pixel_cache,
         )
     elif args.task.lower() == "winoground":
         results = winoground_eval(
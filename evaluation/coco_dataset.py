@@ -20,6 +20,8 @@ class CocoDetection(VisionDataset):
             target and transforms it.
         transforms (callable, optional): A function/transform that takes input sample and its target as entry
             and returns a transformed version.
+        loader (callable, optional): Loads an image given its path, e.g. ``PixelCache.load``;
+            defaults to opening it as an RGB PIL image.
     """
 
     def __init__(
@@ -29,15 +31,20 @@ class CocoDetection(VisionDataset):
         transform: Optional[Callable] = None,
         target_transform: Optional[Callable] = None,
         transforms: Optional[Callable] = None,
+        loader: Optional[Callable] = None,
     ) -> None:
         super().__init__(root, transforms, transform, target_transform)
         from pycocotools.coco import COCO
 
+        self.loader = loader
+
         self.coco = COCO(annFile)
         self.ids = list(sorted(self.coco.imgs.keys()))
 
     def _load_image(self, id: int) -> Image.Image:
         path = self.coco.loadImgs(id)[0]["file_name"]
+        if self.loader is not None:
+            return self.loader(os.path.join(self.root, path))
         return Image.open(os.path.join(self.root, path)).convert("RGB")
 
     def _load_target(self, id: int) -> List[Any]:
@@ -5,7 +5,9 @@ from typing import List
 import os
 from tqdm import tqdm
 import torch.nn as nn
-from .utils import get_model_device, save_features, load_features
+from .utils import get_model_device, save_features, load_features, open_pixel_cache
+from data.pixel_cache import normalize_pixels
+from functools import partial
 from torch.cuda.amp import autocast
 
 
@@ -20,7 +22,7 @@ class Processor:
         else:
             return outputs['pixel_values']
 
-def coco_collate_fn(batch):
+def coco_collate_fn(batch, normalization=None):
     text_list = []
     image_list = []
     index_list = []
@@ -30,7 +32,11 @@ def coco_collate_fn(batch):
         image_list.append(image)
         index_list.append(index)
     # print(image_list)
-    images = torch.cat(image_list)
+    if normalization is not None:
+        # uint8 crops from a pixel cache
+        images = normalize_pixels(torch.stack(image_list), *normalization)
+    else:
+        images = torch.cat(image_list)
     # print(images.shape)
     images = {"pixel_values": images}
     return text_list, images, index_list
@@ -45,6 +51,7 @@ def encode_dataset(
     text_model_name: str,
     vision_model_name: str,
     save_dir: str = None,
+    collate_fn=coco_collate_fn,
 ):
     save_backbone_image_features_path = os.path.join(
         save_dir, f"{vision_model_name}/coco.pt"
@@ -72,7 +79,7 @@ def encode_dataset(
         ):
             dataloader = dutils.DataLoader(
                 dataset,
-                collate_fn=coco_collate_fn,
+                collate_fn=collate_fn,
                 batch_size=batch_size,
                 shuffle=False,
             )
@@ -179,6 +186,7 @@ def recall_at_k(
     text_model_name: str,
     vision_model_name: str,
     save_dir: str = None,
+    collate_fn=coco_collate_fn,
 ):
     print("Encoding all data...")
     image_encodings, text_encodings, text_to_image_map, image_to_text_map = (
@@ -190,6 +198,7 @@ def recall_at_k(
             text_model_name=text_model_name,
             vision_model_name=vision_model_name,
             save_dir=save_dir,
+            collate_fn=collate_fn,
         )
     )
 
@@ -267,14 +276,17 @@ def coco_eval(
     text_model_name: str = "sentence-transformers/all-mpnet-base-v2",
     vision_model_name: str = "facebook/dinov2-base",
     save_dir: str = None,
+    pixel_cache_root: str = None,
 ):
     model.eval()
     device = get_model_device(model)
     processor = Processor(model.vision_model.image_processor)
+    pixel_cache, normalization = open_pixel_cache(pixel_cache_root, "coco_val2017", model.vision_model.image_processor)
     dataset = CocoCaptions(
         root=coco_root,
         annFile=coco_ann_file,
-        transform=processor,
+        transform=processor if pixel_cache is None else None,
+        loader=pixel_cache.load if pixel_cache is not None else None,
         # Note: almost all images have 5 captions, but 12/5000 have 6, and 1/5000 has 7 - I ignore these few extra captions.
     )
     with autocast():
@@ -288,6 +300,7 @@ def coco_eval(
                 text_model_name=text_model_name,
                 vision_model_name=vision_model_name,
                 save_dir=save_dir,
+                collate_fn=partial(coco_collate_fn, normalization=normalization),
             )
     result_dict = {}
     print("Text-to-image Recall@K")
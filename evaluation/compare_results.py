@@ -0,0 +1,59 @@
+import argparse
+import json
+import sys
+
+
+def flatten_metrics(results, prefix=""):
+    metrics = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(flatten_metrics(value, prefix=f"{name}/"))
+        elif isinstance(value, (int, float)):
+            metrics[name] = float(value)
+    return metrics
+
+
+def load_epoch_metrics(json_file, epoch=None):
+    with open(json_file, "r") as f:
+        data = json.load(f)
+    if epoch is None:
+        # latest epoch written by eval.py (keys look like "epoch_12")
+        key = max(data, key=lambda k: int(k.split("_")[-1]))
+    else:
+        key = f"epoch_{epoch}"
+    return key, flatten_metrics(data[key])
+
+
+def compare_results(baseline_json, candidate_json, epoch=None, tolerance=None):
+    """
+    Print baseline vs candidate metrics from two eval.py result files.
+
+    Returns False if any shared metric of the candidate falls more than `tolerance`
+    below the baseline.
+    """
+    baseline_epoch, baseline = load_epoch_metrics(baseline_json, epoch)
+    candidate_epoch, candidate = load_epoch_metrics(candidate_json, epoch)
+    print(f"baseline:  {baseline_json} ({baseline_epoch})")
+    print(f"candidate: {candidate_json} ({candidate_epoch})")
+    print(f"{'metric':<40} {'baseline':>12} {'candidate':>12} {'delta':>10}")
+    passed = True
+    for name in sorted(set(baseline) & set(candidate)):
+        delta = candidate[name] - baseline[name]
+        flag = ""
+        if tolerance is not None and delta < -tolerance:
+            passed = False
+            flag = "  <-- regression"
+        print(f"{name:<40} {baseline[name]:>12.4f} {candidate[name]:>12.4f} {delta:>+10.4f}{flag}")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two eval.py result files, e.g. fp16 vs int8 training data.")
+    parser.add_argument("baseline", type=str, help="Result JSON of the baseline run")
+    parser.add_argument("candidate", type=str, help="Result JSON of the candidate run")
+    parser.add_argument("--epoch", type=int, default=None, help="Epoch to compare, defaults to the latest in each file")
+    parser.add_argument("--tolerance", type=float, default=None, help="Fail if a candidate metric drops more than this")
+    args = parser.parse_args()
+    if not compare_results(args.baseline, args.candidate, args.epoch, args.tolerance):
+        sys.exit(1)
@@ -11,7 +11,8 @@ from tqdm import tqdm
 import os
 from typing import Union, Optional
 import torch.nn as nn
-from .utils import get_model_device, save_features, load_features, Processor
+from .utils import get_model_device, save_features, load_features, Processor, open_pixel_cache, pixel_collate
+from functools import partial
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -163,6 +164,7 @@ def imagenet_eval(
     vision_model_name: str = "dinov2-base",
     save_dir: Optional[str] = "./evaluation/backbone_features",
     version: str = "v2",
+    pixel_cache_root: Optional[str] = None,
 ):
     if version == "v1":
         save_backbone_features_path = os.path.join(
@@ -196,16 +198,22 @@ def imagenet_eval(
 
     if not os.path.exists(save_backbone_features_path):
         print("Extracting backbone features")
+        # with a pixel cache the datasets yield uint8 crops, normalized per batch in pixel_collate
+        pixel_cache, normalization = open_pixel_cache(
+            pixel_cache_root, "imagenet_val" if version == "v1" else "imagenetv2", model.vision_model.image_processor
+        )
+        cache_kwargs = {"loader": pixel_cache.load} if pixel_cache is not None else {"transform": processor}
         if version == "v1":
             images_dataset = ImageNetWithPaths(
-                root=images_dir, split="val", transform=processor
+                root=images_dir, split="val", **cache_kwargs
             )
         else:
             images_dataset = ImageNetV2Dataset(
-            variant="matched-frequency", transform=processor, location=images_dir
+            variant="matched-frequency", location=images_dir, **cache_kwargs
         )
         loader = torch.utils.data.DataLoader(
-            images_dataset, batch_size=bs, num_workers=2
+            images_dataset, batch_size=bs, num_workers=2,
+            collate_fn=partial(pixel_collate, normalization=normalization) if pixel_cache is not None else None,
         )
         top1, top5, n = extract_and_save_backbone_features(
             model, device, loader, save_backbone_features_path, zeroshot_weights
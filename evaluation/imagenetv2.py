@@ -71,7 +71,8 @@ class ImageNetValDataset(Dataset):
 
 
 class ImageNetV2Dataset(Dataset):
-    def __init__(self, variant="matched-frequency", transform=None, location="."):
+    def __init__(self, variant="matched-frequency", transform=None, location=".", loader=None):
+        self.loader = loader
         self.dataset_root = pathlib.Path(f"{location}/imagenetv2-{variant}/")
         self.tar_root = pathlib.Path(f"{location}/imagenetv2-{variant}.tar.gz")
         self.fnames = list(self.dataset_root.glob("**/*.jpeg"))
@@ -102,7 +103,8 @@ class ImageNetV2Dataset(Dataset):
         return len(self.fnames)
 
     def __getitem__(self, i):
-        img, label = Image.open(self.fnames[i]), int(self.fnames[i].parent.name)
+        img = self.loader(str(self.fnames[i])) if self.loader is not None else Image.open(self.fnames[i])
+        label = int(self.fnames[i].parent.name)
         if self.transform is not None:
             img = self.transform(img)
         return img, label, self.fnames[i].name
\ No newline at end of file
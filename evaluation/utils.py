@@ -14,6 +14,25 @@ class Processor:
         else:
             return outputs['pixel_values'][0]
 
+def open_pixel_cache(pixel_cache_root, name, image_processor):
+    """
+    (PixelCache, (mean, std)) of eval image set `name` under the crop policy of `image_processor`,
+    or (None, None) when there is no root, the processor cannot use a cache or none was built.
+    """
+    from data.pixel_cache import PixelCache, processor_spec
+    spec = processor_spec(image_processor) if pixel_cache_root else None
+    cache = PixelCache.open(pixel_cache_root, name, spec) if spec else None
+    if cache is None:
+        return None, None
+    return cache, (spec['mean'], spec['std'])
+
+def pixel_collate(batch, normalization):
+    # (uint8 crop, *fields) items: collate as usual, then normalize the whole image batch at once
+    from torch.utils.data import default_collate
+    from data.pixel_cache import normalize_pixels
+    images, *rest = default_collate(batch)
+    return [normalize_pixels(images, *normalization), *rest]
+
 def check_epoch_exists(json_file, epoch):
     """
     检查 JSON 文件中是否已存在指定 epoch 的结果。
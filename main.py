@@ -25,6 +25,7 @@ from train.distributed import is_master, init_distributed_device, broadcast_obje
 from train.file_utils import pt_load, check_exists
 from train.train import train_one_epoch, evaluate
 from train.optimizer import Lion
+from train.feature_queue import FeatureQueue
 
 from model import create_model, create_loss, create_loss
 from data import get_data
@@ -211,7 +212,7 @@ def main(args):
     optimizer = None
     scaler = None
 
-    if getattr(args,"train_data") or args.dataset_type in ["synthetic", "embedding"]:
+    if getattr(args,"train_data") or args.dataset_type in ["synthetic", "embedding", "embedding-stream"]:
 
         exclude = lambda n, p: p.ndim < 2 or "bn" in n or "ln" in n or "bias" in n or 'logit_scale' in n
         include = lambda n, p: not exclude(n, p)
@@ -311,12 +312,16 @@ def main(args):
 
 
     loss = create_loss(args)
+    feature_queue = None
+    if args.queue_size:
+        feature_queue = FeatureQueue(args.queue_size, device, max_age=args.queue_max_age, momentum=args.queue_momentum,
+                                     model=original_model.module if args.distributed else original_model)
 
     for epoch in range(start_epoch, args.epochs):
         if is_master(args):
             logging.info(f'Start epoch {epoch}')
 
-        train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args)
+        train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args, feature_queue=feature_queue)
         completed_epoch = epoch + 1
 
         if 'val' in data and (args.val_frequency and ((epoch % args.val_frequency) == 0 or epoch == args.epochs)):
@@ -82,6 +82,9 @@ def create_loss(args):
         return SigLipLoss(
             rank=args.rank,
             world_size=args.world_size,
+            block_size=args.siglip_block_size,
+            num_negatives=args.siglip_negatives,
+            negative_sampling=args.siglip_negative_sampling,
         )
     else:
         print("Using Clip (infoNCE) loss")
@@ -92,4 +95,5 @@ def create_loss(args):
             rank=args.rank,
             world_size=args.world_size,
             use_horovod=args.horovod,
+            chunk_size=args.clip_chunk_size,
         )
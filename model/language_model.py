@@ -54,6 +54,7 @@ class SentenceEmbedding(nn.Module):
             self.model = CLIPTextModel.from_pretrained(model_name, device_map=self.device).half()
         else:
             self.model = AutoModel.from_pretrained(model_name, trust_remote_code=True, device_map=self.device).half()
+        self.bucket_stats = {'tokens': 0, 'padded_tokens': 0}
     
     def mean_pooling(self, model_output: torch.Tensor, attention_mask):
         token_embeddings = model_output[0]  # First element of model_output contains all token embeddings
@@ -76,6 +77,41 @@ class SentenceEmbedding(nn.Module):
             encoded_input = self.tokenizer(sentences, padding=True, truncation=True, max_length=1024, return_tensors='pt').to(self.device)
             return self.forward(encoded_input)
         
+    def token_lengths(self, sentences: List[str]) -> List[int]:
+        """Token count of each sentence after truncation, i.e. its length inside a padded batch."""
+        max_length = min(1024, self.tokenizer.model_max_length)
+        return [len(ids) for ids in self.tokenizer(sentences, truncation=True, max_length=max_length)['input_ids']]
+
+    def get_sentence_embeddings_bucketed(self, sentences: List[str], max_batch_size: int = 256, max_tokens: Optional[int] = None):
+        """
+        Encode sentences in batches of similar length and return embeddings in input order.
+
+        Sentences are sorted longest first, so an out-of-memory batch shows up immediately, and
+        a batch closes at `max_batch_size` sentences or once its padded size would exceed
+        `max_tokens`. Padded and real token counts accumulate in `self.bucket_stats`.
+        """
+        lengths = self.token_lengths(sentences)
+        order = sorted(range(len(sentences)), key=lambda i: lengths[i], reverse=True)
+        batches, batch = [], []
+        for i in order:
+            # the first sentence of a batch is its longest, so padded size is len(batch) * lengths[batch[0]]
+            if batch and (len(batch) == max_batch_size or (max_tokens and (len(batch) + 1) * lengths[batch[0]] > max_tokens)):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+
+        embeddings = None
+        for batch in batches:
+            batch_embeddings = self.get_sentence_embeddings([sentences[i] for i in batch])
+            if embeddings is None:
+                embeddings = batch_embeddings.new_empty((len(sentences), batch_embeddings.shape[-1]))
+            embeddings[torch.tensor(batch, device=batch_embeddings.device)] = batch_embeddings
+            self.bucket_stats['tokens'] += sum(lengths[i] for i in batch)
+            self.bucket_stats['padded_tokens'] += len(batch) * lengths[batch[0]]
+        return embeddings
+
     def forward(self, inputs):
         # Compute token embeddings
         if 'clip' in self.model_name:
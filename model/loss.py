@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -65,6 +66,78 @@ def gather_features(
     return all_image_features, all_text_features
 
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Sum over rows i of cross_entropy(logit_scale * x @ y.T, label i + label_offset), without
+    materializing the N x M logits.
+
+    Forward streams each row's logsumexp over chunk_size x chunk_size tiles with a running max and
+    keeps only the N logsumexps. Backward is the second pass: it recomputes each tile, turns it
+    into softmax - one-hot with the saved logsumexps, and accumulates the feature and scale
+    gradients tile by tile, so memory stays O(chunk_size^2 + (N + M) * dim).
+    """
+
+    @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda')
+    def forward(ctx, x, y, logit_scale, label_offset, chunk_size):
+        scale = logit_scale.float()
+        lse = torch.empty(x.shape[0], device=x.device, dtype=torch.float32)
+        for i in range(0, x.shape[0], chunk_size):
+            x_block = x[i:i + chunk_size]
+            running_max = torch.full((x_block.shape[0],), float("-inf"), device=x.device)
+            running_sum = torch.zeros(x_block.shape[0], device=x.device)
+            for j in range(0, y.shape[0], chunk_size):
+                logits = scale * (x_block @ y[j:j + chunk_size].T).float()
+                new_max = torch.maximum(running_max, logits.max(dim=1).values)
+                running_sum = running_sum * torch.exp(running_max - new_max) + torch.exp(logits - new_max.unsqueeze(1)).sum(dim=1)
+                running_max = new_max
+            lse[i:i + chunk_size] = running_max + torch.log(running_sum)
+        targets = y[label_offset:label_offset + x.shape[0]]
+        target_logits = scale * (x * targets).sum(dim=-1).float()
+        ctx.save_for_backward(x, y, logit_scale, lse)
+        ctx.label_offset = label_offset
+        ctx.chunk_size = chunk_size
+        return (lse - target_logits).sum()
+
+    @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
+    def backward(ctx, grad_total):
+        x, y, logit_scale, lse = ctx.saved_tensors
+        chunk_size, label_offset = ctx.chunk_size, ctx.label_offset
+        scale = logit_scale.float()
+        grad_x = torch.zeros_like(x, dtype=torch.float32)
+        grad_y = torch.zeros_like(y, dtype=torch.float32)
+        grad_scale = torch.zeros((), device=x.device, dtype=torch.float32)
+        for i in range(0, x.shape[0], chunk_size):
+            x_block = x[i:i + chunk_size]
+            for j in range(0, y.shape[0], chunk_size):
+                y_block = y[j:j + chunk_size]
+                similarity = (x_block @ y_block.T).float()
+                # d/dlogits of logsumexp is the softmax; the one-hot part is added below
+                grad_logits = grad_total * torch.exp(scale * similarity - lse[i:i + chunk_size].unsqueeze(1))
+                grad_scale += (grad_logits * similarity).sum()
+                grad_logits = (grad_logits * scale).to(x.dtype)
+                grad_x[i:i + chunk_size] += (grad_logits @ y_block).float()
+                grad_y[j:j + chunk_size] += (grad_logits.T @ x_block).float()
+        targets = y[label_offset:label_offset + x.shape[0]]
+        grad_x -= grad_total * scale * targets.float()
+        grad_y[label_offset:label_offset + x.shape[0]] -= grad_total * scale * x.float()
+        grad_scale -= grad_total * (x * targets).sum().float()
+        return (
+            grad_x.to(x.dtype) if ctx.needs_input_grad[0] else None,
+            grad_y.to(y.dtype) if ctx.needs_input_grad[1] else None,
+            grad_scale.reshape(logit_scale.shape).to(logit_scale.dtype) if ctx.needs_input_grad[2] else None,
+            None,
+            None,
+        )
+
+
+def chunked_cross_entropy(x, y, logit_scale, label_offset=0, chunk_size=4096):
+    """Mean over rows of cross_entropy(logit_scale * x @ y.T, arange(N) + label_offset), computed in chunks."""
+    logit_scale = torch.as_tensor(logit_scale, device=x.device, dtype=torch.float32)
+    return ChunkedCrossEntropy.apply(x, y, logit_scale, label_offset, chunk_size) / x.shape[0]
+
+
 class ClipLoss(nn.Module):
 
     def __init__(
@@ -75,6 +148,7 @@ class ClipLoss(nn.Module):
             rank=0,
             world_size=1,
             use_horovod=False,
+            chunk_size=None,
     ):
         super().__init__()
         self.local_loss = local_loss
@@ -83,6 +157,8 @@ class ClipLoss(nn.Module):
         self.rank = rank
         self.world_size = world_size
         self.use_horovod = use_horovod
+        # compute the cross entropies over chunk_size x chunk_size tiles instead of full logit matrices
+        self.chunk_size = chunk_size
 
         # cache state
         self.prev_num_logits = 0
@@ -101,7 +177,7 @@ class ClipLoss(nn.Module):
             labels = self.labels[device]
         return labels
 
-    def get_logits(self, image_features, text_features, logit_scale):
+    def get_logits(self, image_features, text_features, logit_scale, queue_image_features=None, queue_text_features=None):
         if self.world_size > 1:
             all_image_features, all_text_features = gather_features(
                 image_features, text_features,
@@ -113,18 +189,63 @@ class ClipLoss(nn.Module):
             else:
                 logits_per_image = logit_scale * all_image_features @ all_text_features.T
                 logits_per_text = logits_per_image.T
+                image_features, text_features = all_image_features, all_text_features
         else:
 
             image_features = F.normalize(image_features, p=2, dim=-1)
             text_features = F.normalize(text_features, p=2, dim=-1)
             logits_per_image = logit_scale * image_features @ text_features.T
             logits_per_text = logit_scale * text_features @ image_features.T
+
+        if queue_text_features is not None:
+            # queued features are extra columns: more negatives, same labels
+            queue_image_features, queue_text_features = self._queue_features(image_features, queue_image_features, queue_text_features)
+            logits_per_image = torch.cat([logits_per_image, logit_scale * image_features @ queue_text_features.T], dim=1)
+            logits_per_text = torch.cat([logits_per_text, logit_scale * text_features @ queue_image_features.T], dim=1)
         
         return logits_per_image, logits_per_text
 
-    def forward(self, image_features, text_features, logit_scale=np.log(1 / 0.07), output_dict=False, *args, **kwargs):
+    def _queue_features(self, features, queue_image_features, queue_text_features):
+        queue_image_features = queue_image_features.to(features.dtype)
+        queue_text_features = queue_text_features.to(features.dtype)
+        if self.world_size == 1:
+            # normalized like the batch features
+            queue_image_features = F.normalize(queue_image_features, p=2, dim=-1)
+            queue_text_features = F.normalize(queue_text_features, p=2, dim=-1)
+        return queue_image_features, queue_text_features
+
+    def _chunked_loss(self, image_features, text_features, logit_scale, queue_image_features=None, queue_text_features=None):
+        # same value as the cross entropies over get_logits, one chunk of logits at a time
+        label_offset = 0
+        if self.world_size > 1:
+            all_image_features, all_text_features = gather_features(
+                image_features, text_features,
+                self.local_loss, self.gather_with_grad, self.rank, self.world_size, self.use_horovod)
+            if self.local_loss:
+                label_offset = image_features.shape[0] * self.rank
+            else:
+                image_features, text_features = all_image_features, all_text_features
+        else:
+            image_features = F.normalize(image_features, p=2, dim=-1)
+            text_features = F.normalize(text_features, p=2, dim=-1)
+            all_image_features, all_text_features = image_features, text_features
+        if queue_text_features is not None:
+            queue_image_features, queue_text_features = self._queue_features(image_features, queue_image_features, queue_text_features)
+            all_image_features = torch.cat([all_image_features, queue_image_features])
+            all_text_features = torch.cat([all_text_features, queue_text_features])
+        return (
+            chunked_cross_entropy(image_features, all_text_features, logit_scale, label_offset, self.chunk_size) +
+            chunked_cross_entropy(text_features, all_image_features, logit_scale, label_offset, self.chunk_size)
+        ) / 2
+
+    def forward(self, image_features, text_features, logit_scale=np.log(1 / 0.07), output_dict=False, *args,
+                queue_image_features=None, queue_text_features=None, **kwargs):
         device = image_features.device
-        logits_per_image, logits_per_text = self.get_logits(image_features, text_features, logit_scale)
+        if self.chunk_size:
+            total_loss = self._chunked_loss(image_features, text_features, logit_scale, queue_image_features, queue_text_features)
+            return {"contrastive_loss": total_loss} if output_dict else total_loss
+
+        logits_per_image, logits_per_text = self.get_logits(image_features, text_features, logit_scale, queue_image_features, queue_text_features)
 
         labels = self.get_ground_truth(device, logits_per_image.shape[0])
 
@@ -309,6 +430,197 @@ def neighbour_exchange_bidir_with_grad(left_rank, right_rank, tensor_to_left, te
     return NeighbourExchangeBidir.apply(left_rank, right_rank, group, tensor_to_left, tensor_to_right)
 
 
+# Split-phase versions of the exchanges above: start_* posts the sends and receives and returns
+# at once, so the caller can compute on what it already holds; finish_* waits for them and
+# attaches the received tensors to the autograd graph. Backward sends the gradients back along
+# the reverse ring, exactly like NeighbourExchange / NeighbourExchangeBidir.
+
+def start_neighbour_exchange(from_rank, to_rank, tensor, group=None):
+    tensor = tensor.detach().contiguous()
+    tensor_recv = torch.zeros_like(tensor)
+    reqs = torch.distributed.batch_isend_irecv([
+        torch.distributed.P2POp(torch.distributed.isend, tensor, to_rank, group=group),
+        torch.distributed.P2POp(torch.distributed.irecv, tensor_recv, from_rank, group=group),
+    ])
+    return reqs, tensor_recv
+
+
+def start_neighbour_exchange_bidir(left_rank, right_rank, tensor_to_left, tensor_to_right, group=None):
+    tensor_to_left = tensor_to_left.detach().contiguous()
+    tensor_to_right = tensor_to_right.detach().contiguous()
+    tensor_from_left = torch.zeros_like(tensor_to_right)
+    tensor_from_right = torch.zeros_like(tensor_to_left)
+    reqs = torch.distributed.batch_isend_irecv([
+        torch.distributed.P2POp(torch.distributed.isend, tensor_to_right, right_rank, group=group),
+        torch.distributed.P2POp(torch.distributed.isend, tensor_to_left, left_rank, group=group),
+        torch.distributed.P2POp(torch.distributed.irecv, tensor_from_right, right_rank, group=group),
+        torch.distributed.P2POp(torch.distributed.irecv, tensor_from_left, left_rank, group=group),
+    ])
+    return reqs, (tensor_from_right, tensor_from_left)
+
+
+class ReceivedFromNeighbour(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, from_rank, to_rank, group, tensor, tensor_recv):
+        ctx.group = group
+        ctx.from_rank = from_rank
+        ctx.to_rank = to_rank
+        return tensor_recv.view_as(tensor_recv)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return (None, None, None, NeighbourExchange.apply(ctx.to_rank, ctx.from_rank, ctx.group, grad_output), None)
+
+
+class ReceivedFromNeighboursBidir(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, left_rank, right_rank, group, tensor_to_left, tensor_to_right, tensor_from_right, tensor_from_left):
+        ctx.group = group
+        ctx.left_rank = left_rank
+        ctx.right_rank = right_rank
+        return tensor_from_right.view_as(tensor_from_right), tensor_from_left.view_as(tensor_from_left)
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        return (None, None, None) + \
+            NeighbourExchangeBidir.apply(ctx.right_rank, ctx.left_rank, ctx.group, *grad_outputs) + (None, None)
+
+
+def finish_neighbour_exchange(from_rank, to_rank, tensor, pending, group=None):
+    reqs, tensor_recv = pending
+    for req in reqs:
+        req.wait()
+    return ReceivedFromNeighbour.apply(from_rank, to_rank, group, tensor, tensor_recv)
+
+
+def finish_neighbour_exchange_bidir(left_rank, right_rank, tensor_to_left, tensor_to_right, pending, group=None):
+    reqs, (tensor_from_right, tensor_from_left) = pending
+    for req in reqs:
+        req.wait()
+    return ReceivedFromNeighboursBidir.apply(left_rank, right_rank, group, tensor_to_left, tensor_to_right, tensor_from_right, tensor_from_left)
+
+
+def _pair_signs(row_start, col_start, num_rows, num_cols, device, negative_only=False):
+    # +1 where the global row and column index match (positive pairs), -1 elsewhere
+    if negative_only:
+        return torch.full((num_rows, num_cols), -1.0, device=device)
+    rows = torch.arange(row_start, row_start + num_rows, device=device).unsqueeze(1)
+    cols = torch.arange(col_start, col_start + num_cols, device=device).unsqueeze(0)
+    return torch.where(rows == cols, 1.0, -1.0)
+
+
+class BlockwiseSigmoidLoss(torch.autograd.Function):
+    """
+    Sum of logsigmoid(label * (logit_scale * x @ y.T + logit_bias)) over all N x M pairs, label
+    +1 on the diagonal and -1 elsewhere (-1 everywhere with negative_only, for text features
+    received from another rank), without materializing the N x M logits or labels.
+
+    Forward and backward both walk block_size x block_size tiles; backward recomputes each
+    tile's logits instead of saving them, under the autocast state forward ran in. Returns (sum over all pairs, sum over the diagonal);
+    the diagonal sum is a diagnostic and carries no gradient.
+    """
+
+    @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda')
+    def forward(ctx, x, y, logit_scale, logit_bias, block_size, negative_only=False):
+        total = torch.zeros((), device=x.device, dtype=torch.float32)
+        diag = torch.zeros((), device=x.device, dtype=torch.float32)
+        for i in range(0, x.shape[0], block_size):
+            x_block = x[i:i + block_size]
+            for j in range(0, y.shape[0], block_size):
+                y_block = y[j:j + block_size]
+                logits = logit_scale.float() * (x_block @ y_block.T).float() + logit_bias.float()
+                loss = F.logsigmoid(_pair_signs(i, j, x_block.shape[0], y_block.shape[0], x.device, negative_only) * logits)
+                total += loss.sum()
+                if not negative_only and i < j + y_block.shape[0] and j < i + x_block.shape[0]:
+                    diag += torch.diagonal(loss, offset=i - j).sum()
+        ctx.save_for_backward(x, y, logit_scale, logit_bias)
+        ctx.block_size = block_size
+        ctx.negative_only = negative_only
+        ctx.mark_non_differentiable(diag)
+        return total, diag
+
+    @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
+    def backward(ctx, grad_total, grad_diag):
+        x, y, logit_scale, logit_bias = ctx.saved_tensors
+        block_size = ctx.block_size
+        grad_x = torch.zeros_like(x, dtype=torch.float32)
+        grad_y = torch.zeros_like(y, dtype=torch.float32)
+        grad_scale = torch.zeros((), device=x.device, dtype=torch.float32)
+        grad_bias = torch.zeros((), device=x.device, dtype=torch.float32)
+        scale = logit_scale.float()
+        for i in range(0, x.shape[0], block_size):
+            x_block = x[i:i + block_size]
+            for j in range(0, y.shape[0], block_size):
+                y_block = y[j:j + block_size]
+                similarity = (x_block @ y_block.T).float()
+                signs = _pair_signs(i, j, x_block.shape[0], y_block.shape[0], x.device, ctx.negative_only)
+                # d/dz logsigmoid(s * z) = s * sigmoid(-s * z)
+                grad_logits = grad_total * signs * torch.sigmoid(-signs * (scale * similarity + logit_bias.float()))
+                grad_scale += (grad_logits * similarity).sum()
+                grad_bias += grad_logits.sum()
+                grad_logits = (grad_logits * scale).to(x.dtype)
+                grad_x[i:i + block_size] += (grad_logits @ y_block).float()
+                grad_y[j:j + block_size] += (grad_logits.T @ x_block).float()
+        return (
+            grad_x.to(x.dtype) if ctx.needs_input_grad[0] else None,
+            grad_y.to(y.dtype) if ctx.needs_input_grad[1] else None,
+            grad_scale.reshape(logit_scale.shape).to(logit_scale.dtype) if ctx.needs_input_grad[2] else None,
+            grad_bias.reshape(logit_bias.shape).to(logit_bias.dtype) if ctx.needs_input_grad[3] else None,
+            None,
+            None,
+        )
+
+
+def blockwise_sigmoid_loss(x, y, logit_scale, logit_bias=None, block_size=4096, negative_only=False):
+    logit_scale = torch.as_tensor(logit_scale, device=x.device)
+    logit_bias = torch.as_tensor(0.0 if logit_bias is None else logit_bias, device=x.device)
+    return BlockwiseSigmoidLoss.apply(x, y, logit_scale, logit_bias, block_size, negative_only)
+
+
+def sample_negatives(image_features, text_features, num_negatives, logit_scale, logit_bias=None, mode="random",
+                     chunk_size=4096, uniform_mix=0.1, negative_only=False):
+    """
+    Draw `num_negatives` negative columns per row (with replacement, never the diagonal positive)
+    and importance weights such that summing weight * f(pair) over a row's draws is an unbiased
+    estimate of the sum of f over all of its negatives. With negative_only every column is a
+    negative, e.g. a block of text features received from another rank.
+
+    random: uniform draws, weight (M - 1) / k (M / k with negative_only); O(N * k).
+    hard: draws proportional to sigmoid(logit), the gradient magnitude of a negative pair, mixed
+    with `uniform_mix` of uniform so no weight exceeds (M - 1) / (k * uniform_mix). Scoring the
+    candidates walks chunk_size rows at a time without gradients, so only the draws enter the graph.
+    """
+    num_rows, num_cols = image_features.shape[0], text_features.shape[0]
+    num_candidates = num_cols if negative_only else num_cols - 1
+    assert num_candidates > 0, "Need at least one negative per row"
+    device = image_features.device
+    rows = torch.arange(num_rows, device=device).unsqueeze(1)
+    if mode == "random":
+        indices = torch.randint(0, num_candidates, (num_rows, num_negatives), device=device)
+        if not negative_only:
+            indices = indices + (indices >= rows).long()
+        weights = torch.full((num_rows, num_negatives), num_candidates / num_negatives, device=device)
+        return indices, weights
+
+    assert mode == "hard", f"Unknown negative sampling mode {mode}"
+    indices, weights = [], []
+    with torch.no_grad():
+        for i in range(0, num_rows, chunk_size):
+            logits = logit_scale * (image_features[i:i + chunk_size] @ text_features.T).float()
+            if logit_bias is not None:
+                logits += logit_bias
+            positive = _pair_signs(i, 0, logits.shape[0], num_cols, device, negative_only) > 0
+            probs = torch.sigmoid(logits).masked_fill(positive, 0)
+            probs = (1 - uniform_mix) * probs / probs.sum(dim=1, keepdim=True) + uniform_mix / num_candidates
+            probs = probs.masked_fill(positive, 0)
+            chunk_indices = torch.multinomial(probs, num_negatives, replacement=True)
+            indices.append(chunk_indices)
+            weights.append(1 / (num_negatives * probs.gather(1, chunk_indices)))
+    return torch.cat(indices), torch.cat(weights)
+
+
 class SigLipLoss(nn.Module):
     """ Sigmoid Loss for Language Image Pre-Training (SigLIP) - https://arxiv.org/abs/2303.15343
 
@@ -327,9 +639,17 @@ class SigLipLoss(nn.Module):
             bidir=True,
             use_horovod=False,
             diagonal_weight:float = 0.0,
+            block_size=None,
+            num_negatives=None,
+            negative_sampling="random",
     ):
         super().__init__()
         self.cache_labels = cache_labels
+        # compute the loss in block_size x block_size tiles instead of full N x N matrices
+        self.block_size = block_size
+        # estimate the local negatives from num_negatives sampled pairs per row instead of all N - 1
+        self.num_negatives = num_negatives
+        self.negative_sampling = negative_sampling
         self.rank = rank
         self.world_size = world_size
         assert not use_horovod  # FIXME need to look at hvd ops for ring transfers
@@ -377,11 +697,56 @@ class SigLipLoss(nn.Module):
             logits += logit_bias
         return logits
     
+    def _blockwise_loss(self, image_features, text_features, extra_text_features, logit_scale, logit_bias=None):
+        # same outputs as _loss, from sums over tiles
+        num_pairs = image_features.shape[0] * image_features.shape[0]
+        total, diag = blockwise_sigmoid_loss(image_features, text_features, logit_scale, logit_bias, self.block_size)
+        output = {"positive_loss": -diag / num_pairs, "negative_loss": -(total.detach() - diag) / num_pairs}
+        loss_sum, loss_count = total, num_pairs
+        if extra_text_features is not None:
+            extra_text_features = F.normalize(extra_text_features, p=2, dim=-1)
+            extra_total, _ = blockwise_sigmoid_loss(image_features, extra_text_features, logit_scale, logit_bias, self.block_size)
+            output["extra_loss"] = -extra_total / num_pairs
+            loss_sum, loss_count = loss_sum + extra_total, 2 * num_pairs
+        output["contrastive_loss"] = -loss_sum / loss_count
+        return output
+
+    def _sampled_loss(self, image_features, text_features, extra_text_features, logit_scale, logit_bias=None):
+        # same outputs as _loss, with each row's negative sum replaced by an importance-weighted estimate
+        num_pairs = image_features.shape[0] * image_features.shape[0]
+
+        def sums(texts):
+            positive_logits = logit_scale * (image_features * texts[:image_features.shape[0]]).sum(dim=-1)
+            if logit_bias is not None:
+                positive_logits = positive_logits + logit_bias
+            positive = F.logsigmoid(positive_logits).sum()
+            indices, weights = sample_negatives(image_features, texts, self.num_negatives, logit_scale.detach(),
+                                                None if logit_bias is None else logit_bias.detach(), self.negative_sampling)
+            logits = logit_scale * torch.einsum("nd,nkd->nk", image_features, texts[indices])
+            if logit_bias is not None:
+                logits = logits + logit_bias
+            return positive, (weights * F.logsigmoid(-logits)).sum()
+
+        positive, negative = sums(text_features)
+        output = {"positive_loss": -positive.detach() / num_pairs, "negative_loss": -negative.detach() / num_pairs}
+        loss_sum, loss_count = positive + negative, num_pairs
+        if extra_text_features is not None:
+            extra_text_features = F.normalize(extra_text_features, p=2, dim=-1)
+            extra_positive, extra_negative = sums(extra_text_features)
+            output["extra_loss"] = -(extra_positive + extra_negative).detach() / num_pairs
+            loss_sum, loss_count = loss_sum + extra_positive + extra_negative, 2 * num_pairs
+        output["contrastive_loss"] = -loss_sum / loss_count
+        return output
+
     def _loss(self, image_features, text_features, extra_text_features, logit_scale, logit_bias=None, logits_per_text=None, negative_only=False):
         # breakpoint()
 
         image_features = F.normalize(image_features, p=2, dim=-1)
         text_features = F.normalize(text_features, p=2, dim=-1)
+        if self.num_negatives and logits_per_text is None:
+            return self._sampled_loss(image_features, text_features, extra_text_features, logit_scale, logit_bias)
+        if self.block_size and logits_per_text is None:
+            return self._blockwise_loss(image_features, text_features, extra_text_features, logit_scale, logit_bias)
       
         if logits_per_text is not None:
             logits = logits_per_text
@@ -423,59 +788,103 @@ class SigLipLoss(nn.Module):
 
 
 
-    def forward(self, image_features, text_features, extra_text_features, logit_scale, logit_bias, logits_per_text=None, output_dict=False, **kwargs):
-       
+    def _negative_sum(self, image_features, text_features, logit_scale, logit_bias=None, num_negatives=None):
+        # sum of logsigmoid(-logits) over all pairs: every pair is a negative
+        if num_negatives:
+            # importance-weighted estimate from num_negatives draws per row
+            indices, weights = sample_negatives(image_features, text_features, num_negatives, logit_scale.detach(),
+                                                None if logit_bias is None else logit_bias.detach(), self.negative_sampling, negative_only=True)
+            logits = logit_scale * torch.einsum("nd,nkd->nk", image_features, text_features[indices])
+            if logit_bias is not None:
+                logits = logits + logit_bias
+            return (weights * F.logsigmoid(-logits)).sum()
+        if self.block_size:
+            total, _ = blockwise_sigmoid_loss(image_features, text_features, logit_scale, logit_bias, self.block_size, negative_only=True)
+            return total
+        return F.logsigmoid(-self.get_logits(image_features, text_features, logit_scale, logit_bias)).sum()
+
+    def _ring_loss(self, loss, image_features, payload, pending, logit_scale, logit_bias):
+        """
+        Add the text (and extra text) features of every other rank to the local loss as negatives.
+        `payload` holds the local normalized text features, followed by the extra text features if
+        any; its first exchange was already posted (`pending`) so it overlaps the local loss.
+        """
+        right_rank = (self.rank + 1) % self.world_size
+        left_rank = (self.rank - 1 + self.world_size) % self.world_size
+        image_features = F.normalize(image_features, p=2, dim=-1)
+        # with sampled negatives, the remote blocks share one budget of num_negatives draws per row
+        num_negatives = math.ceil(self.num_negatives / (self.world_size - 1)) if self.num_negatives else None
+        remote_sum = 0
+        if self.bidir:
+            to_left = to_right = payload
+            num_bidir, remainder = divmod(self.world_size - 1, 2)
+            for i in range(num_bidir):
+                received = finish_neighbour_exchange_bidir(left_rank, right_rank, to_left, to_right, pending)
+                to_left, to_right = received
+                # post the next hop before computing on this one
+                if i + 1 < num_bidir:
+                    pending = start_neighbour_exchange_bidir(left_rank, right_rank, to_left, to_right)
+                elif remainder:
+                    pending = start_neighbour_exchange(left_rank, right_rank, to_right)
+                for f in received:
+                    remote_sum = remote_sum + self._negative_sum(image_features, f, logit_scale, logit_bias, num_negatives)
+            if remainder:
+                received = finish_neighbour_exchange(left_rank, right_rank, to_right, pending)
+                remote_sum = remote_sum + self._negative_sum(image_features, received, logit_scale, logit_bias, num_negatives)
+        else:
+            to_right = payload
+            for i in range(self.world_size - 1):
+                received = finish_neighbour_exchange(left_rank, right_rank, to_right, pending)
+                if i + 1 < self.world_size - 1:
+                    pending = start_neighbour_exchange(left_rank, right_rank, received)
+                remote_sum = remote_sum + self._negative_sum(image_features, received, logit_scale, logit_bias, num_negatives)
+                to_right = received
+
+        # contrastive_loss stays the mean over all pairs, now N x (world_size * payload rows)
+        local_count = image_features.shape[0] * payload.shape[0]
+        return self._add_negatives(loss, local_count, remote_sum, local_count * (self.world_size - 1), "remote_negative_loss")
+
+    def _add_negatives(self, loss, pair_count, negative_sum, negative_count, name):
+        # fold negative_count more pairs, summing to negative_sum, into the mean over pair_count pairs
+        pair_sum = -loss["contrastive_loss"] * pair_count
+        loss["contrastive_loss"] = -(pair_sum + negative_sum) / (pair_count + negative_count)
+        loss[name] = -negative_sum.detach() / negative_count
+        return loss
+
+    def _queue_loss(self, loss, pair_count, image_features, text_features, queue_image_features, queue_text_features, logit_scale, logit_bias):
+        # local images against queued texts and local texts against queued images, all negatives
+        image_features = F.normalize(image_features, p=2, dim=-1)
+        text_features = F.normalize(text_features, p=2, dim=-1)
+        queue_image_features = F.normalize(queue_image_features.to(image_features.dtype), p=2, dim=-1)
+        queue_text_features = F.normalize(queue_text_features.to(text_features.dtype), p=2, dim=-1)
+        queue_sum = self._negative_sum(image_features, queue_text_features, logit_scale, logit_bias, self.num_negatives) + \
+            self._negative_sum(text_features, queue_image_features, logit_scale, logit_bias, self.num_negatives)
+        queue_count = image_features.shape[0] * queue_text_features.shape[0] + text_features.shape[0] * queue_image_features.shape[0]
+        return self._add_negatives(loss, pair_count, queue_sum, queue_count, "queue_negative_loss")
+
+    def forward(self, image_features, text_features, extra_text_features, logit_scale, logit_bias, logits_per_text=None, output_dict=False,
+                queue_image_features=None, queue_text_features=None, **kwargs):
+        ring = self.world_size > 1 and logits_per_text is None
+        if ring:
+            # exchange text features w/ neighbour world_size - 1 times, the first hop in flight during the local loss
+            payload = F.normalize(text_features, p=2, dim=-1)
+            if extra_text_features is not None:
+                payload = torch.cat([payload, F.normalize(extra_text_features, p=2, dim=-1)])
+            right_rank = (self.rank + 1) % self.world_size
+            left_rank = (self.rank - 1 + self.world_size) % self.world_size
+            if self.bidir and self.world_size > 2:
+                pending = start_neighbour_exchange_bidir(left_rank, right_rank, payload, payload)
+            else:
+                pending = start_neighbour_exchange(left_rank, right_rank, payload)
+
         loss = self._loss(image_features, text_features, extra_text_features, logit_scale, logit_bias, logits_per_text)
-        # if self.world_size > 1:
-        #     # exchange text features w/ neighbour world_size - 1 times
-        #     right_rank = (self.rank + 1) % self.world_size
-        #     left_rank = (self.rank - 1 + self.world_size) % self.world_size
-        #     if self.bidir:
-        #         text_features_to_right = text_features_to_left = text_features
-        #         num_bidir, remainder = divmod(self.world_size - 1, 2)
-        #         for i in range(num_bidir):
-        #             text_features_recv = neighbour_exchange_bidir_with_grad(
-        #                 left_rank,
-        #                 right_rank,
-        #                 text_features_to_left,
-        #                 text_features_to_right,
-        #             )
-
-        #             for f in text_features_recv:
-        #                 loss += self._loss(
-        #                     image_features,
-        #                     f,
-        #                     logit_scale,
-        #                     logit_bias,
-        #                     negative_only=True,
-        #                 )
-        #             text_features_to_left, text_features_to_right = text_features_recv
-
-        #         if remainder:
-        #             text_features_recv = neighbour_exchange_with_grad(
-        #                 left_rank, right_rank, text_features_to_right)
-
-        #             loss += self._loss(
-        #                 image_features,
-        #                 text_features_recv,
-        #                 logit_scale,
-        #                 logit_bias,
-        #                 negative_only=True,
-        #             )
-        #     else:
-        #         text_features_to_right = text_features
-        #         for i in range(self.world_size - 1):
-        #             text_features_from_left = neighbour_exchange_with_grad(
-        #                 left_rank, right_rank, text_features_to_right)
-
-        #             loss += self._loss(
-        #                 image_features,
-        #                 text_features_from_left,
-        #                 logit_scale,
-        #                 logit_bias,
-        #                 negative_only=True,
-        #             )
-        #             text_features_to_right = text_features_from_left
+        if ring:
+            loss = self._ring_loss(loss, image_features, payload, pending, logit_scale, logit_bias)
+        if queue_text_features is not None:
+            num_texts = text_features.shape[0] + (0 if extra_text_features is None else extra_text_features.shape[0])
+            pair_count = image_features.shape[0] * num_texts * (self.world_size if ring else 1)
+            loss = self._queue_loss(loss, pair_count, image_features, text_features, queue_image_features, queue_text_features,
+                                    logit_scale, logit_bias)
         return loss if output_dict else loss['contrastive_loss']
         # return {"contrastive_loss": loss, "loss_high_temp": loss_high_temp, "loss_low_temp": loss_low_temp} if output_dict else loss
 
@@ -518,4 +927,161 @@ class BarlowTwinsLoss(nn.Module):
     def forward(self, image_features, text_features, output_dict=False, **kwargs):
         # Normalize features
         loss = self._barlowtwins_loss(image_features, text_features)
-        return {"contrastive_loss": loss} if output_dict else loss
\ No newline at end of file
+        return {"contrastive_loss": loss} if output_dict else loss
+
+def _check_blockwise_siglip(n=50, dim=16, block_size=7):
+    # tiled SigLip against the dense one, loss and the gradients of features, scale and bias
+    generator = torch.Generator().manual_seed(0)
+    image, text = torch.randn(n, dim, generator=generator), torch.randn(n, dim, generator=generator)
+    scale, bias = torch.tensor(10.0), torch.tensor(-10.0)
+    results = []
+    for loss_fn in (SigLipLoss(), SigLipLoss(block_size=block_size)):
+        leaves = [t.clone().requires_grad_() for t in (image, text, scale, bias)]
+        loss = loss_fn(leaves[0], leaves[1], None, leaves[2], leaves[3])
+        loss.backward()
+        results.append([loss.detach()] + [t.grad for t in leaves])
+    for dense, blockwise in zip(*results):
+        torch.testing.assert_close(blockwise, dense, rtol=1e-4, atol=1e-6)
+
+
+@torch.no_grad()
+def _check_sampled_siglip(n=20, dim=8, num_negatives=4, draws=4000):
+    # sampled-negative estimates must average to the dense loss, within 5 standard errors
+    generator = torch.Generator().manual_seed(0)
+    image, text, extra = (torch.randn(n, dim, generator=generator) for _ in range(3))
+    scale, bias = torch.tensor(10.0), torch.tensor(-10.0)
+    dense = SigLipLoss()(image, text, extra, scale, bias)
+    torch.manual_seed(0)
+    for mode in ("random", "hard"):
+        loss_fn = SigLipLoss(num_negatives=num_negatives, negative_sampling=mode)
+        estimates = torch.stack([loss_fn(image, text, extra, scale, bias) for _ in range(draws)])
+        error = (estimates.mean() - dense).abs().item()
+        tolerance = 5 * estimates.std().item() / math.sqrt(draws)
+        assert error <= tolerance, f"{mode} sampling is biased: mean estimate off the dense loss {dense.item():.6f} by {error:.2e} > {tolerance:.2e}"
+
+
+def _check_queue_negatives(n=12, queue_size=20, dim=8, block_size=5):
+    # losses with queued features against dense losses over the batch plus queued columns
+    generator = torch.Generator().manual_seed(0)
+    image, text, queue_image, queue_text = (torch.randn(m, dim, generator=generator) for m in (n, n, queue_size, queue_size))
+    # FeatureQueue stores fp16; the references read the same rounded values
+    queue_image, queue_text = queue_image.half().float(), queue_text.half().float()
+    scale, bias = torch.tensor(10.0), torch.tensor(-10.0)
+
+    def siglip_reference(image, text, scale, bias):
+        i, t, qi, qt = (F.normalize(x, dim=-1) for x in (image, text, queue_image, queue_text))
+        labels = 2 * torch.eye(n) - 1
+        terms = [F.logsigmoid(labels * (scale * i @ t.T + bias)), F.logsigmoid(-(scale * i @ qt.T + bias)), F.logsigmoid(-(scale * t @ qi.T + bias))]
+        return -sum(x.sum() for x in terms) / sum(x.numel() for x in terms)
+
+    def clip_reference(image, text, scale, bias):
+        i, t, qi, qt = (F.normalize(x, dim=-1) for x in (image, text, queue_image, queue_text))
+        labels = torch.arange(n)
+        return (F.cross_entropy(scale * torch.cat([i @ t.T, i @ qt.T], dim=1), labels) +
+                F.cross_entropy(scale * torch.cat([t @ i.T, t @ qi.T], dim=1), labels)) / 2
+
+    cases = [
+        (SigLipLoss(), siglip_reference),
+        (SigLipLoss(block_size=block_size), siglip_reference),
+        (lambda i, t, s, b, **kw: ClipLoss()(i, t, s, **kw), clip_reference),
+        (lambda i, t, s, b, **kw: ClipLoss(chunk_size=block_size)(i, t, s, **kw), clip_reference),
+    ]
+    for loss_fn, reference_fn in cases:
+        results = []
+        for use_queue in (True, False):
+            leaves = [t.clone().requires_grad_() for t in (image, text, scale, bias)]
+            if use_queue:
+                queue = {"queue_image_features": queue_image.half(), "queue_text_features": queue_text.half()}
+                loss = loss_fn(leaves[0], leaves[1], None, leaves[2], leaves[3], **queue) if isinstance(loss_fn, SigLipLoss) else \
+                    loss_fn(leaves[0], leaves[1], leaves[2], leaves[3], **queue)
+            else:
+                loss = reference_fn(*leaves)
+            loss.backward()
+            results.append([loss.detach()] + [t.grad for t in leaves[:3]])
+        for queued, reference in zip(*results):
+            torch.testing.assert_close(queued, reference, rtol=1e-4, atol=1e-6)
+
+    from train.feature_queue import FeatureQueue
+    feature_queue = FeatureQueue(8, "cpu", max_age=1)
+    assert feature_queue.negatives(0) == {}
+    for step in range(3):
+        feature_queue.update(None, None, None, {"image_features": torch.full((3, dim), float(step)), "text_features": torch.full((3, dim), float(step))}, step)
+    # 9 rows written into 8: step 0 keeps 2 rows at most, and max_age=1 drops it at step 2
+    negatives = feature_queue.negatives(2)
+    assert sorted(negatives["queue_image_features"][:, 0].tolist()) == [1.0] * 3 + [2.0] * 3
+
+
+def _check_chunked_clip(n=50, dim=16, chunk_size=7):
+    # chunked InfoNCE against the dense ClipLoss, loss and gradients
+    generator = torch.Generator().manual_seed(0)
+    image, text = torch.randn(n, dim, generator=generator), torch.randn(n, dim, generator=generator)
+    scale = torch.tensor(14.0)
+    results = []
+    for loss_fn in (ClipLoss(), ClipLoss(chunk_size=chunk_size)):
+        leaves = [t.clone().requires_grad_() for t in (image, text, scale)]
+        loss = loss_fn(*leaves)
+        loss.backward()
+        results.append([loss.detach()] + [t.grad for t in leaves])
+    for dense, chunked in zip(*results):
+        torch.testing.assert_close(chunked, dense, rtol=1e-4, atol=1e-6)
+
+
+def _check_ring_siglip(rank, world_size, port, bidir, block_size, n, dim):
+    # every rank builds the same global batch and keeps its slice; the ring losses must add up to
+    # the single-process loss on the whole batch, and their gradients to its gradients
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    generator = torch.Generator().manual_seed(0)
+    image, text, extra = (torch.randn(world_size * n, dim, generator=generator) for _ in range(3))
+    scale, bias = torch.tensor(10.0), torch.tensor(-10.0)
+
+    leaves = [t.clone().requires_grad_() for t in (image, text, extra, scale, bias)]
+    reference = SigLipLoss(block_size=block_size)(*leaves, output_dict=True)
+    reference["contrastive_loss"].backward()
+
+    rows = slice(rank * n, (rank + 1) * n)
+    local = [t[rows].clone().requires_grad_() for t in (image, text, extra)] + [t.clone().requires_grad_() for t in (scale, bias)]
+    loss = SigLipLoss(rank=rank, world_size=world_size, bidir=bidir, block_size=block_size)(*local, output_dict=True)
+    loss["contrastive_loss"].backward()
+
+    # mean of the per-rank losses, sum of the per-rank parameter gradients (as DDP would average them)
+    contrastive = loss["contrastive_loss"].detach().clone()
+    dist.all_reduce(contrastive)
+    torch.testing.assert_close(contrastive / world_size, reference["contrastive_loss"].detach())
+    for i in range(3):
+        torch.testing.assert_close(local[i].grad, world_size * leaves[i].grad[rows], rtol=1e-4, atol=1e-6)
+    for i in (3, 4):
+        grad = local[i].grad.clone()
+        dist.all_reduce(grad)
+        torch.testing.assert_close(grad, world_size * leaves[i].grad, rtol=1e-4, atol=1e-5)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    # Check the blockwise SigLIP and chunked ClipLoss against the dense ones, and the ring-exchange SigLIP loss
+    # against the single-process loss on CPU with gloo:
+    #   python -m model.loss --world_sizes 2 3 4
+    import socket
+    import argparse
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[2, 3, 4, 5])
+    parser.add_argument("--batch_size", type=int, default=8, help="Per rank")
+    parser.add_argument("--dim", type=int, default=16)
+    args = parser.parse_args()
+    _check_blockwise_siglip()
+    print("blockwise SigLipLoss: ok")
+    _check_sampled_siglip()
+    print("sampled-negative SigLipLoss: ok")
+    _check_chunked_clip()
+    print("chunked ClipLoss: ok")
+    _check_queue_negatives()
+    print("queued negatives: ok")
+    for world_size in args.world_sizes:
+        for bidir in (True, False):
+            for block_size in (None, 3):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", 0))
+                    port = s.getsockname()[1]
+                mp.spawn(_check_ring_siglip, args=(world_size, port, bidir, block_size, args.batch_size, args.dim), nprocs=world_size)
+                print(f"world_size={world_size} bidir={bidir} block_size={block_size}: ok")
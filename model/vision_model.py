@@ -18,8 +18,6 @@ from .mae import get_mae_vit
 from .ibot import get_ibot_vit
 from .ijepa import get_ijepa_vit
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 Image.MAX_IMAGE_PIXELS = None
 
@@ -117,28 +115,29 @@ class ImageEmbedding(nn.Module):
             self.model = AutoModel.from_pretrained(model_name, attn_implementation="eager", torch_dtype=torch.float16)
             self.image_processor = AutoImageProcessor.from_pretrained(model_name)
 
-    def load_images_from_directory(self, images_path: List[str]) -> List[Image.Image]:
+    @property
+    def agg_layout(self) -> str:
+        """`agg_mode` if forward() pools the cls/patch tokens itself, 'model' if the backbone's own pooling is used."""
+        if any(x in self.model_name.lower() for x in ['ijepa', 'clip', 'aimv2', 'ibot', 'mae', 'dinov1', 'aim']):
+            return 'model'
+        return self.agg_mode
 
-        def load_single_image(args):
-            idx, image_path = args
-            with Image.open(image_path) as img:
-                return idx, img.convert("RGB")
-        
-        images = [None] * len(images_path)
-        with ThreadPoolExecutor() as executor:
-            # Submit tasks with indices to maintain order
-            futures = {executor.submit(load_single_image, (i, path)): i 
-                      for i, path in enumerate(images_path)}
-            
-            # Collect results in order
-            for future in as_completed(futures):
-                idx, img = future.result()
-                images[idx] = img
-                
-        return images
-
-    def get_visual_embeddings_from_directory(self, images_path: List[str]):
-        images = self.load_images_from_directory(images_path)
+    def load_images_from_directory(self, images_path: List[str], draft: bool = False) -> List[Image.Image]:
+        """
+        Decode `images_path` to RGB on a process-wide decode pool. With `draft`, JPEGs are decoded at
+        the smallest DCT scale still covering the processor's resize, which is faster but changes the
+        pixels (and so the embeddings) slightly.
+        """
+        from data.decode import shared_decode_service
+        min_side = None
+        if draft:
+            from data.pixel_cache import processor_spec
+            spec = processor_spec(self.image_processor)
+            min_side = spec['resize'] if spec else None
+        return shared_decode_service(min_side).decode(images_path)
+
+    def get_visual_embeddings_from_directory(self, images_path: List[str], draft: bool = False):
+        images = self.load_images_from_directory(images_path, draft=draft)
         inputs = self.image_processor(images, return_tensors="pt").to(self.device, dtype=self.model.dtype)
         with torch.autocast(device_type=self.device, dtype=self.model.dtype):
             with torch.no_grad():
@@ -3,7 +3,7 @@
 #==============================================================================#
 #                              VISION MODEL                                      #
 #==============================================================================#
-vision_model="apple/aimv2-large-patch14-224"
+vision_model="apple/aimv2-large-patch14-224" # several models can share one image decode, e.g. "facebook/dinov2-large openai/clip-vit-large-patch14"
 # Available options:
 # vision_model="ijepa-huge"                    # IJEPA
 # vision_model="openai/clip-vit-large-patch14" # OpenAI CLIP
@@ -51,7 +51,7 @@ batch_size=1024 # adjust based on GPU memory
 # HQ Short captions: shortIB_captions, shortSV_captions, shortLLA_captions
 # Raw caption:    raw_caption
 # agg_mode: "concat" (concatenate cls with all patch tokens and average pool) or "cls" (use cls token only)
-source_caption="longSV_captions"
+source_caption="longSV_captions" # several columns can be encoded in one text run, e.g. "raw_caption shortSV_captions longSV_captions"
 agg_mode="concat"
 
 
@@ -71,6 +71,12 @@ if [ "$gpu_count" -eq 4 ]; then # If use multiple GPUs, please make sure the end
     CUDA_VISIBLE_DEVICES=2 python encode.py --domain $domain --vision_model_name $vision_model --text_model_name $text_model --batch_size $batch_size --data $data --resume --start_index 12288000 --end_index 18432000 --source_caption $source_caption &
     CUDA_VISIBLE_DEVICES=3 python encode.py --domain $domain --vision_model_name $vision_model --text_model_name $text_model --batch_size $batch_size --data $data --resume --start_index 18432000 --source_caption $source_caption &
     wait
+elif [ "$gpu_count" -gt 1 ]; then # Work-queue mode: every GPU claims fixed-size tasks via lease files, no index ranges to compute
+    echo "bash output: Running $gpu_count work-queue workers..."
+    for gpu in $(seq 0 $((gpu_count - 1))); do
+        CUDA_VISIBLE_DEVICES=$gpu python encode.py --domain $domain --vision_model_name $vision_model --text_model_name $text_model --batch_size $batch_size --data $data --source_caption $source_caption --agg_mode $agg_mode --work_queue &
+    done
+    wait
 else
     echo "bash output: Running tasks sequentially on a single GPU..."
     echo "bash output: Using vision model: $vision_model"
@@ -0,0 +1,75 @@
+#!/bin/bash
+# Train the same alignment layer on fp16 and int8 packed embeddings, evaluate both
+# checkpoints on ImageNet and COCO and compare the numbers.
+
+# ----------------------SETTING------------------------
+vision_model="facebook/dinov2-large"
+text_model="nvidia/NV-Embed-v2"
+text_embedding_list="data/tensor_data/text_embedding/NV-Embed-v2/dreamclipcc3m_raw_caption"
+image_embedding_list="data/tensor_data/image_embedding/dinov2-large/dreamclipcc3m_concat"
+output_name="quant_check_dinov2l_nv2"
+DATASET_ROOT_DIR=""
+
+epoch_num=20
+lr=1e-5
+bs=32768
+d=1024
+tolerance=0.005
+# ------------------------------------------------------
+
+# int8 stores are written next to the fp16 ones as <dir>_int8
+python -m data.embedding_store $text_embedding_list $image_embedding_list
+python -m data.embedding_store $text_embedding_list $image_embedding_list --dtype int8 --output-suffix _int8
+
+for dtype in fp16 int8
+do
+    if [ "$dtype" == "int8" ]; then
+        text_list=$(for dir in $text_embedding_list; do echo -n "${dir}_int8 "; done)
+        image_list=$(for dir in $image_embedding_list; do echo -n "${dir}_int8 "; done)
+    else
+        text_list=$text_embedding_list
+        image_list=$image_embedding_list
+    fi
+
+    python main.py \
+        --text-embedding-list $text_list \
+        --image-embedding-list $image_list \
+        --dataset-type embedding \
+        --seed 42 \
+        --resume latest \
+        --save-frequency $epoch_num \
+        --batch-size $bs \
+        --lr $lr \
+        --epochs $epoch_num \
+        --workers 0 \
+        --optimizer lion \
+        --siglip \
+        --wd 1e-4 \
+        --target-dimension $d \
+        --linear-type star \
+        --log-every-n-steps 5 \
+        --name ${output_name}_${dtype} \
+        --logit_scale 20 \
+        --logit_bias -10
+
+    for task in imagenetv1 COCO
+    do
+        python eval.py \
+            --head-weights-path ./logs/${output_name}_${dtype}/checkpoints/epoch_${epoch_num}.pt \
+            --task $task \
+            --vision-model $vision_model \
+            --text-model $text_model \
+            --dataset_root_dir $DATASET_ROOT_DIR \
+            --batch_size 32 \
+            --agg_mode concat
+    done
+done
+
+for task in imagenetv1 COCO
+do
+    python -m evaluation.compare_results \
+        evaluation/eval_result/$task/${output_name}_fp16/alignment_probing.json \
+        evaluation/eval_result/$task/${output_name}_int8/alignment_probing.json \
+        --epoch $epoch_num \
+        --tolerance $tolerance
+done
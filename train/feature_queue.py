@@ -0,0 +1,82 @@
+import copy
+import logging
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+
+class FeatureQueue:
+    """
+    FIFO of the projected image and text features of recent batches, fed to SigLipLoss / ClipLoss
+    as extra negatives (`queue_image_features` / `queue_text_features`).
+
+    The backbones are frozen and their embeddings precomputed, so an entry only goes stale as
+    the alignment layer moves. Rows older than `max_age` steps are never returned. With
+    `momentum`, entries come from an exponential moving average copy of the model, which moves
+    more slowly and keeps the queue consistent over more steps. Features are stored as projected,
+    in `dtype` on the training device; the losses normalize them like the batch features.
+    Each rank keeps its own queue.
+
+    Entries carry no sample identity, so a queued caption of an image that appears again in the
+    current batch (text row i pairs with image i % n_img) is treated as a negative for it.
+    """
+
+    def __init__(self, size: int, device, dtype: torch.dtype = torch.float16, max_age: Optional[int] = None,
+                 momentum: Optional[float] = None, model: Optional[nn.Module] = None):
+        self.size = size
+        self.device = device
+        self.dtype = dtype
+        self.max_age = max_age
+        self.momentum = momentum
+        self.image_features = self.text_features = None
+        # step at which each row was written, -1 while empty
+        self.steps = torch.full((size,), -1, dtype=torch.long, device=device)
+        self.pointer = 0
+        self.momentum_model = None
+        if momentum is not None:
+            assert model is not None, "A momentum queue needs the model to copy"
+            self.momentum_model = copy.deepcopy(model).requires_grad_(False).eval()
+            logging.info(f"Feature queue of {size} rows fed by a momentum copy of the model (momentum {momentum})")
+        else:
+            logging.info(f"Feature queue of {size} rows")
+
+    def negatives(self, step: int) -> dict:
+        """Keyword arguments for the loss: the queued features no older than max_age, or none."""
+        if self.image_features is None:
+            return {}
+        valid = self.steps >= 0
+        if self.max_age is not None:
+            valid &= self.steps >= step - self.max_age
+        if not valid.any():
+            return {}
+        if valid.all():
+            return {"queue_image_features": self.image_features, "queue_text_features": self.text_features}
+        return {"queue_image_features": self.image_features[valid], "queue_text_features": self.text_features[valid]}
+
+    @torch.no_grad()
+    def _update_momentum_model(self, model: nn.Module):
+        for momentum_param, param in zip(self.momentum_model.parameters(), model.parameters()):
+            momentum_param.mul_(self.momentum).add_(param.detach(), alpha=1 - self.momentum)
+        for momentum_buffer, buffer in zip(self.momentum_model.buffers(), model.buffers()):
+            momentum_buffer.copy_(buffer)
+
+    @torch.no_grad()
+    def update(self, model: nn.Module, images: torch.Tensor, texts: torch.Tensor, model_out: dict, step: int):
+        """Enqueue this step's features; call after the optimizer step with the batch and its model outputs."""
+        if self.momentum_model is not None:
+            self._update_momentum_model(model)
+            model_out = self.momentum_model(images, texts)
+        self._enqueue(model_out["image_features"], model_out["text_features"], step)
+
+    def _enqueue(self, image_features: torch.Tensor, text_features: torch.Tensor, step: int):
+        if self.image_features is None:
+            self.image_features = torch.zeros(self.size, image_features.shape[1], dtype=self.dtype, device=self.device)
+            self.text_features = torch.zeros(self.size, text_features.shape[1], dtype=self.dtype, device=self.device)
+        # a batch larger than the queue only keeps its last rows
+        image_features, text_features = image_features[-self.size:], text_features[-self.size:]
+        indices = (self.pointer + torch.arange(image_features.shape[0], device=self.device)) % self.size
+        self.image_features[indices] = image_features.detach().to(self.dtype)
+        self.text_features[indices] = text_features.detach().to(self.dtype)
+        self.steps[indices] = step
+        self.pointer = (self.pointer + image_features.shape[0]) % self.size
@@ -164,10 +164,41 @@ def parse_args(args):
     )
     parser.add_argument(
         "--dataset-type",
-        choices=["webdataset", "csv", "synthetic", "auto", "embedding"],
+        choices=["webdataset", "csv", "synthetic", "auto", "embedding", "embedding-stream"],
         default="auto",
         help="Which type of dataset to process."
     )
+    parser.add_argument(
+        "--stream-shuffle-buffer",
+        type=int,
+        default=131072,
+        help="Number of rows held in the shuffle buffer of each --dataset-type embedding-stream worker."
+    )
+    parser.add_argument(
+        "--data-on-device",
+        default=False,
+        action="store_true",
+        help="Keep the training embeddings resident on the training device and sample batches there, bypassing the DataLoader."
+    )
+    parser.add_argument(
+        "--load-workers",
+        type=int,
+        default=8,
+        help="Number of parallel readers used to load .pt embedding shards at startup."
+    )
+    parser.add_argument(
+        "--image-agg-mode",
+        choices=["concat", "cls", "patch"],
+        default=None,
+        help="Build this aggregation from concat-encoded image embeddings ([cls | patch-mean]) at load time "
+             "instead of re-encoding; evaluate with the matching --agg_mode. Default: use the embeddings as stored."
+    )
+    parser.add_argument(
+        "--load-backend",
+        choices=["thread", "process"],
+        default="thread",
+        help="Pool type used by --load-workers to read .pt embedding shards."
+    )
     parser.add_argument(
         "--dataset-resampled",
         default=False,
@@ -366,6 +397,13 @@ def parse_args(args):
         action="store_true",
         help="enable full distributed gradient for feature gather"
     )
+    parser.add_argument(
+        "--clip-chunk-size",
+        type=int,
+        default=None,
+        help="Compute the Clip (InfoNCE) loss over logit chunks of this many rows and columns, with a streaming "
+        "logsumexp and a chunked backward, never materializing the batch x batch logits. Same loss values."
+    )
     parser.add_argument(
         '--force-image-size', type=int, nargs='+', default=None,
         help='Override default image size'
@@ -555,6 +593,51 @@ def parse_args(args):
         action="store_true",
         help='Use SigLip (sigmoid) loss.'
     )
+    parser.add_argument(
+        "--siglip-block-size",
+        type=int,
+        default=None,
+        help='Compute the SigLip loss in tiles of this many rows and columns, never materializing the full '
+        'batch x batch logits. Needed for very large batches, e.g. 4096 at --batch-size 32768.'
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=0,
+        help='Keep the projected features of this many recent samples in an fp16 queue and use them as extra '
+        'negatives in the SigLip or Clip loss. 0 disables the queue. Queued entries are not matched against the '
+        'current batch: with several captions per image, a queued caption of an image that is in the batch again '
+        'counts as a negative for it (false negatives, more frequent with larger queues).'
+    )
+    parser.add_argument(
+        "--queue-max-age",
+        type=int,
+        default=None,
+        help='Only use queued features written in the last this many steps.'
+    )
+    parser.add_argument(
+        "--queue-momentum",
+        type=float,
+        default=None,
+        help='Fill the queue from an exponential moving average copy of the model with this momentum (e.g. 0.99) '
+        'instead of the model itself. The copy restarts from the model when training resumes.'
+    )
+    parser.add_argument(
+        "--siglip-negatives",
+        type=int,
+        default=None,
+        help='Estimate the SigLip loss from the positive plus this many sampled negatives per row, reweighted '
+        'to an unbiased estimate of the full loss. Cost grows with batch x negatives instead of batch x batch. '
+        'With several ranks, the text blocks received over the ring share another budget of this many draws per row.'
+    )
+    parser.add_argument(
+        "--siglip-negative-sampling",
+        type=str,
+        default="random",
+        choices=["random", "hard"],
+        help='How --siglip-negatives are drawn: uniformly, or in proportion to their gradient (sigmoid of the logit), '
+        'favouring hard negatives.'
+    )
     parser.add_argument(
         "--barlowtwins",
         default=False,  
@@ -0,0 +1,109 @@
+import json
+import time
+import logging
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import numpy as np
+import torch
+
+
+def synchronize(device: Optional[Union[str, torch.device]]):
+    if device is None:
+        return
+    device = torch.device(device)
+    if device.type == "cuda" and torch.cuda.is_available():
+        torch.cuda.synchronize(device)
+
+
+class StageTimer:
+    """
+    Per-stage wall-clock timing of a pipeline loop, e.g. data wait / h2d / forward / d2h / save.
+
+    Wrap each stage in `with timer.stage(name, device)`; a CUDA `device` is synchronized before
+    and after the stage so queued kernels are charged to the stage that launched them. Stages
+    timed elsewhere (e.g. in DataLoader workers) can be `add`ed directly. `step(n)` closes one
+    iteration of n items and, with `jsonl_path`, appends its stage times as one JSON line.
+    Percentiles are over the last `window` steps; totals are over the whole run.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, window: int = 1000, enabled: bool = True):
+        self.enabled = enabled
+        self.window = window
+        self.jsonl = open(jsonl_path, "a") if (jsonl_path and enabled) else None
+        self.recent = OrderedDict()
+        self.totals = OrderedDict()
+        self.current = OrderedDict()
+        self.steps = 0
+        self.items = 0
+        self.start_time = time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str, device: Optional[Union[str, torch.device]] = None):
+        if not self.enabled:
+            yield
+            return
+        synchronize(device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            synchronize(device)
+            self.add(name, time.perf_counter() - start)
+
+    def step(self, n: int = 1, **extra):
+        if not self.enabled:
+            return
+        for name, seconds in self.current.items():
+            self.recent.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+        if self.jsonl is not None:
+            record = {"step": self.steps, "items": n, "time": time.time(), **{f"{k}_s": v for k, v in self.current.items()}, **extra}
+            self.jsonl.write(json.dumps(record) + "\n")
+        self.current = OrderedDict()
+        self.steps += 1
+        self.items += n
+
+    def summary(self) -> list:
+        """One row per stage: total seconds, share of the summed stage time, mean/p50/p90/p99 ms per step."""
+        stage_total = sum(self.totals.values()) or 1e-9
+        rows = []
+        for name, total in self.totals.items():
+            recent = np.asarray(self.recent[name]) * 1000
+            p50, p90, p99 = np.percentile(recent, [50, 90, 99])
+            rows.append({
+                "stage": name,
+                "total_s": total,
+                "share": total / stage_total,
+                "mean_ms": 1000 * total / self.steps,
+                "p50_ms": p50,
+                "p90_ms": p90,
+                "p99_ms": p99,
+                "items_per_s": self.items / total if total > 0 else float("inf"),
+            })
+        return rows
+
+    def log_summary(self, unit: str = "items"):
+        if not self.enabled or self.steps == 0:
+            return
+        wall = time.perf_counter() - self.start_time
+        lines = [f"{'stage':<12}{'total s':>10}{'share':>8}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{unit + '/s':>14}"]
+        for row in self.summary():
+            lines.append(f"{row['stage']:<12}{row['total_s']:>10.2f}{100 * row['share']:>7.1f}%{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}"
+                         f"{row['p90_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['items_per_s']:>14.1f}")
+        lines.append(f"{self.steps} steps, {self.items} {unit} in {wall:.2f} s wall: {self.items / wall:.1f} {unit}/s end to end")
+        logging.info("Stage timing (the slowest stage bounds throughput):\n" + "\n".join(lines))
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps({"summary": self.summary(), "wall_s": wall, "items": self.items}) + "\n")
+            self.jsonl.flush()
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
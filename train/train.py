@@ -60,7 +60,7 @@ def backward(total_loss, scaler):
         total_loss.backward()
 
 
-def train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args):
+def train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args, feature_queue=None):
     device = torch.device(args.device)
     autocast = get_autocast(args.precision)
     input_dtype = get_input_dtype(args.precision)
@@ -101,7 +101,8 @@ def train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args
         with autocast():
             model_out = model(images, texts, extra_texts)
             logit_scale = model_out["logit_scale"]
-            losses = loss(**model_out, output_dict=True)
+            queue_negatives = feature_queue.negatives(step) if feature_queue is not None else {}
+            losses = loss(**model_out, **queue_negatives, output_dict=True)
             total_loss = losses['contrastive_loss']
 
         backward(total_loss, scaler)
@@ -121,6 +122,10 @@ def train_one_epoch(model, data, loss, epoch, optimizer, scaler, scheduler, args
         with torch.no_grad():
             unwrap_model(model).logit_scale.clamp_(0, math.log(100))
 
+        if feature_queue is not None:
+            with autocast():
+                feature_queue.update(unwrap_model(model), images, texts, model_out, step)
+
         batch_time_m.update(time.time() - end)
         end = time.time()
         batch_count = i_accum + 1